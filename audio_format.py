@@ -0,0 +1,53 @@
+import codecs
+
+# Content types file hosts use for error pages rather than audio
+DOCUMENT_TYPES = ("text/", "application/json", "application/xml", "application/xhtml")
+
+
+def sniff_audio(data):
+    """
+    Identifies an audio container from a file's first bytes
+
+    Args:
+        data (bytes): The start of the file (a few dozen bytes are enough)
+
+    Returns:
+        str: "mp3", "aac", "flac", "ogg", "m4a" or "wav", or None if unrecognised
+    """
+    if data.startswith(b"ID3"):
+        return "mp3"
+    if len(data) >= 2 and data[0] == 0xFF:
+        # ADTS (raw AAC) sets layer bits 00; MPEG audio frames use the rest
+        if data[1] & 0xF6 == 0xF0:
+            return "aac"
+        if data[1] & 0xE0 == 0xE0:
+            return "mp3"
+    if data.startswith(b"fLaC"):
+        return "flac"
+    if data.startswith(b"OggS"):
+        return "ogg"
+    if data[4:8] == b"ftyp":
+        return "m4a"
+    if data.startswith(b"RIFF") and data[8:12] == b"WAVE":
+        return "wav"
+    return None
+
+
+def is_document_type(content_type):
+    """
+    Whether a Content-Type header announces a web page or API answer instead of a file
+    """
+    return (content_type or "").split(";")[0].strip().lower().startswith(DOCUMENT_TYPES)
+
+
+def looks_like_document(data):
+    """
+    Whether a body's first bytes are HTML, XML or JSON rather than binary audio
+
+    Unknown binary content is given the benefit of the doubt; only bodies that
+    are clearly markup or JSON count as documents.
+    """
+    if sniff_audio(data):
+        return False
+    text = data[len(codecs.BOM_UTF8):] if data.startswith(codecs.BOM_UTF8) else data
+    return text.lstrip()[:1] in (b"<", b"{", b"[")
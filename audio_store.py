@@ -0,0 +1,315 @@
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+
+
+class AudioStore:
+    """
+    Content-addressed store for downloaded audio, with a disk budget
+
+    Files are named by the SHA-256 of their content, so a track is kept once
+    no matter what it's called, and tracks with the same title never clash.
+    A SQLite index maps Spotify track IDs to content hashes and records each
+    file's size, source URL, last access and hit count. When the store grows
+    past max_bytes, the least recently used (policy "lru") or least often
+    used (policy "lfu") files are evicted.
+
+    Several processes may share one store directory.
+    """
+
+    def __init__(self, root, max_bytes=None, policy="lru", db_path=None):
+        """
+        Args:
+            root (str): Directory the audio files are kept in
+            max_bytes (int): Disk budget, or None for no limit
+            policy (str): "lru" or "lfu" - which files are evicted first
+            db_path (str): SQLite index (defaults to root/index.sqlite3)
+        """
+        if policy not in ("lru", "lfu"):
+            raise ValueError(f"Unknown eviction policy {policy!r}, expected 'lru' or 'lfu'")
+        self.root = root
+        self.max_bytes = max_bytes
+        self.policy = policy
+
+        os.makedirs(root, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path or os.path.join(root, "index.sqlite3"), check_same_thread=False, isolation_level=None, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS audio_blobs ("
+            " hash TEXT PRIMARY KEY,"
+            " size INTEGER NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " last_access REAL NOT NULL,"
+            " hits INTEGER NOT NULL DEFAULT 0)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS audio_tracks ("
+            " track_id TEXT PRIMARY KEY,"
+            " hash TEXT NOT NULL,"
+            " source_url TEXT,"
+            " metadata TEXT,"
+            " added_at REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS audio_tracks_hash ON audio_tracks (hash)")
+        self._counters = {"hits": 0, "misses": 0, "stored": 0, "deduplicated": 0, "evicted": 0}
+
+    def _blob_path(self, content_hash):
+        return os.path.join(self.root, content_hash[:2], content_hash + ".mp3")
+
+    def _transaction(self, fn):
+        # BEGIN IMMEDIATE takes the write lock, so processes sharing the index don't race
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn()
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+        return result
+
+    def _find(self, track_id):
+        # Runs inside a transaction
+        row = self._db.execute(
+            "SELECT t.hash, t.source_url, t.metadata, b.size FROM audio_tracks t"
+            " JOIN audio_blobs b ON b.hash = t.hash WHERE t.track_id = ?",
+            (track_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        content_hash, source_url, metadata, size = row
+        path = self._blob_path(content_hash)
+        if not os.path.exists(path):
+            # Removed behind our back; forget it so it's downloaded again
+            self._forget_blob(content_hash)
+            return None
+        self._db.execute(
+            "UPDATE audio_blobs SET last_access = ?, hits = hits + 1 WHERE hash = ?",
+            (time.time(), content_hash)
+        )
+        return {
+            "path": path,
+            "hash": content_hash,
+            "size": size,
+            "source_url": source_url,
+            "metadata": json.loads(metadata) if metadata else None
+        }
+
+    def _count(self, found):
+        with self._lock:
+            self._counters["hits" if found else "misses"] += 1
+
+    def lookup(self, track_id):
+        """
+        Finds a stored track and counts the access
+
+        Args:
+            track_id (str): Spotify track ID
+
+        Returns:
+            dict: {"path", "hash", "size", "source_url", "metadata"} or None if not stored
+        """
+        entry = self._transaction(lambda: self._find(track_id))
+        self._count(entry)
+        return entry
+
+    def open(self, track_id):
+        """
+        Opens a stored track for reading
+
+        Returns:
+            tuple: (file, entry) or None if the track isn't stored
+        """
+        stored = self.open_first([track_id])
+        return stored[:2] if stored else None
+
+    def open_first(self, track_ids):
+        """
+        Opens the first of several keys that's stored, e.g. a re-encoded
+        variant before the original, counting it as one access
+
+        Args:
+            track_ids (list): Keys to try, in order of preference
+
+        Returns:
+            tuple: (file, entry, track_id) or None if none of them is stored
+        """
+        def find_first():
+            for track_id in track_ids:
+                entry = self._find(track_id)
+                if entry:
+                    return entry, track_id
+            return None
+
+        found = self._transaction(find_first)
+        self._count(found)
+        if found is None:
+            return None
+        entry, track_id = found
+        try:
+            return open(entry["path"], "rb"), entry, track_id
+        except FileNotFoundError:
+            # Evicted by another process between the lookup and the open
+            return None
+
+    def add(self, track_id, source, source_url=None, metadata=None):
+        """
+        Stores a track's audio from a readable binary file object
+
+        The content is hashed while it's copied in; if an identical file is
+        already stored, the copy is dropped and the track points at that file.
+
+        Args:
+            track_id (str): Spotify track ID
+            source: File object positioned at the start of the audio
+            source_url (str): Where the audio was downloaded from
+            metadata (dict): Track metadata to keep with it (JSON serialisable)
+
+        Returns:
+            dict: The stored entry, as returned by lookup
+        """
+        tmp_path = os.path.join(self.root, f"incoming-{uuid.uuid4().hex}.part")
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with open(tmp_path, "wb") as f:
+                for chunk in iter(lambda: source.read(1024 * 1024), b""):
+                    digest.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+            return self._commit(track_id, digest.hexdigest(), size, tmp_path, source_url, metadata)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def add_file(self, track_id, path, source_url=None, metadata=None):
+        """
+        Stores a downloaded file, hard-linking it into the store when possible
+        so it takes no extra space
+
+        Args:
+            track_id (str): Spotify track ID
+            path (str): The downloaded file (left in place)
+            source_url (str): Where the audio was downloaded from
+            metadata (dict): Track metadata to keep with it (JSON serialisable)
+
+        Returns:
+            dict: The stored entry, as returned by lookup
+        """
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+        tmp_path = os.path.join(self.root, f"incoming-{uuid.uuid4().hex}.part")
+        try:
+            try:
+                os.link(path, tmp_path)
+            except OSError:
+                # Different filesystem (or no hard links): fall back to a copy
+                shutil.copyfile(path, tmp_path)
+            return self._commit(track_id, digest.hexdigest(), os.path.getsize(tmp_path), tmp_path, source_url, metadata)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _commit(self, track_id, content_hash, size, tmp_path, source_url, metadata):
+        blob_path = self._blob_path(content_hash)
+        now = time.time()
+
+        def commit():
+            if os.path.exists(blob_path):
+                self._counters["deduplicated"] += 1
+            else:
+                os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                os.replace(tmp_path, blob_path)
+                self._counters["stored"] += 1
+            self._db.execute(
+                "INSERT INTO audio_blobs (hash, size, created_at, last_access, hits) VALUES (?, ?, ?, ?, 0)"
+                " ON CONFLICT (hash) DO UPDATE SET last_access = excluded.last_access",
+                (content_hash, size, now, now)
+            )
+            previous = self._db.execute("SELECT hash FROM audio_tracks WHERE track_id = ?", (track_id,)).fetchone()
+            self._db.execute(
+                "INSERT OR REPLACE INTO audio_tracks (track_id, hash, source_url, metadata, added_at) VALUES (?, ?, ?, ?, ?)",
+                (track_id, content_hash, source_url, json.dumps(metadata) if metadata is not None else None, now)
+            )
+            # The track's old content is garbage once nothing points at it
+            if previous and previous[0] != content_hash:
+                self._drop_if_unreferenced(previous[0])
+            self._evict(keep=content_hash)
+
+        self._transaction(commit)
+        return {"path": blob_path, "hash": content_hash, "size": size, "source_url": source_url, "metadata": metadata}
+
+    def _drop_if_unreferenced(self, content_hash):
+        if not self._db.execute("SELECT 1 FROM audio_tracks WHERE hash = ? LIMIT 1", (content_hash,)).fetchone():
+            self._forget_blob(content_hash)
+
+    def _forget_blob(self, content_hash):
+        self._db.execute("DELETE FROM audio_tracks WHERE hash = ?", (content_hash,))
+        self._db.execute("DELETE FROM audio_blobs WHERE hash = ?", (content_hash,))
+        try:
+            os.remove(self._blob_path(content_hash))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self, keep=None):
+        # Runs inside a transaction; removes files until the store fits its budget
+        if self.max_bytes is None:
+            return
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM audio_blobs").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        order = "last_access" if self.policy == "lru" else "hits, last_access"
+        victims = self._db.execute(f"SELECT hash, size FROM audio_blobs WHERE hash != ? ORDER BY {order}", (keep or "",))
+        for content_hash, size in victims.fetchall():
+            if total <= self.max_bytes:
+                break
+            self._forget_blob(content_hash)
+            self._counters["evicted"] += 1
+            total -= size
+
+    def export(self, entry, dest_path):
+        """
+        Places a stored track at dest_path (hard link if possible, otherwise a copy)
+
+        Args:
+            entry (dict): The track's entry from lookup
+            dest_path (str): Where the file should appear
+
+        Returns:
+            str: dest_path, or None if the file has been evicted since the lookup
+        """
+        directory = os.path.dirname(dest_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = dest_path + ".part"
+        try:
+            os.link(entry["path"], tmp_path)
+        except FileNotFoundError:
+            return None
+        except OSError:
+            shutil.copyfile(entry["path"], tmp_path)
+        os.replace(tmp_path, dest_path)
+        return dest_path
+
+    def stats(self):
+        """
+        Returns the store's size and budget, plus hit, dedupe and eviction counters
+        """
+        with self._lock:
+            files, size = self._db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM audio_blobs").fetchone()
+            tracks = self._db.execute("SELECT COUNT(*) FROM audio_tracks").fetchone()[0]
+            counters = dict(self._counters)
+        lookups = counters["hits"] + counters["misses"]
+        counters.update(
+            files=files, tracks=tracks, bytes=size, max_bytes=self.max_bytes,
+            hit_rate=counters["hits"] / lookups if lookups else 0.0
+        )
+        return counters
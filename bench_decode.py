@@ -0,0 +1,122 @@
+"""
+Micro-benchmark for decoding spotydown API responses.
+
+Compares the old decode ladder (httpx's json(), then manual brotli, then
+json.loads(text), then a lossy utf-8 decode) with decoding.py's single-pass
+decoder, for every encoding the API may answer with. Payloads are recorded
+response bodies (decoded JSON files) given on the command line; without any,
+sample bodies shaped like the API's answers are used. Legacy timings include
+building the httpx response, since that's where httpx decoded the body.
+
+Usage:
+    python bench_decode.py
+    python bench_decode.py recorded/metadata.json recorded/playlist.json --rounds 2000
+"""
+import argparse
+import gzip
+import json
+import os
+import timeit
+import zlib
+
+import brotli
+import httpx
+import zstandard as zstd
+
+from decoding import decode_json
+
+CHUNK_SIZE = 16 * 1024  # httpx's default raw read size
+
+ENCODERS = {
+    "identity": lambda body: body,
+    "gzip": lambda body: gzip.compress(body, compresslevel=6),
+    "deflate": lambda body: zlib.compress(body, 6),
+    "br": lambda body: brotli.compress(body, quality=5),
+    "zstd": lambda body: zstd.ZstdCompressor(level=3).compress(body)
+}
+
+
+def sample_track(number):
+    return {
+        "name": f"Sample Track {number}",
+        "artist": "Sample Artist, Featured Artist",
+        "album_name": "Sample Album (Deluxe Edition)",
+        "album_artist": "Sample Artist",
+        "cover_url": f"https://i.scdn.co/image/ab67616d0000b273{number:024x}",
+        "url": f"https://open.spotify.com/track/{number:022d}",
+        "duration": 180000 + number,
+        "release_date": "2024-01-01"
+    }
+
+
+def sample_payloads():
+    return {
+        "metadata (1 track)": {"apiResponse": {"data": [sample_track(1)]}},
+        "playlist (100 tracks)": {"apiResponse": {"data": [sample_track(n) for n in range(100)]}},
+        "download-track": {"file_url": "https://cdn.example.com/files/" + "a" * 64 + ".mp3"}
+    }
+
+
+def legacy_decode(response):
+    # The ladder that used to be copied into get_spotify_track_metadata and download_track
+    try:
+        return response.json()
+    except json.JSONDecodeError:
+        if 'br' in response.headers.get('content-encoding', '').lower():
+            try:
+                return json.loads(brotli.decompress(response.content))
+            except Exception:
+                try:
+                    return json.loads(response.text)
+                except json.JSONDecodeError:
+                    try:
+                        return json.loads(response.content.decode('utf-8', errors='ignore'))
+                    except Exception:
+                        return None
+    except Exception:
+        return None
+    return None
+
+
+def legacy_run(encoding, raw):
+    response = httpx.Response(200, headers={"content-encoding": encoding}, content=raw)
+    return legacy_decode(response)
+
+
+def unified_run(encoding, raw):
+    chunks = [raw[i:i + CHUNK_SIZE] for i in range(0, len(raw), CHUNK_SIZE)]
+    return decode_json(encoding, chunks)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark API response decoding")
+    parser.add_argument("payloads", nargs="*", help="recorded response bodies (JSON files)")
+    parser.add_argument("--rounds", type=int, default=1000, help="decodes per measurement")
+    args = parser.parse_args()
+
+    if args.payloads:
+        payloads = {}
+        for path in args.payloads:
+            with open(path, "rb") as f:
+                payloads[os.path.basename(path)] = json.load(f)
+    else:
+        payloads = sample_payloads()
+
+    print(f"{'payload':<24}{'encoding':<10}{'bytes':>8}{'legacy us':>12}{'unified us':>12}{'speedup':>9}")
+    for name, payload in payloads.items():
+        body = json.dumps(payload).encode("utf-8")
+        for encoding, encode in ENCODERS.items():
+            raw = encode(body)
+            assert unified_run(encoding, raw) == payload
+
+            unified = timeit.timeit(lambda: unified_run(encoding, raw), number=args.rounds) / args.rounds * 1e6
+            if legacy_run(encoding, raw) == payload:
+                legacy = timeit.timeit(lambda: legacy_run(encoding, raw), number=args.rounds) / args.rounds * 1e6
+                legacy_text, speedup = f"{legacy:.1f}", f"{legacy / unified:.2f}x"
+            else:
+                legacy_text, speedup = "fails", "-"
+            print(f"{name:<24}{encoding:<10}{len(raw):>8}{legacy_text:>12}{unified:>12.1f}{speedup:>9}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,278 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+
+class Broker:
+    """
+    Job broker shared by the bot front end and the download workers
+
+    Delivery is at-least-once: reserve() hides a job for visibility_timeout
+    seconds, and unless the worker ack()s it (or keeps extend()ing it while it
+    works) the job becomes visible again and another worker picks it up.
+    """
+
+    def enqueue(self, payload):
+        """
+        Adds a job
+
+        Args:
+            payload (dict): JSON serialisable job description
+
+        Returns:
+            str: The job ID
+        """
+        raise NotImplementedError
+
+    def reserve(self, visibility_timeout):
+        """
+        Takes the oldest visible job and hides it from other workers
+
+        Args:
+            visibility_timeout (float): Seconds before the job is handed out again
+
+        Returns:
+            tuple: (job_id, receipt, payload, attempts) or None if no job is ready
+        """
+        raise NotImplementedError
+
+    def extend(self, job_id, receipt, visibility_timeout):
+        """
+        Keeps a reserved job hidden for another visibility_timeout seconds
+
+        Returns:
+            bool: False if the reservation was lost (the job was handed to someone else)
+        """
+        raise NotImplementedError
+
+    def ack(self, job_id, receipt):
+        """
+        Removes a finished job
+        """
+        raise NotImplementedError
+
+    def stats(self):
+        """
+        Returns the number of ready, reserved and dead jobs
+        """
+        raise NotImplementedError
+
+
+class SqliteBroker(Broker):
+    """
+    Broker backed by a local SQLite file, for several processes on one host
+    """
+
+    def __init__(self, db_path, queue="downloads", max_attempts=5):
+        self.db_path = db_path
+        self.queue = queue
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(db_path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id TEXT PRIMARY KEY,"
+            " queue TEXT NOT NULL,"
+            " payload TEXT NOT NULL,"
+            " receipt TEXT,"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " visible_at REAL NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " dead INTEGER NOT NULL DEFAULT 0)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS jobs_ready ON jobs (queue, dead, visible_at, created_at)")
+
+    def enqueue(self, payload):
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO jobs (id, queue, payload, visible_at, created_at) VALUES (?, ?, ?, ?, ?)",
+                (job_id, self.queue, json.dumps(payload), now, now)
+            )
+        return job_id
+
+    def reserve(self, visibility_timeout):
+        now = time.time()
+        receipt = uuid.uuid4().hex
+        with self._lock:
+            # BEGIN IMMEDIATE takes the write lock, so two processes can't reserve the same row
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                # Jobs that keep failing are parked instead of being retried forever
+                self._db.execute(
+                    "UPDATE jobs SET dead = 1 WHERE queue = ? AND dead = 0 AND visible_at <= ? AND attempts >= ?",
+                    (self.queue, now, self.max_attempts)
+                )
+                row = self._db.execute(
+                    "SELECT id, payload, attempts FROM jobs WHERE queue = ? AND dead = 0 AND visible_at <= ?"
+                    " ORDER BY created_at LIMIT 1",
+                    (self.queue, now)
+                ).fetchone()
+                if row is None:
+                    self._db.execute("COMMIT")
+                    return None
+                job_id, payload, attempts = row
+                self._db.execute(
+                    "UPDATE jobs SET receipt = ?, attempts = attempts + 1, visible_at = ? WHERE id = ?",
+                    (receipt, now + visibility_timeout, job_id)
+                )
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+        return job_id, receipt, json.loads(payload), attempts + 1
+
+    def extend(self, job_id, receipt, visibility_timeout):
+        with self._lock:
+            cursor = self._db.execute(
+                "UPDATE jobs SET visible_at = ? WHERE id = ? AND receipt = ?",
+                (time.time() + visibility_timeout, job_id, receipt)
+            )
+        return cursor.rowcount == 1
+
+    def ack(self, job_id, receipt):
+        with self._lock:
+            self._db.execute("DELETE FROM jobs WHERE id = ? AND receipt = ?", (job_id, receipt))
+
+    def stats(self):
+        now = time.time()
+        with self._lock:
+            ready, reserved, dead = self._db.execute(
+                "SELECT"
+                " COALESCE(SUM(dead = 0 AND visible_at <= ?), 0),"
+                " COALESCE(SUM(dead = 0 AND visible_at > ?), 0),"
+                " COALESCE(SUM(dead = 1), 0)"
+                " FROM jobs WHERE queue = ?",
+                (now, now, self.queue)
+            ).fetchone()
+        return {"ready": ready, "reserved": reserved, "dead": dead}
+
+
+class RedisBroker(Broker):
+    """
+    Broker backed by Redis (or any server speaking its protocol), for workers on several hosts
+
+    Ready job IDs live in a list, reserved ones in a sorted set scored by the
+    time their visibility timeout runs out; payloads and attempt counts in hashes.
+    """
+
+    # Moves expired reservations back to the ready list, then reserves the oldest ready job
+    RESERVE_SCRIPT = """
+    local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1])
+    for _, job_id in ipairs(expired) do
+        redis.call('ZREM', KEYS[2], job_id)
+        if tonumber(redis.call('HGET', KEYS[4], job_id) or '0') >= tonumber(ARGV[4]) then
+            redis.call('LPUSH', KEYS[5], job_id)
+        else
+            redis.call('RPUSH', KEYS[1], job_id)
+        end
+    end
+    local job_id = redis.call('LPOP', KEYS[1])
+    if not job_id then
+        return nil
+    end
+    redis.call('ZADD', KEYS[2], ARGV[2], job_id)
+    redis.call('HSET', KEYS[6], job_id, ARGV[3])
+    local attempts = redis.call('HINCRBY', KEYS[4], job_id, 1)
+    return {job_id, redis.call('HGET', KEYS[3], job_id), attempts}
+    """
+
+    # Extends a reservation only while the caller's receipt still holds it, in one atomic step,
+    # so a worker whose reservation expired and was handed out again can't extend the new one
+    EXTEND_SCRIPT = """
+    if redis.call('HGET', KEYS[2], ARGV[1]) ~= ARGV[2] then
+        return 0
+    end
+    if not redis.call('ZSCORE', KEYS[1], ARGV[1]) then
+        return 0
+    end
+    redis.call('ZADD', KEYS[1], 'XX', ARGV[3], ARGV[1])
+    return 1
+    """
+
+    # Removes a finished job only if the caller's receipt still holds it
+    ACK_SCRIPT = """
+    if redis.call('HGET', KEYS[5], ARGV[1]) ~= ARGV[2] then
+        return 0
+    end
+    redis.call('ZREM', KEYS[1], ARGV[1])
+    -- A late ack may land after the job timed out and went back to the ready list
+    redis.call('LREM', KEYS[2], 0, ARGV[1])
+    redis.call('HDEL', KEYS[3], ARGV[1])
+    redis.call('HDEL', KEYS[4], ARGV[1])
+    redis.call('HDEL', KEYS[5], ARGV[1])
+    return 1
+    """
+
+    def __init__(self, url, queue="downloads", max_attempts=5):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("RedisBroker needs the redis package (pip install redis)")
+
+        self.queue = queue
+        self.max_attempts = max_attempts
+        self._redis = redis.Redis.from_url(url)
+        self._reserve = self._redis.register_script(self.RESERVE_SCRIPT)
+        self._extend = self._redis.register_script(self.EXTEND_SCRIPT)
+        self._ack = self._redis.register_script(self.ACK_SCRIPT)
+        self._keys = {name: f"{queue}:{name}" for name in ("ready", "reserved", "payloads", "attempts", "dead", "receipts")}
+
+    def enqueue(self, payload):
+        job_id = uuid.uuid4().hex
+        pipeline = self._redis.pipeline()
+        pipeline.hset(self._keys["payloads"], job_id, json.dumps(payload))
+        pipeline.rpush(self._keys["ready"], job_id)
+        pipeline.execute()
+        return job_id
+
+    def reserve(self, visibility_timeout):
+        now = time.time()
+        receipt = uuid.uuid4().hex
+        keys = [self._keys[name] for name in ("ready", "reserved", "payloads", "attempts", "dead", "receipts")]
+        result = self._reserve(keys=keys, args=[now, now + visibility_timeout, receipt, self.max_attempts])
+        if not result:
+            return None
+        job_id, payload, attempts = result
+        return job_id.decode(), receipt, json.loads(payload), int(attempts)
+
+    def extend(self, job_id, receipt, visibility_timeout):
+        keys = [self._keys["reserved"], self._keys["receipts"]]
+        return bool(self._extend(keys=keys, args=[job_id, receipt, time.time() + visibility_timeout]))
+
+    def ack(self, job_id, receipt):
+        keys = [self._keys[name] for name in ("reserved", "ready", "payloads", "attempts", "receipts")]
+        self._ack(keys=keys, args=[job_id, receipt])
+
+    def stats(self):
+        return {
+            "ready": self._redis.llen(self._keys["ready"]),
+            "reserved": self._redis.zcard(self._keys["reserved"]),
+            "dead": self._redis.llen(self._keys["dead"])
+        }
+
+
+def broker_from_url(url, **kwargs):
+    """
+    Creates a broker from a URL
+
+    Args:
+        url (str): sqlite:///path/to/jobs.sqlite3, redis://host:6379/0 or rediss://...
+
+    Returns:
+        Broker: The matching broker
+    """
+    if url.startswith("sqlite:///"):
+        return SqliteBroker(url[len("sqlite:///"):], **kwargs)
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisBroker(url, **kwargs)
+    raise ValueError(f"Unsupported broker URL: {url}")
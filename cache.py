@@ -0,0 +1,228 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class TieredCache:
+    """
+    Two-tier key/value cache: an in-memory LRU in front of an optional SQLite file
+
+    Values must be JSON serialisable. Storing None records a failed lookup
+    (negative caching) which expires after negative_ttl instead of ttl.
+    Entries read from disk are promoted into memory, so a restarted process
+    warms up again without touching the upstream API.
+
+    Expired rows are purged from disk every purge_interval seconds (checked
+    on set), and max_disk_entries caps the rows kept, dropping the least
+    recently written first. The a-prefixed methods run the disk tier in a
+    worker thread for use on an event loop.
+    """
+
+    def __init__(self, namespace, db_path=None, ttl=None, negative_ttl=60, max_entries=1024,
+                 max_disk_entries=None, purge_interval=600):
+        """
+        Args:
+            namespace (str): Name that keeps this cache's rows apart in a shared database
+            db_path (str): SQLite file for the persistent tier, or None for memory only
+            ttl (float): Seconds an entry stays valid, or None to never expire
+            negative_ttl (float): Seconds a cached failure (None value) stays valid
+            max_entries (int): Maximum entries kept in the in-memory tier
+            max_disk_entries (int): Maximum rows kept on disk, or None for no limit
+            purge_interval (float): Seconds between purges of expired rows
+        """
+        self.namespace = namespace
+        self.db_path = db_path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self.purge_interval = purge_interval
+        self._next_purge = time.monotonic() + purge_interval
+
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._db = None
+        self._counters = {"memory_hits": 0, "disk_hits": 0, "negative_hits": 0, "misses": 0}
+
+        if db_path:
+            directory = os.path.dirname(db_path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory, exist_ok=True)
+            self._db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS cache_entries ("
+                " namespace TEXT NOT NULL,"
+                " key TEXT NOT NULL,"
+                " value TEXT,"
+                " expires_at REAL,"
+                " PRIMARY KEY (namespace, key))"
+            )
+
+    def _remember(self, key, value, expires_at):
+        self._memory[key] = (value, expires_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _count_hit(self, tier, value):
+        self._counters["negative_hits" if value is None else tier] += 1
+
+    def _get_memory(self, key, now):
+        # Runs under the lock
+        entry = self._memory.get(key)
+        if entry is not None:
+            value, expires_at = entry
+            if expires_at is None or expires_at > now:
+                self._memory.move_to_end(key)
+                self._count_hit("memory_hits", value)
+                return True, value
+            del self._memory[key]
+        return False, None
+
+    def get(self, key):
+        """
+        Looks up a key in memory, then on disk
+
+        Args:
+            key (str): Cache key
+
+        Returns:
+            tuple: (hit, value) - hit is False when the key is missing or expired
+        """
+        now = time.time()
+        with self._lock:
+            hit, value = self._get_memory(key, now)
+            if hit:
+                return True, value
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT value, expires_at FROM cache_entries WHERE namespace = ? AND key = ?",
+                    (self.namespace, key)
+                ).fetchone()
+                if row is not None:
+                    stored, expires_at = row
+                    if expires_at is None or expires_at > now:
+                        value = json.loads(stored) if stored is not None else None
+                        self._remember(key, value, expires_at)
+                        self._count_hit("disk_hits", value)
+                        return True, value
+                    self._db.execute(
+                        "DELETE FROM cache_entries WHERE namespace = ? AND key = ?",
+                        (self.namespace, key)
+                    )
+
+            self._counters["misses"] += 1
+            return False, None
+
+    def set(self, key, value, ttl=None):
+        """
+        Stores a value; None is stored as a negative entry
+
+        Args:
+            key (str): Cache key
+            value: JSON serialisable value, or None for a failed lookup
+            ttl (float): Overrides the cache's default TTL for this entry
+        """
+        if ttl is None:
+            ttl = self.negative_ttl if value is None else self.ttl
+        expires_at = time.time() + ttl if ttl is not None else None
+
+        with self._lock:
+            self._remember(key, value, expires_at)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO cache_entries (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)",
+                    (self.namespace, key, json.dumps(value) if value is not None else None, expires_at)
+                )
+            purge_due = time.monotonic() >= self._next_purge
+            if purge_due:
+                self._next_purge = time.monotonic() + self.purge_interval
+        if purge_due:
+            self.purge_expired()
+
+    def delete(self, key):
+        """
+        Removes a key from both tiers
+        """
+        with self._lock:
+            self._memory.pop(key, None)
+            if self._db is not None:
+                self._db.execute(
+                    "DELETE FROM cache_entries WHERE namespace = ? AND key = ?",
+                    (self.namespace, key)
+                )
+
+    def purge_expired(self):
+        """
+        Drops expired entries from both tiers, and the oldest disk rows beyond max_disk_entries
+
+        Returns:
+            int: Number of rows removed from disk
+        """
+        now = time.time()
+        with self._lock:
+            for key in [k for k, (_, expires_at) in self._memory.items() if expires_at is not None and expires_at <= now]:
+                del self._memory[key]
+            if self._db is None:
+                return 0
+            removed = self._db.execute(
+                "DELETE FROM cache_entries WHERE namespace = ? AND expires_at IS NOT NULL AND expires_at <= ?",
+                (self.namespace, now)
+            ).rowcount
+            if self.max_disk_entries is not None:
+                # INSERT OR REPLACE gives a rewritten row a new rowid, so the lowest rowids were written longest ago
+                removed += self._db.execute(
+                    "DELETE FROM cache_entries WHERE namespace = ? AND rowid IN ("
+                    " SELECT rowid FROM cache_entries WHERE namespace = ? ORDER BY rowid DESC LIMIT -1 OFFSET ?)",
+                    (self.namespace, self.namespace, self.max_disk_entries)
+                ).rowcount
+            return removed
+
+    async def aget(self, key):
+        """
+        Async version of get; only a lookup that reaches the disk tier leaves the event loop
+        """
+        with self._lock:
+            hit, value = self._get_memory(key, time.time())
+        if hit:
+            return True, value
+        if self._db is None:
+            return self.get(key)
+        return await asyncio.to_thread(self.get, key)
+
+    async def aset(self, key, value, ttl=None):
+        """
+        Async version of set
+        """
+        if self._db is None:
+            return self.set(key, value, ttl)
+        return await asyncio.to_thread(self.set, key, value, ttl)
+
+    async def adelete(self, key):
+        """
+        Async version of delete
+        """
+        if self._db is None:
+            return self.delete(key)
+        return await asyncio.to_thread(self.delete, key)
+
+    def stats(self):
+        """
+        Returns hit/miss counters for this cache
+
+        Returns:
+            dict: Counters plus the overall hit rate and in-memory size
+        """
+        with self._lock:
+            counters = dict(self._counters)
+            counters["memory_entries"] = len(self._memory)
+        lookups = counters["memory_hits"] + counters["disk_hits"] + counters["negative_hits"] + counters["misses"]
+        hits = lookups - counters["misses"]
+        counters["hit_rate"] = hits / lookups if lookups else 0.0
+        return counters
@@ -0,0 +1,212 @@
+import asyncio
+import hashlib
+import io
+import os
+import uuid
+
+import httpx
+
+from metrics import record_error
+from singleflight import SingleFlight
+from tagging import image_mime
+
+try:
+    from PIL import Image
+    PIL_AVAILABLE = True
+except ImportError:
+    # Without Pillow covers are kept as served (usually a 640px JPEG)
+    PIL_AVAILABLE = False
+
+# Telegram only shows audio thumbnails that are JPEGs under this size
+THUMBNAIL_MAX_BYTES = 200 * 1024
+
+
+def _warn(message):
+    # Covers are fetched alongside link resolution, often from another thread. One line per
+    # message in a single write, so it can't run into the caller's output
+    # (httpx adds a second "For more information" line to status errors)
+    print(str(message).splitlines()[0] + "\n", end="", flush=True)
+
+
+def jpeg_dimensions(data):
+    """
+    Reads a JPEG's width and height from its start-of-frame marker
+
+    Returns:
+        tuple: (width, height), or None if data isn't a JPEG with a readable frame header
+    """
+    if image_mime(data) != "image/jpeg":
+        return None
+    i = 2
+    while i + 9 <= len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:
+            # Fill byte before a marker
+            i += 1
+            continue
+        if 0xD0 <= marker <= 0xD9 or marker == 0x01:
+            # Markers without a length
+            i += 2
+            continue
+        # SOF0-SOF15, except DHT (C4), JPG (C8) and DAC (CC) which share the range
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height = (data[i + 5] << 8) | data[i + 6]
+            width = (data[i + 7] << 8) | data[i + 8]
+            return width, height
+        i += 2 + ((data[i + 2] << 8) | data[i + 3])
+    return None
+
+
+class CoverCache:
+    """
+    Cover art fetched once per URL, resized, and kept on disk
+
+    Every track of an album shares one cover URL, so each image is
+    downloaded once and then read from disk. Concurrent requests for the
+    same cover share one fetch. Each download is stored in two variants:
+    "cover" (for tags and info cards) and "thumb", a small JPEG that
+    meets Telegram's audio thumbnail limits.
+
+    Without Pillow nothing can be resized: "cover" is the image as served,
+    and "thumb" is that same image only if it already meets the thumbnail
+    limits (None otherwise).
+    """
+
+    def __init__(self, root, client, size=600, thumbnail_size=320, quality=90, timeout=10):
+        """
+        Args:
+            root (str): Directory the images are kept in
+            client (PooledClient): HTTP client to fetch covers with
+            size (int): Longest side of the "cover" variant in pixels
+            thumbnail_size (int): Longest side of the "thumb" variant in pixels
+            quality (int): JPEG quality of resized images
+            timeout (float): Seconds a cover fetch may take
+        """
+        self.root = root
+        self.client = client
+        self.sizes = {"cover": size, "thumb": thumbnail_size}
+        self.quality = quality
+        self.timeout = timeout
+        self._flights = SingleFlight()
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, url, variant):
+        digest = hashlib.sha256(url.encode()).hexdigest()
+        return os.path.join(self.root, digest[:2], f"{digest}-{self.sizes[variant]}")
+
+    def _read(self, path):
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        # Files from before covers were checked may hold error pages; fetch those again
+        return data if image_mime(data) else None
+
+    def _as_thumbnail(self, data):
+        # Without Pillow the original can stand in for a thumbnail only if Telegram would take it as is
+        if data is None or len(data) > THUMBNAIL_MAX_BYTES:
+            return None
+        dimensions = jpeg_dimensions(data)
+        if dimensions is None or max(dimensions) > self.sizes["thumb"]:
+            return None
+        return data
+
+    def resize(self, data, size):
+        """
+        Scales an image down to fit size x size and re-encodes it as JPEG
+
+        Returns:
+            bytes: The JPEG, or data unchanged when Pillow isn't installed
+        """
+        if not PIL_AVAILABLE:
+            return data
+        with Image.open(io.BytesIO(data)) as image:
+            image = image.convert("RGB")
+            image.thumbnail((size, size))
+            output = io.BytesIO()
+            image.save(output, "JPEG", quality=self.quality, optimize=True)
+        return output.getvalue()
+
+    def _store(self, url, data, variant):
+        # Writes every variant of a freshly fetched image and returns the one asked for
+        if image_mime(data) is None:
+            # A 200 answer can still be an error or consent page; never cache or embed it
+            _warn(f"Cover {url} is not a JPEG or PNG image")
+            record_error("cover", "not_image")
+            return None
+        images = {}
+        for name, size in self.sizes.items():
+            if name == "thumb" and not PIL_AVAILABLE:
+                continue
+            try:
+                images[name] = self.resize(data, size)
+            except (OSError, ValueError) as e:
+                # Not an image Pillow can read (e.g. an error page); don't use it
+                _warn(f"Could not resize cover {url}: {e}")
+                record_error("cover", e)
+                return None
+            path = self._path(url, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{uuid.uuid4().hex}.part"
+            with open(tmp_path, "wb") as f:
+                f.write(images[name])
+            os.replace(tmp_path, path)
+        return images[variant]
+
+    def get(self, url, variant="cover"):
+        """
+        Returns a cover, fetching and resizing it on first use
+
+        Args:
+            url (str): The cover's URL
+            variant (str): "cover" or "thumb"
+
+        Returns:
+            bytes: The image, or None if it couldn't be fetched (or, for
+                "thumb", made small enough without Pillow)
+        """
+        if not url:
+            return None
+        if variant == "thumb" and not PIL_AVAILABLE:
+            return self._as_thumbnail(self.get(url))
+        cached = self._read(self._path(url, variant))
+        if cached is not None:
+            return cached
+        return self._flights.call((url, variant), lambda: self._fetch(url, variant))
+
+    def _fetch(self, url, variant):
+        try:
+            response = self.client.request("GET", url, timeout=self.timeout)
+            response.raise_for_status()
+        except httpx.HTTPError as e:
+            _warn(f"Could not fetch cover {url}: {e}")
+            record_error("cover", e)
+            return None
+        return self._store(url, response.content, variant)
+
+    async def aget(self, url, variant="cover"):
+        """
+        Async version of get
+        """
+        if not url:
+            return None
+        if variant == "thumb" and not PIL_AVAILABLE:
+            return self._as_thumbnail(await self.aget(url))
+        cached = await asyncio.to_thread(self._read, self._path(url, variant))
+        if cached is not None:
+            return cached
+        return await self._flights.acall((url, variant), lambda: self._afetch(url, variant))
+
+    async def _afetch(self, url, variant):
+        try:
+            response = await self.client.arequest("GET", url, timeout=self.timeout)
+            response.raise_for_status()
+        except httpx.HTTPError as e:
+            _warn(f"Could not fetch cover {url}: {e}")
+            record_error("cover", e)
+            return None
+        # Resizing is CPU work; keep it off the event loop
+        return await asyncio.to_thread(self._store, url, response.content, variant)
@@ -0,0 +1,189 @@
+import json
+import zlib
+
+import brotli
+import zstandard as zstd
+
+# Advertised to the API; every encoding listed here can be undone by ResponseDecoder
+ACCEPT_ENCODING = "br, zstd, gzip, deflate"
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+# Errors a corrupt or mislabelled body can raise while decoding
+DECODE_ERRORS = (ValueError, zlib.error, brotli.error, zstd.ZstdError)
+
+
+class _Identity:
+    def decompress(self, data):
+        return data
+
+    def flush(self):
+        return b""
+
+
+class _Zlib:
+    def __init__(self, wbits):
+        self.wbits = wbits
+        self._decompressor = None
+
+    def decompress(self, data):
+        if self._decompressor is None:
+            if not data:
+                return b""
+            wbits = self.wbits
+            # "deflate" is meant to be zlib-wrapped, but some servers send raw deflate
+            if wbits == zlib.MAX_WBITS and not _looks_like_zlib(data):
+                wbits = -zlib.MAX_WBITS
+            self._decompressor = zlib.decompressobj(wbits)
+        return self._decompressor.decompress(data)
+
+    def flush(self):
+        return self._decompressor.flush() if self._decompressor else b""
+
+
+class _Brotli:
+    def __init__(self):
+        self._decompressor = brotli.Decompressor()
+
+    def decompress(self, data):
+        return self._decompressor.process(data)
+
+    def flush(self):
+        return b""
+
+
+class _Zstd:
+    def __init__(self):
+        self._decompressor = zstd.ZstdDecompressor().decompressobj()
+
+    def decompress(self, data):
+        return self._decompressor.decompress(data)
+
+    def flush(self):
+        return b""
+
+
+DECODERS = {
+    "identity": _Identity,
+    "gzip": lambda: _Zlib(zlib.MAX_WBITS | 16),
+    "x-gzip": lambda: _Zlib(zlib.MAX_WBITS | 16),
+    "deflate": lambda: _Zlib(zlib.MAX_WBITS),
+    "br": _Brotli,
+    "zstd": _Zstd
+}
+
+
+def _looks_like_zlib(data):
+    return len(data) >= 2 and data[0] & 0x0F == 8 and ((data[0] << 8) | data[1]) % 31 == 0
+
+
+def _sniff(head):
+    # Only formats with a signature can be recognised; brotli has none
+    if head.startswith(GZIP_MAGIC):
+        return "gzip"
+    if head.startswith(ZSTD_MAGIC):
+        return "zstd"
+    return "identity"
+
+
+class ResponseDecoder:
+    """
+    Undoes a response's content codings in one streaming pass
+
+    The codings come from the Content-Encoding header, checked against the
+    body's first bytes: a body that's already plain JSON (a proxy decoded it
+    but kept the header) passes through untouched, and a compressed body sent
+    without a header is recognised by its gzip or zstd magic bytes.
+    """
+
+    def __init__(self, content_encoding=None):
+        """
+        Args:
+            content_encoding (str): The Content-Encoding header, if any
+        """
+        self.encodings = [
+            value.strip().lower()
+            for value in (content_encoding or "").split(",")
+            if value.strip() and value.strip().lower() != "identity"
+        ]
+        self._decoders = None
+
+    def _start(self, head):
+        encodings = self.encodings
+        if head.lstrip()[:1] in (b"{", b"["):
+            encodings = []
+        elif not encodings:
+            encodings = [_sniff(head)]
+        # Codings are listed in the order they were applied, so undo them last to first
+        self._decoders = [DECODERS.get(encoding, _Identity)() for encoding in reversed(encodings)]
+
+    def decompress(self, chunk):
+        """
+        Decodes the next chunk of the raw body
+
+        Returns:
+            bytes: The decoded data available so far
+        """
+        if not chunk:
+            return b""
+        if self._decoders is None:
+            self._start(chunk)
+        for decoder in self._decoders:
+            if not chunk:
+                break
+            chunk = decoder.decompress(chunk)
+        return chunk
+
+    def flush(self):
+        """
+        Returns any decoded data still buffered at the end of the body
+        """
+        data = b""
+        for decoder in self._decoders or ():
+            # A finished zstd frame refuses further input, even an empty chunk
+            if data:
+                data = decoder.decompress(data)
+            data += decoder.flush()
+        return data
+
+
+def decode_json(content_encoding, chunks):
+    """
+    Decompresses raw body chunks and parses the JSON they hold
+
+    Args:
+        content_encoding (str): The response's Content-Encoding header
+        chunks (iterable): Raw (still encoded) body chunks
+
+    Returns:
+        dict: Parsed JSON or None if the body can't be decoded
+    """
+    decoder = ResponseDecoder(content_encoding)
+    try:
+        body = b"".join(decoder.decompress(chunk) for chunk in chunks) + decoder.flush()
+        return json.loads(body)
+    except DECODE_ERRORS:
+        return None
+
+
+def read_json(response):
+    """
+    Reads and parses the JSON body of a streamed httpx response
+    """
+    return decode_json(response.headers.get("content-encoding"), response.iter_raw())
+
+
+async def aread_json(response):
+    """
+    Reads and parses the JSON body of a streamed httpx response without blocking the event loop
+    """
+    decoder = ResponseDecoder(response.headers.get("content-encoding"))
+    parts = []
+    try:
+        async for chunk in response.aiter_raw():
+            parts.append(decoder.decompress(chunk))
+        parts.append(decoder.flush())
+        return json.loads(b"".join(parts))
+    except DECODE_ERRORS:
+        return None
@@ -0,0 +1,177 @@
+"""
+Fake Telegram for testing the bot's webhook mode locally.
+
+Acts as both sides of Telegram: a minimal Bot API server the bot talks to, and
+a sender that posts N updates to the bot's webhook at once. Reports how long
+each chat waited for the bot's first reply.
+
+Usage (start the fake first; it waits for the bot's webhook to come up):
+    # terminal 1
+    python fake_telegram.py --webhook http://127.0.0.1:8443/telegram --secret s3cret --updates 200
+
+    # terminal 2
+    BOT_MODE=webhook WEBHOOK_LISTEN=127.0.0.1 WEBHOOK_PORT=8443 WEBHOOK_SECRET=s3cret \\
+    WEBHOOK_URL=http://127.0.0.1:8443 TELEGRAM_API_BASE_URL=http://127.0.0.1:8081/bot \\
+    python spotify_bot.py
+"""
+import argparse
+import json
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import httpx
+
+# chat_id -> time the bot first called the API for that chat
+first_replies = {}
+replies_lock = threading.Lock()
+message_ids = iter(range(1, 10 ** 9))
+
+
+def request_fields(content_type, body):
+    """
+    Extracts form fields from a Bot API request (urlencoded or multipart)
+    """
+    if content_type.startswith("application/x-www-form-urlencoded"):
+        return {key: values[0] for key, values in parse_qs(body.decode("utf-8")).items()}
+    if content_type.startswith("application/json"):
+        return json.loads(body or b"{}")
+    # multipart: only the small text fields matter here
+    fields = {}
+    for name, value in re.findall(rb'name="([^"]+)"\r\n\r\n(.*?)\r\n--', body, re.S):
+        if len(value) < 4096:
+            fields[name.decode()] = value.decode("utf-8", errors="ignore")
+    return fields
+
+
+class FakeBotAPI(BaseHTTPRequestHandler):
+    """
+    Answers the Bot API methods the bot uses with plausible results
+    """
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        fields = request_fields(self.headers.get("Content-Type", ""), self.rfile.read(length))
+        method = self.path.rsplit("/", 1)[-1]
+
+        chat_id = fields.get("chat_id")
+        if chat_id is not None:
+            with replies_lock:
+                first_replies.setdefault(int(chat_id), time.perf_counter())
+
+        message = {
+            "message_id": next(message_ids),
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id or 0), "type": "private"},
+            "text": fields.get("text", "")
+        }
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}
+        elif method in ("setWebhook", "deleteWebhook", "answerCallbackQuery", "deleteMessage"):
+            result = True
+        elif method == "sendAudio":
+            file_id = uuid.uuid4().hex
+            result = dict(message, audio={"file_id": file_id, "file_unique_id": file_id, "duration": 0})
+        elif method == "sendPhoto":
+            file_id = uuid.uuid4().hex
+            result = dict(message, photo=[{"file_id": file_id, "file_unique_id": file_id, "width": 320, "height": 320}])
+        else:
+            result = message
+
+        body = json.dumps({"ok": True, "result": result}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeBotAPIServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+def make_update(update_id, chat_id, text):
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "private"},
+        "from": {"id": chat_id, "is_bot": False, "first_name": "Load"},
+        "text": text
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": update_id, "message": message}
+
+
+def send_update(client, webhook, secret, update):
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret else {}
+    sent_at = time.perf_counter()
+    response = client.post(webhook, json=update, headers=headers)
+    return update["message"]["chat"]["id"], sent_at, response.status_code, time.perf_counter() - sent_at
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered))) - 1))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Drive the bot's webhook with fake Telegram updates")
+    parser.add_argument("--webhook", required=True, help="the bot's webhook URL, e.g. http://127.0.0.1:8443/telegram")
+    parser.add_argument("--secret", default=None, help="WEBHOOK_SECRET the bot was started with")
+    parser.add_argument("--updates", type=int, default=50, help="number of updates (one chat each) to send at once")
+    parser.add_argument("--text", default="/start", help="message text to send")
+    parser.add_argument("--api-port", type=int, default=8081, help="port for the fake Bot API server")
+    parser.add_argument("--wait", type=float, default=30, help="seconds to wait for replies")
+    args = parser.parse_args()
+
+    server = FakeBotAPIServer(("127.0.0.1", args.api_port), FakeBotAPI)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Fake Bot API listening on http://127.0.0.1:{args.api_port}/bot")
+
+    updates = [make_update(1000 + i, 5000 + i, args.text) for i in range(args.updates)]
+    with httpx.Client(timeout=30) as client, ThreadPoolExecutor(max_workers=min(64, args.updates)) as pool:
+        print(f"Waiting for the bot's webhook at {args.webhook}...")
+        while True:
+            try:
+                client.get(args.webhook)
+                break
+            except httpx.TransportError:
+                time.sleep(0.2)
+
+        results = list(pool.map(lambda update: send_update(client, args.webhook, args.secret, update), updates))
+
+    rejected = [status for _, _, status, _ in results if status != 200]
+    if rejected:
+        print(f"{len(rejected)} updates rejected by the webhook (HTTP {sorted(set(rejected))}) - check --secret")
+
+    deadline = time.time() + args.wait
+    while time.time() < deadline:
+        with replies_lock:
+            if len(first_replies) >= args.updates - len(rejected):
+                break
+        time.sleep(0.05)
+    server.shutdown()
+
+    accept_times = [elapsed for _, _, status, elapsed in results if status == 200]
+    reply_times = [first_replies[chat_id] - sent_at for chat_id, sent_at, status, _ in results if chat_id in first_replies]
+    print(f"Accepted: {len(accept_times)}/{args.updates}, answered: {len(reply_times)}")
+    for label, values in (("webhook ack", accept_times), ("first reply", reply_times)):
+        if values:
+            print(
+                f"{label:>12}: p50={percentile(values, 50) * 1000:.1f}ms "
+                f"p95={percentile(values, 95) * 1000:.1f}ms max={max(values) * 1000:.1f}ms"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+import asyncio
+import contextlib
+import socket
+import threading
+from urllib.parse import urlsplit
+
+import httpx
+
+try:
+    import h2  # noqa: F401  (enables HTTP/2 in httpx when installed)
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+
+class PooledClient:
+    """
+    One keep-alive HTTP client shared by every spotydown call
+
+    Wraps an httpx.Client (for the CLI / threads) and an httpx.AsyncClient (for the
+    bot's event loop) that keep connections open between requests, negotiate HTTP/2
+    when the server supports it, and never open more than max_connections_per_host
+    concurrent requests to the same host.
+    """
+
+    def __init__(self, max_connections_per_host=10, max_connections=100, keepalive_expiry=30.0, timeout=15):
+        self.max_connections_per_host = max_connections_per_host
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+            keepalive_expiry=keepalive_expiry
+        )
+        self.timeout = timeout
+
+        self._lock = threading.Lock()
+        self._client = None
+        self._async_client = None
+        self._async_loop = None
+        self._host_slots = {}
+        self._async_host_slots = {}
+
+        # Counters fed by httpcore trace events
+        self._connections_opened = 0
+        self._requests_sent = 0
+
+    @property
+    def client(self):
+        """
+        The shared synchronous httpx.Client, created on first use
+        """
+        with self._lock:
+            if self._client is None:
+                self._client = httpx.Client(
+                    http2=HTTP2_AVAILABLE,
+                    limits=self.limits,
+                    timeout=self.timeout,
+                    follow_redirects=True
+                )
+            return self._client
+
+    @property
+    def async_client(self):
+        """
+        The shared httpx.AsyncClient for the running event loop, created on first use
+        """
+        loop = asyncio.get_running_loop()
+        if self._async_client is None or self._async_loop is not loop:
+            # Connections belong to the loop that opened them, so a new loop gets a new pool
+            if self._async_client is not None:
+                self._release_async_client(self._async_client, self._async_loop)
+            self._async_client = httpx.AsyncClient(
+                http2=HTTP2_AVAILABLE,
+                limits=self.limits,
+                timeout=self.timeout,
+                follow_redirects=True
+            )
+            self._async_loop = loop
+            self._async_host_slots = {}
+        return self._async_client
+
+    def _host_slot(self, url):
+        host = urlsplit(str(url)).netloc
+        with self._lock:
+            if host not in self._host_slots:
+                self._host_slots[host] = threading.BoundedSemaphore(self.max_connections_per_host)
+            return self._host_slots[host]
+
+    def _async_host_slot(self, url):
+        host = urlsplit(str(url)).netloc
+        if host not in self._async_host_slots:
+            self._async_host_slots[host] = asyncio.Semaphore(self.max_connections_per_host)
+        return self._async_host_slots[host]
+
+    def _record(self, event_name):
+        if event_name == "connection.connect_tcp.complete":
+            with self._lock:
+                self._connections_opened += 1
+        elif event_name.endswith("send_request_headers.started"):
+            with self._lock:
+                self._requests_sent += 1
+
+    def _trace(self, event_name, info):
+        self._record(event_name)
+
+    async def _async_trace(self, event_name, info):
+        self._record(event_name)
+
+    def _with_trace(self, kwargs, trace):
+        extensions = dict(kwargs.pop("extensions", None) or {})
+        extensions["trace"] = trace
+        kwargs["extensions"] = extensions
+        return kwargs
+
+    def request(self, method, url, **kwargs):
+        """
+        Sends a request over the shared pool and returns the httpx.Response
+        """
+        with self._host_slot(url):
+            return self.client.request(method, url, **self._with_trace(kwargs, self._trace))
+
+    def head(self, url, **kwargs):
+        return self.request("HEAD", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    @contextlib.contextmanager
+    def stream(self, method, url, **kwargs):
+        """
+        Streams a response body; the per-host slot is held until the body is consumed
+        """
+        with self._host_slot(url):
+            with self.client.stream(method, url, **self._with_trace(kwargs, self._trace)) as response:
+                yield response
+
+    async def arequest(self, method, url, **kwargs):
+        """
+        Async version of request()
+        """
+        client = self.async_client
+        async with self._async_host_slot(url):
+            return await client.request(method, url, **self._with_trace(kwargs, self._async_trace))
+
+    async def ahead(self, url, **kwargs):
+        return await self.arequest("HEAD", url, **kwargs)
+
+    async def apost(self, url, **kwargs):
+        return await self.arequest("POST", url, **kwargs)
+
+    @contextlib.asynccontextmanager
+    async def astream(self, method, url, **kwargs):
+        """
+        Async version of stream()
+        """
+        client = self.async_client
+        async with self._async_host_slot(url):
+            async with client.stream(method, url, **self._with_trace(kwargs, self._async_trace)) as response:
+                yield response
+
+    def _release_async_client(self, client, loop):
+        # Closes an AsyncClient left behind by another event loop
+        if loop.is_running():
+            # Still serving another thread; let its loop close the connections
+            asyncio.run_coroutine_threadsafe(client.aclose(), loop)
+            return
+        # The loop has ended (e.g. an earlier asyncio.run), so aclose() can't run there; shut the sockets down
+        # directly (their file descriptors go with the dropped transports)
+        for connection in self._pool_connections(client):
+            stream = getattr(getattr(connection, "_connection", None), "_network_stream", None)
+            sock = stream.get_extra_info("socket") if stream is not None else None
+            if sock is not None:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    @staticmethod
+    def _pool_connections(client):
+        # httpx doesn't expose its connection pool publicly; read it defensively
+        pool = getattr(getattr(client, "_transport", None), "_pool", None)
+        return list(getattr(pool, "connections", []) or [])
+
+    def stats(self):
+        """
+        Returns connection pool statistics
+
+        Returns:
+            dict: open, idle and reused connection counts plus totals
+        """
+        connections = []
+        for client in (self._client, self._async_client):
+            if client is not None:
+                connections.extend(self._pool_connections(client))
+
+        open_connections = [c for c in connections if not c.is_closed()]
+        idle_connections = [c for c in open_connections if c.is_idle()]
+        with self._lock:
+            requests_sent = self._requests_sent
+            connections_opened = self._connections_opened
+
+        return {
+            "open": len(open_connections),
+            "idle": len(idle_connections),
+            "active": len(open_connections) - len(idle_connections),
+            "connections_opened": connections_opened,
+            "requests": requests_sent,
+            "reused": max(0, requests_sent - connections_opened),
+            "http2": HTTP2_AVAILABLE
+        }
+
+    def close(self):
+        with self._lock:
+            if self._client is not None:
+                self._client.close()
+                self._client = None
+        # An AsyncClient whose loop has ended wasn't closed by aclose()
+        if self._async_client is not None and not self._async_loop.is_running():
+            self._release_async_client(self._async_client, self._async_loop)
+            self._async_client = None
+            self._async_loop = None
+
+    async def aclose(self):
+        if self._async_client is not None:
+            await self._async_client.aclose()
+            self._async_client = None
+            self._async_loop = None
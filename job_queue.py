@@ -0,0 +1,178 @@
+import asyncio
+import contextvars
+import time
+from collections import deque
+
+
+class QueueFullError(Exception):
+    """
+    Raised when a job is submitted while the queue is at capacity
+    """
+
+
+class _Job:
+    def __init__(self, user_id, job_factory, future):
+        self.user_id = user_id
+        self.job_factory = job_factory
+        self.future = future
+        self.enqueued_at = time.monotonic()
+        # The submitter's context (trace, deadline), which the job runs in
+        self.context = contextvars.copy_context()
+
+
+class FairJobQueue:
+    """
+    Bounded job queue shared by all chats, served by a fixed pool of workers
+
+    Users are scheduled round-robin and each user has at most per_user_limit jobs
+    running at once, so one heavy user can't starve everybody else. Submitting
+    beyond max_queued pending jobs raises QueueFullError.
+    """
+
+    def __init__(self, workers=8, per_user_limit=2, max_queued=200):
+        """
+        Args:
+            workers (int): Jobs run at the same time across all users
+            per_user_limit (int): Jobs run at the same time for one user
+            max_queued (int): Pending jobs accepted before submissions are refused
+        """
+        self.workers = workers
+        self.per_user_limit = per_user_limit
+        self.max_queued = max_queued
+
+        self._pending = {}        # user_id -> deque of jobs waiting to run
+        self._running = {}        # user_id -> jobs currently running
+        self._rotation = deque()  # users with pending jobs, in round-robin order
+        self._depth = 0
+        self._wakeup = None
+        self._worker_tasks = []
+
+        self._wait_times = deque(maxlen=1000)
+        self._completed = 0
+        self._failed = 0
+        self._rejected = 0
+
+    def _ensure_workers(self):
+        if self._worker_tasks:
+            return
+        self._wakeup = asyncio.Event()
+        self._worker_tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    def submit(self, user_id, job_factory):
+        """
+        Queues a job for a user
+
+        Args:
+            user_id: Identifies the user the job belongs to
+            job_factory (callable): Returns the coroutine to run once the job is scheduled
+
+        Returns:
+            tuple: (future, position) - the future resolves to the job's result;
+                position is how many jobs are waiting ahead of it (0 = starts now)
+
+        Raises:
+            QueueFullError: If max_queued jobs are already waiting
+        """
+        self._ensure_workers()
+        if self._depth >= self.max_queued:
+            self._rejected += 1
+            raise QueueFullError(f"{self._depth} jobs already queued")
+
+        # Round-robin means each other user gets at most one turn per job of ours already queued
+        own = len(self._pending.get(user_id, ()))
+        position = own + sum(min(len(jobs), own + 1) for other, jobs in self._pending.items() if other != user_id)
+        if position == 0 and (self._active_count() >= self.workers or self._running.get(user_id, 0) >= self.per_user_limit):
+            position = 1
+
+        job = _Job(user_id, job_factory, asyncio.get_running_loop().create_future())
+        if user_id not in self._pending:
+            self._pending[user_id] = deque()
+        if not self._pending[user_id]:
+            self._rotation.append(user_id)
+        self._pending[user_id].append(job)
+        self._depth += 1
+
+        self._wakeup.set()
+        return job.future, position
+
+    def _active_count(self):
+        return sum(self._running.values())
+
+    def _next_job(self):
+        # Walk the rotation once, taking the first user that's under their limit
+        for _ in range(len(self._rotation)):
+            user_id = self._rotation[0]
+            self._rotation.rotate(-1)
+            if self._running.get(user_id, 0) >= self.per_user_limit:
+                continue
+
+            job = self._pending[user_id].popleft()
+            if not self._pending[user_id]:
+                self._rotation.remove(user_id)
+                del self._pending[user_id]
+            self._depth -= 1
+            self._running[user_id] = self._running.get(user_id, 0) + 1
+            return job
+        return None
+
+    async def _worker(self):
+        while True:
+            # No await between checking and clearing, so a wakeup can't be missed
+            job = self._next_job()
+            if job is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            self._wait_times.append(time.monotonic() - job.enqueued_at)
+            try:
+                if not job.future.cancelled():
+                    # Worker tasks outlive any one request, so the job gets its own task in the submitter's context
+                    result = await job.context.run(lambda: asyncio.ensure_future(job.job_factory()))
+                    if not job.future.done():
+                        job.future.set_result(result)
+                self._completed += 1
+            except Exception as e:
+                self._failed += 1
+                if not job.future.done():
+                    job.future.set_exception(e)
+            finally:
+                self._running[job.user_id] -= 1
+                if not self._running[job.user_id]:
+                    del self._running[job.user_id]
+                self._wakeup.set()
+
+    def stats(self):
+        """
+        Returns queue depth, activity and wait time statistics
+
+        Returns:
+            dict: Counters and wait time percentiles (seconds) over the last 1000 jobs
+        """
+        waits = sorted(self._wait_times)
+
+        def percentile(pct):
+            if not waits:
+                return 0.0
+            return waits[min(len(waits) - 1, int(len(waits) * pct / 100))]
+
+        return {
+            "queued": self._depth,
+            "running": self._active_count(),
+            "waiting_users": len(self._pending),
+            "completed": self._completed,
+            "failed": self._failed,
+            "rejected": self._rejected,
+            "wait_p50": percentile(50),
+            "wait_p95": percentile(95),
+            "wait_max": waits[-1] if waits else 0.0
+        }
+
+    async def stop(self):
+        """
+        Cancels the workers; pending jobs are dropped
+        """
+        for task in self._worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        self._worker_tasks = []
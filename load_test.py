@@ -0,0 +1,243 @@
+"""
+Load test for the bot's download handlers.
+
+Starts a local stub of the spotydown API and file host, then simulates N users
+concurrently sending a track URL and tapping "Download Track". Reports handler
+latency percentiles so we can confirm that one slow request doesn't stall the others.
+
+Usage:
+    python load_test.py --users 200 --api-delay 1.0 --file-delay 2.0
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Keep the persistent caches out of the way; every run starts cold
+os.environ.setdefault("METADATA_CACHE_DB", "")
+os.environ.setdefault("BOT_CACHE_DB", "")
+os.environ.setdefault("AUDIO_STORE_DIR", "")
+os.environ.setdefault("COVER_CACHE_DIR", "")
+
+import metrics
+import spotify_downloader
+import spotify_bot
+
+FILE_SIZE = 256 * 1024  # bytes served for every fake track
+COLLECTION_SIZE = 12  # tracks in every fake album/playlist
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Fakes the spotydown endpoints used by spotify_downloader
+    """
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real API
+    api_delay = 0.0
+    file_delay = 0.0
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        track_url = request.get("url", "")
+        track_id = track_url.rstrip("/").split("/")[-1]
+        time.sleep(self.api_delay)
+
+        if self.path == "/api/get-metadata" and ("/album/" in track_url or "/playlist/" in track_url):
+            self._send_json({"apiResponse": {"data": [{
+                "name": f"Track {track_id}-{n}",
+                "artist": "Load Test",
+                "album_name": "Stub Album",
+                "album_artist": "Load Test",
+                "cover_url": f"http://{self.headers['Host']}/cover/{track_id}.jpg",
+                "url": f"https://open.spotify.com/track/{track_id}x{n}",
+            } for n in range(COLLECTION_SIZE)]}})
+        elif self.path == "/api/get-metadata":
+            self._send_json({"apiResponse": {"data": [{
+                "name": f"Track {track_id}",
+                "artist": "Load Test",
+                "album_name": "Stub Album",
+                "album_artist": "Load Test",
+                "cover_url": f"http://{self.headers['Host']}/cover/{track_id}.jpg",
+                "url": track_url,
+            }]}})
+        elif self.path == "/api/download-track":
+            self._send_json({"file_url": f"http://{self.headers['Host']}/files/{track_id}.mp3"})
+        else:
+            self.send_error(404)
+
+    def _send_file_headers(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "audio/mpeg")
+        self.send_header("Content-Length", str(FILE_SIZE))
+        self.end_headers()
+
+    def do_HEAD(self):
+        self._send_file_headers()
+
+    def do_GET(self):
+        time.sleep(self.file_delay)
+        self._send_file_headers()
+        self.wfile.write(b"\0" * FILE_SIZE)
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024  # don't refuse connections during the burst
+
+
+class FakeMessage:
+    """
+    Minimal stand-in for telegram.Message recording what the bot sends
+    """
+    audio = None
+    photo = ()
+
+    async def reply_text(self, text, **kwargs):
+        return FakeMessage()
+
+    async def reply_photo(self, photo=None, **kwargs):
+        sent = FakeMessage()
+        sent.photo = (FakeAudio(uuid.uuid4().hex),)
+        return sent
+
+    async def reply_audio(self, audio=None, **kwargs):
+        sent = FakeMessage()
+        if hasattr(audio, "read"):
+            audio.read()
+            # Like Telegram, hand back a reusable file_id for uploaded files
+            sent.audio = FakeAudio(uuid.uuid4().hex)
+        return sent
+
+    async def edit_text(self, text, **kwargs):
+        return self
+
+    async def delete(self):
+        return True
+
+
+class FakeAudio:
+    # Stands in for telegram.Audio and telegram.PhotoSize; the bot only reads file_id
+    def __init__(self, file_id):
+        self.file_id = file_id
+
+
+class FakeCallbackQuery:
+    def __init__(self, data):
+        self.data = data
+        self.message = FakeMessage()
+
+    async def answer(self):
+        return True
+
+
+class FakeUser:
+    def __init__(self, user_id):
+        self.id = user_id
+
+
+class FakeUpdate:
+    def __init__(self, message=None, callback_query=None, user_id=0):
+        self.message = message
+        self.callback_query = callback_query
+        self.effective_user = FakeUser(user_id)
+
+
+def percentile(values, pct):
+    """
+    Returns the pct-th percentile of values using nearest-rank
+    """
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+async def simulate_user(user_id, track_id, latencies):
+    track_url = f"https://open.spotify.com/track/{track_id}"
+
+    start = time.perf_counter()
+    await spotify_bot.process_spotify_url(FakeUpdate(message=FakeMessage(), user_id=user_id), track_url)
+    latencies["info"].append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    update = FakeUpdate(callback_query=FakeCallbackQuery(f"get_link_{track_id}"), user_id=user_id)
+    await spotify_bot.button_callback(update, None)
+    latencies["download"].append(time.perf_counter() - start)
+
+
+async def run_load(users, distinct_tracks):
+    latencies = {"info": [], "download": []}
+    tasks = [simulate_user(i, f"loadtest{i % distinct_tracks:05d}", latencies) for i in range(users)]
+    start = time.perf_counter()
+    await asyncio.gather(*tasks)
+    return latencies, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate concurrent bot users against a local stub server")
+    parser.add_argument("--users", type=int, default=100, help="number of concurrent simulated users")
+    parser.add_argument("--tracks", type=int, default=0, help="distinct tracks requested (default: one per user)")
+    parser.add_argument("--api-delay", type=float, default=0.5, help="seconds the stub API waits before answering")
+    parser.add_argument("--file-delay", type=float, default=1.0, help="seconds the stub file host waits before sending")
+    parser.add_argument("--verbose", action="store_true", help="show the downloader's own output")
+    parser.add_argument("--metrics", action="store_true", help="print the /metrics exposition at the end")
+    args = parser.parse_args()
+
+    StubHandler.api_delay = args.api_delay
+    StubHandler.file_delay = args.file_delay
+    server = StubServer(("127.0.0.1", 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    spotify_downloader.SPOTYDOWN_BASE_URL = f"http://127.0.0.1:{server.server_address[1]}"
+
+    distinct_tracks = args.tracks or args.users
+    print(f"Simulating {args.users} users ({distinct_tracks} distinct tracks) against {spotify_downloader.SPOTYDOWN_BASE_URL}")
+
+    # Run in a scratch directory so downloaded files don't pile up in the repo
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as scratch:
+        os.chdir(scratch)
+        try:
+            output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+            with output:
+                latencies, wall_time = asyncio.run(run_load(args.users, distinct_tracks))
+        finally:
+            os.chdir(cwd)
+    server.shutdown()
+
+    serial_estimate = args.users * (3 * args.api_delay + args.file_delay)
+    print(f"Wall time: {wall_time:.2f}s (serial handling would take ~{serial_estimate:.0f}s)")
+    for stage, values in latencies.items():
+        print(
+            f"{stage:>8}: n={len(values)} "
+            f"p50={percentile(values, 50):.3f}s p90={percentile(values, 90):.3f}s "
+            f"p95={percentile(values, 95):.3f}s p99={percentile(values, 99):.3f}s max={max(values):.3f}s"
+        )
+    print(f"Connection pool: {spotify_downloader.http_client.stats()}")
+    print(f"Metadata cache: {spotify_downloader.metadata_cache.stats()}")
+    print(f"Resolvers: {spotify_downloader.resolver_router.stats()}")
+    print(f"Rate limiter: {spotify_downloader.rate_limiter.stats()}")
+    print(f"File ID cache: {spotify_bot.file_id_cache.stats()}")
+    print(f"Download queue: {spotify_bot.download_queue.stats()}")
+    if args.metrics:
+        print(metrics.REGISTRY.render())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,307 @@
+import contextlib
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Port for the /metrics endpoint (0 = don't serve metrics)
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 0))
+METRICS_ADDR = os.environ.get("METRICS_ADDR", "127.0.0.1")
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+THROUGHPUT_BUCKETS = tuple(kb * 1024 for kb in (64, 256, 512, 1024, 2048, 5120, 10240, 25600, 51200, 102400))
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+        self._functions = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple((name, labels[name]) for name in self.labelnames)
+
+    def set_function(self, fn, **labels):
+        """
+        Reads the value from fn() whenever metrics are collected, e.g. from an existing stats() dict
+        """
+        with self._lock:
+            self._functions[self._key(labels)] = fn
+
+    def samples(self):
+        with self._lock:
+            samples = [(self.name, key, value) for key, value in self._values.items()]
+            functions = list(self._functions.items())
+        for key, fn in functions:
+            try:
+                samples.append((self.name, key, fn()))
+            except Exception:
+                # A broken callback shouldn't take the whole endpoint down
+                continue
+        return samples
+
+
+class Counter(_Metric):
+    """
+    A value that only goes up (requests, bytes, errors)
+    """
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """
+    A value that goes up and down (in-flight jobs, hit ratios)
+    """
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    """
+    Counts observations (latencies, throughput) into cumulative buckets
+    """
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """
+        Observes how long the block takes (also around awaits)
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            items = list(self._values.items())
+        for key, (counts, total) in items:
+            for bound, count in zip(self.buckets, counts):
+                samples.append((f"{self.name}_bucket", key + (("le", _format_value(bound)),), count))
+            samples.append((f"{self.name}_sum", key, total))
+            samples.append((f"{self.name}_count", key, counts[-1]))
+        return samples
+
+
+class Registry:
+    """
+    Holds every metric and renders them in the Prometheus text format
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def _register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help_text, labelnames=()):
+        return self._register(Counter(name, help_text, labelnames))
+
+    def gauge(self, name, help_text, labelnames=()):
+        return self._register(Gauge(name, help_text, labelnames))
+
+    def histogram(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, help_text, labelnames, buckets))
+
+    def render(self):
+        """
+        Returns:
+            str: All metrics in the Prometheus text exposition format
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# Pipeline metrics shared by the downloader, the bot and the workers
+STAGE_SECONDS = REGISTRY.histogram(
+    "spotify_stage_duration_seconds",
+    "Time spent per pipeline stage (metadata, link, head, transfer, transcode, upload)",
+    ("stage",)
+)
+BYTES_TRANSFERRED = REGISTRY.counter(
+    "spotify_bytes_transferred_total",
+    "Audio bytes downloaded from file hosts"
+)
+THROUGHPUT = REGISTRY.histogram(
+    "spotify_download_throughput_bytes_per_second",
+    "Average speed of each completed download",
+    buckets=THROUGHPUT_BUCKETS
+)
+ERRORS = REGISTRY.counter(
+    "spotify_errors_total",
+    "Failures per pipeline stage and cause",
+    ("stage", "cause")
+)
+CACHE_HIT_RATIO = REGISTRY.gauge(
+    "spotify_cache_hit_ratio",
+    "Share of cache lookups answered from the cache",
+    ("cache",)
+)
+CACHE_LOOKUPS = REGISTRY.counter(
+    "spotify_cache_lookups_total",
+    "Cache lookups by result",
+    ("cache", "result")
+)
+IN_FLIGHT = REGISTRY.gauge(
+    "spotify_in_flight",
+    "Work currently in progress",
+    ("kind",)
+)
+AUDIO_STORE_BYTES = REGISTRY.gauge(
+    "spotify_audio_store_bytes",
+    "Disk used by the audio store, and its budget",
+    ("kind",)
+)
+AUDIO_STORE_EVICTIONS = REGISTRY.counter(
+    "spotify_audio_store_evictions_total",
+    "Files evicted from the audio store to stay within its budget"
+)
+
+
+def record_error(stage, error):
+    """
+    Counts a failure, using the HTTP status or exception type as its cause
+
+    Args:
+        stage (str): Pipeline stage that failed
+        error: The exception, or a short cause string when there's none
+    """
+    if isinstance(error, str):
+        cause = error
+    else:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+        cause = f"http_{status}" if status else type(error).__name__
+    ERRORS.inc(stage=stage, cause=cause)
+
+
+def record_transfer(size, elapsed):
+    """
+    Counts a completed download's bytes and its average speed
+    """
+    BYTES_TRANSFERRED.inc(size)
+    if elapsed > 0:
+        THROUGHPUT.observe(size / elapsed)
+
+
+def watch_cache(name, cache):
+    """
+    Exposes a TieredCache's hit ratio and lookup counts
+    """
+    CACHE_HIT_RATIO.set_function(lambda: cache.stats()["hit_rate"], cache=name)
+    for result, field in (("memory_hit", "memory_hits"), ("disk_hit", "disk_hits"), ("negative_hit", "negative_hits"), ("miss", "misses")):
+        CACHE_LOOKUPS.set_function(lambda field=field: cache.stats()[field], cache=name, result=result)
+
+
+def watch_audio_store(store):
+    """
+    Exposes an AudioStore's hit ratio, lookups, size and evictions
+    """
+    CACHE_HIT_RATIO.set_function(lambda: store.stats()["hit_rate"], cache="audio_store")
+    CACHE_LOOKUPS.set_function(lambda: store.stats()["hits"], cache="audio_store", result="disk_hit")
+    CACHE_LOOKUPS.set_function(lambda: store.stats()["misses"], cache="audio_store", result="miss")
+    AUDIO_STORE_BYTES.set_function(lambda: store.stats()["bytes"], kind="used")
+    if store.max_bytes:
+        AUDIO_STORE_BYTES.set(store.max_bytes, kind="budget")
+    AUDIO_STORE_EVICTIONS.set_function(lambda: store.stats()["evicted"])
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_metrics_server(port=None, addr=None):
+    """
+    Serves /metrics from a background thread
+
+    Args:
+        port (int): Port to listen on (defaults to METRICS_PORT)
+        addr (str): Address to bind (defaults to METRICS_ADDR)
+
+    Returns:
+        ThreadingHTTPServer: The running server
+    """
+    server = ThreadingHTTPServer((addr or METRICS_ADDR, port or METRICS_PORT), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    print(f"Metrics available at http://{server.server_address[0]}:{server.server_address[1]}/metrics")
+    return server
@@ -0,0 +1,145 @@
+import math
+import os
+import sys
+import threading
+import time
+
+# Progress events are emitted at most this often, and only after this many new bytes
+PROGRESS_INTERVAL = float(os.environ.get("PROGRESS_INTERVAL", 0.5))  # seconds
+PROGRESS_MIN_BYTES = int(os.environ.get("PROGRESS_MIN_BYTES", 64 * 1024))
+
+
+class ProgressEvent:
+    """
+    A snapshot of one download's progress
+    """
+
+    def __init__(self, downloaded, total, elapsed, speed, done=False):
+        self.downloaded = downloaded  # bytes on hand, including any resumed from disk
+        self.total = total            # expected bytes, 0 if unknown
+        self.elapsed = elapsed        # seconds since the transfer started
+        self.speed = speed            # bytes per second, smoothed
+        self.done = done
+
+    @property
+    def percent(self):
+        return self.downloaded / self.total * 100 if self.total else None
+
+    @property
+    def eta(self):
+        """
+        Seconds left at the current speed, or None if unknown
+        """
+        if not self.total or not self.speed:
+            return None
+        return max(0.0, (self.total - self.downloaded) / self.speed)
+
+
+class Progress:
+    """
+    Turns a download's stream of chunks into throttled ProgressEvents
+
+    advance() is cheap and may be called for every chunk, from any thread;
+    the callback only runs once min_interval has passed and min_bytes more
+    have arrived since the last event, plus once more from finish().
+    """
+
+    def __init__(self, callback=None, min_interval=None, min_bytes=None, alpha=0.3):
+        """
+        Args:
+            callback (callable): Called with each ProgressEvent (None = no reporting)
+            min_interval (float): Seconds between events (defaults to PROGRESS_INTERVAL)
+            min_bytes (int): New bytes needed for an event (defaults to PROGRESS_MIN_BYTES)
+            alpha (float): Weight of the newest speed sample in the smoothed speed
+        """
+        self.callback = callback
+        self.min_interval = PROGRESS_INTERVAL if min_interval is None else min_interval
+        self.min_bytes = PROGRESS_MIN_BYTES if min_bytes is None else min_bytes
+        self.alpha = alpha
+        self._lock = threading.Lock()
+        self.start()
+
+    def start(self, total=0, initial=0):
+        """
+        (Re)starts the transfer, e.g. once the size is known or when a retry starts over
+
+        Args:
+            total (int): Expected bytes, 0 if unknown
+            initial (int): Bytes already on hand (a resumed download)
+        """
+        with self._lock:
+            self.total = total
+            self.downloaded = self._initial = initial
+            self.speed = None
+            self._started = self._last_time = time.monotonic()
+            self._last_bytes = initial
+
+    def advance(self, length):
+        """
+        Records length more bytes, emitting an event if the throttle allows
+        """
+        if self.callback is None:
+            return
+        with self._lock:
+            self.downloaded += length
+            now = time.monotonic()
+            interval = now - self._last_time
+            if interval < self.min_interval or self.downloaded - self._last_bytes < self.min_bytes:
+                return
+            rate = (self.downloaded - self._last_bytes) / interval
+            self.speed = rate if self.speed is None else self.speed + self.alpha * (rate - self.speed)
+            self._last_time, self._last_bytes = now, self.downloaded
+            self.callback(ProgressEvent(self.downloaded, self.total, now - self._started, self.speed))
+
+    def finish(self):
+        """
+        Emits the final event
+        """
+        if self.callback is None:
+            return
+        with self._lock:
+            elapsed = time.monotonic() - self._started
+            # The final speed is the transfer's average
+            speed = (self.downloaded - self._initial) / elapsed if elapsed > 0 else None
+            self.callback(ProgressEvent(self.downloaded, self.total or self.downloaded, elapsed, speed, done=True))
+
+
+def format_eta(seconds):
+    if seconds is None:
+        return "?"
+    seconds = math.ceil(seconds)
+    return f"{seconds // 60}m{seconds % 60:02d}s" if seconds >= 60 else f"{seconds}s"
+
+
+def print_progress_bar(event, width=30, stream=None):
+    """
+    Progress callback that draws a one-line progress bar on the terminal
+    """
+    stream = stream or sys.stdout
+    downloaded = event.downloaded / 1024 / 1024
+    speed = f"{event.speed / 1024 / 1024:.2f} MB/s" if event.speed else "-- MB/s"
+    if event.total:
+        filled = int(width * min(event.downloaded, event.total) / event.total)
+        bar = "#" * filled + "-" * (width - filled)
+        line = f"[{bar}] {event.percent:5.1f}% {downloaded:.2f}/{event.total / 1024 / 1024:.2f} MB {speed} ETA {format_eta(event.eta)}"
+    else:
+        line = f"{downloaded:.2f} MB {speed}"
+    stream.write("\r" + line + ("\n" if event.done else ""))
+    stream.flush()
+
+
+def print_progress_line(label, event, stream=None):
+    """
+    Progress callback for several downloads at once: one full line per event, prefixed with label
+    """
+    stream = stream or sys.stdout
+    downloaded = event.downloaded / 1024 / 1024
+    speed = f"{event.speed / 1024 / 1024:.2f} MB/s" if event.speed else "-- MB/s"
+    if event.done:
+        line = f"{label}: done, {downloaded:.2f} MB at {speed}"
+    elif event.total:
+        line = f"{label}: {event.percent:5.1f}% {downloaded:.2f}/{event.total / 1024 / 1024:.2f} MB {speed} ETA {format_eta(event.eta)}"
+    else:
+        line = f"{label}: {downloaded:.2f} MB {speed}"
+    stream.write(line + "\n")
+    stream.flush()
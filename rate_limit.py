@@ -0,0 +1,245 @@
+import asyncio
+import email.utils
+import os
+import random
+import sqlite3
+import threading
+import time
+from urllib.parse import urlsplit
+
+
+def parse_retry_after(value):
+    """
+    Parses a Retry-After header (seconds or an HTTP date)
+
+    Returns:
+        float: Seconds to wait, or None if the header is missing or invalid
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class _MemoryStore:
+    # Bucket state for this process only
+    blocking = False
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    def update(self, host, fn):
+        with self._lock:
+            state = fn(self._buckets.get(host))
+            self._buckets[host] = state
+            return state
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._buckets)
+
+
+class _SqliteStore:
+    # Bucket state in a SQLite file, shared by every process using the same path
+    # Updates can wait on another process's write lock, so async callers run them in a thread
+    blocking = True
+
+    def __init__(self, db_path):
+        directory = os.path.dirname(db_path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS rate_limits ("
+            " host TEXT PRIMARY KEY,"
+            " tokens REAL NOT NULL,"
+            " updated_at REAL NOT NULL,"
+            " rate REAL NOT NULL,"
+            " blocked_until REAL NOT NULL)"
+        )
+
+    def update(self, host, fn):
+        with self._lock:
+            # BEGIN IMMEDIATE takes the write lock, so two processes can't spend the same token
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._db.execute(
+                    "SELECT tokens, updated_at, rate, blocked_until FROM rate_limits WHERE host = ?", (host,)
+                ).fetchone()
+                state = fn(tuple(row) if row else None)
+                self._db.execute(
+                    "INSERT OR REPLACE INTO rate_limits (host, tokens, updated_at, rate, blocked_until) VALUES (?, ?, ?, ?, ?)",
+                    (host,) + state
+                )
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+        return state
+
+    def snapshot(self):
+        with self._lock:
+            rows = self._db.execute("SELECT host, tokens, updated_at, rate, blocked_until FROM rate_limits").fetchall()
+        return {row[0]: tuple(row[1:]) for row in rows}
+
+
+class RateLimiter:
+    """
+    Token bucket per upstream host, shared by every thread and coroutine
+
+    Each request takes a token; tokens refill at the host's current rate up to
+    burst, and requests wait while there are none. The rate is learned: every
+    successful answer nudges it up towards max_rate, while a 429 halves it
+    (down to min_rate) and pauses the host for Retry-After seconds, so the
+    limiter settles just under the upstream quota.
+
+    With db_path set the buckets live in a SQLite file, and every process
+    pointing at the same file shares one budget per host.
+    """
+
+    def __init__(self, rate=5.0, burst=10, min_rate=0.5, max_rate=20.0, increase=0.5, db_path=None):
+        """
+        Args:
+            rate (float): Starting requests per second for a host
+            burst (int): Requests that may go out back to back after a quiet spell
+            min_rate (float): The rate never drops below this
+            max_rate (float): The rate never climbs above this
+            increase (float): Requests per second added per second of successful traffic
+            db_path (str): SQLite file to share buckets across processes (None = this process only)
+        """
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self._store = _SqliteStore(db_path) if db_path else _MemoryStore()
+        self.throttled = 0
+
+    def _fresh(self, state, now):
+        if state is None:
+            return float(self.burst), now, self.rate, 0.0
+        tokens, updated_at, rate, blocked_until = state
+        return min(float(self.burst), tokens + (now - updated_at) * rate), now, rate, blocked_until
+
+    def _try_take(self, host):
+        now = time.time()
+        wait = 0.0
+
+        def take(state):
+            nonlocal wait
+            tokens, updated_at, rate, blocked_until = self._fresh(state, now)
+            if now >= blocked_until and tokens >= 1:
+                return tokens - 1, updated_at, rate, blocked_until
+            wait = max(blocked_until - now, (1 - tokens) / rate)
+            return tokens, updated_at, rate, blocked_until
+
+        self._store.update(host, take)
+        return wait
+
+    def acquire(self, url, max_wait=None):
+        """
+        Waits until a request to url's host may be sent
+
+        The bucket is checked again after every wait, so a rate cut or pause
+        learned in the meantime applies to requests already waiting.
+
+        Args:
+            url (str): The request URL
+            max_wait (float): Give up instead of waiting longer than this
+
+        Returns:
+            bool: False if the wait would have exceeded max_wait
+        """
+        host = urlsplit(url).netloc
+        give_up_at = None if max_wait is None else time.monotonic() + max_wait
+        while True:
+            wait = self._try_take(host)
+            if not wait:
+                return True
+            if give_up_at is not None and time.monotonic() + wait > give_up_at:
+                return False
+            # Jitter keeps waiters from all waking for the same token
+            time.sleep(wait * random.uniform(1.0, 1.2))
+
+    async def aacquire(self, url, max_wait=None):
+        """
+        Async version of acquire
+        """
+        host = urlsplit(url).netloc
+        give_up_at = None if max_wait is None else time.monotonic() + max_wait
+        while True:
+            wait = await self._aupdate(self._try_take, host)
+            if not wait:
+                return True
+            if give_up_at is not None and time.monotonic() + wait > give_up_at:
+                return False
+            await asyncio.sleep(wait * random.uniform(1.0, 1.2))
+
+    async def _aupdate(self, fn, *args):
+        # A shared store can block on another process's lock; keep it off the event loop
+        if self._store.blocking:
+            return await asyncio.to_thread(fn, *args)
+        return fn(*args)
+
+    def record(self, url, response):
+        """
+        Adjusts the host's rate from an answer: up on success, down on 429
+
+        Args:
+            url (str): The request URL
+            response (httpx.Response): The answer
+        """
+        adjust = self._adjustment(response)
+        if adjust is not None:
+            self._store.update(urlsplit(url).netloc, adjust)
+
+    async def arecord(self, url, response):
+        """
+        Async version of record
+        """
+        adjust = self._adjustment(response)
+        if adjust is not None:
+            await self._aupdate(self._store.update, urlsplit(url).netloc, adjust)
+
+    def _adjustment(self, response):
+        # The bucket update an answer calls for, or None if it says nothing about the rate
+        now = time.time()
+        throttled = response.status_code == 429
+        retry_after = parse_retry_after(response.headers.get("retry-after"))
+        if not throttled and retry_after is None:
+            if response.status_code >= 400:
+                return None
+            # Additive increase: about `increase` more requests per second for every second of success
+            def adjust(state):
+                tokens, updated_at, rate, blocked_until = self._fresh(state, now)
+                return tokens, updated_at, min(self.max_rate, rate + self.increase / rate), blocked_until
+        else:
+            self.throttled += 1
+            def adjust(state):
+                tokens, updated_at, rate, blocked_until = self._fresh(state, now)
+                if throttled:
+                    rate = max(self.min_rate, rate / 2)
+                pause = retry_after if retry_after is not None else 1 / rate
+                # Drop any saved-up burst so the host isn't hit again the moment the pause ends
+                return min(tokens, 0.0), updated_at, rate, max(blocked_until, now + pause)
+        return adjust
+
+    def stats(self):
+        """
+        Returns each host's current rate (requests per second) and pause, plus the 429 count
+        """
+        now = time.time()
+        hosts = {
+            host: {"rate": round(rate, 2), "paused_for": round(max(0.0, blocked_until - now), 2)}
+            for host, (tokens, updated_at, rate, blocked_until) in self._store.snapshot().items()
+        }
+        return {"throttled": self.throttled, "hosts": hosts}
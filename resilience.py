@@ -0,0 +1,273 @@
+import asyncio
+import contextlib
+import contextvars
+import random
+import threading
+import time
+
+import httpx
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of calling an endpoint whose circuit breaker is open
+    """
+
+
+class DeadlineExceededError(Exception):
+    """
+    Raised when a user request has used up its time budget
+    """
+
+
+class CircuitBreaker:
+    """
+    Stops calling an endpoint that keeps failing
+
+    After failure_threshold consecutive failures the circuit opens and calls
+    fail immediately with CircuitOpenError. Once reset_timeout seconds have
+    passed it goes half-open: a single probe call is let through, and its
+    outcome closes the circuit again or reopens it for another reset_timeout.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30.0):
+        """
+        Args:
+            name (str): Endpoint name used in messages
+            failure_threshold (int): Consecutive failures that open the circuit
+            reset_timeout (float): Seconds the circuit stays open before probing
+        """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_started = None
+        self._rejected = 0
+
+    def allow(self):
+        """
+        Claims permission to make a call
+
+        Raises:
+            CircuitOpenError: If the circuit is open, or half-open with a probe already running
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self._state == self.OPEN and now - self._opened_at >= self.reset_timeout:
+                self._state = self.HALF_OPEN
+                self._probe_started = None
+
+            if self._state == self.CLOSED:
+                return
+            # A probe that never reported back (e.g. cancelled) frees its slot after reset_timeout
+            if self._state == self.HALF_OPEN and (self._probe_started is None or now - self._probe_started >= self.reset_timeout):
+                self._probe_started = now
+                return
+
+            self._rejected += 1
+            retry_in = max(0.0, self._opened_at + self.reset_timeout - now)
+            raise CircuitOpenError(f"{self.name} is unavailable, retrying in {retry_in:.0f}s")
+
+    def record_success(self):
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures = 0
+            self._probe_started = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+                self._probe_started = None
+
+    def stats(self):
+        """
+        Returns the breaker's state, consecutive failures and calls rejected while open
+        """
+        with self._lock:
+            return {"state": self._state, "failures": self._failures, "rejected": self._rejected}
+
+
+class RetryPolicy:
+    """
+    Exponential backoff with full jitter: attempt n waits a random time up to
+    min(max_delay, base_delay * 2 ** (n - 1)) before the next try.
+    """
+
+    def __init__(self, attempts=3, base_delay=0.5, max_delay=8.0):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+
+# Monotonic time the current user request must be done by (None = no budget)
+_deadline = contextvars.ContextVar("deadline", default=None)
+
+
+@contextlib.contextmanager
+def deadline(seconds):
+    """
+    Gives every call made inside the block one shared time budget
+
+    The budget follows the code into coroutines and tasks started inside the
+    block; a nested deadline can only shorten it.
+
+    Args:
+        seconds (float): The budget
+    """
+    expires_at = time.monotonic() + seconds
+    current = _deadline.get()
+    if current is not None:
+        expires_at = min(expires_at, current)
+    token = _deadline.set(expires_at)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining_budget():
+    """
+    Returns the seconds left for the current user request, or None without a deadline
+    """
+    expires_at = _deadline.get()
+    if expires_at is None:
+        return None
+    return expires_at - time.monotonic()
+
+
+def budget_timeout(timeout):
+    """
+    Caps an httpx.Timeout by what's left of the current deadline
+
+    Raises:
+        DeadlineExceededError: If the budget is already spent
+    """
+    budget = remaining_budget()
+    if budget is None:
+        return timeout
+    if budget <= 0:
+        raise DeadlineExceededError("request deadline exceeded")
+
+    def cap(value):
+        return budget if value is None else min(value, budget)
+
+    return httpx.Timeout(connect=cap(timeout.connect), read=cap(timeout.read), write=cap(timeout.write), pool=cap(timeout.pool))
+
+
+def is_retryable(error):
+    """
+    Whether an error is worth another attempt: network failures, timeouts,
+    5xx answers and 429 Too Many Requests
+    """
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code >= 500 or error.response.status_code == 429
+    return isinstance(error, httpx.TransportError)
+
+
+def is_throttled(error):
+    """
+    Whether an error is a 429: the upstream is pacing us, not failing
+    """
+    return isinstance(error, httpx.HTTPStatusError) and error.response.status_code == 429
+
+
+def raise_for_retryable_status(response):
+    """
+    Raises httpx.HTTPStatusError for answers worth retrying (5xx and 429)
+    """
+    if response.status_code >= 500 or response.status_code == 429:
+        response.raise_for_status()
+
+
+def _next_delay(breaker, policy, attempt, error):
+    # Returns how long to wait before retrying, or None to give up
+    if attempt >= policy.attempts:
+        return None
+    delay = policy.delay(attempt)
+    budget = remaining_budget()
+    if budget is not None and delay >= budget:
+        return None
+    reason = f"HTTP {error.response.status_code}" if isinstance(error, httpx.HTTPStatusError) else (str(error) or type(error).__name__)
+    print(f"{breaker.name} attempt {attempt} failed ({reason}), retrying in {delay:.2f}s")
+    return delay
+
+
+def call_with_retry(breaker, fn, policy):
+    """
+    Calls fn() through a circuit breaker, retrying retryable failures
+
+    Args:
+        breaker (CircuitBreaker): The endpoint's breaker
+        fn (callable): Makes one attempt
+        policy (RetryPolicy): Attempts and backoff
+
+    Returns:
+        The result of the first successful attempt
+
+    Raises:
+        CircuitOpenError: If the endpoint's circuit is open
+        The last attempt's exception once retries or the deadline run out
+    """
+    attempt = 0
+    while True:
+        attempt += 1
+        breaker.allow()
+        try:
+            result = fn()
+        except DeadlineExceededError:
+            raise
+        except Exception as e:
+            if not is_retryable(e):
+                # The endpoint answered; the failure is about this request, not its health
+                breaker.record_success()
+                raise
+            if not is_throttled(e):
+                breaker.record_failure()
+            delay = _next_delay(breaker, policy, attempt, e)
+            if delay is None:
+                raise
+            time.sleep(delay)
+        else:
+            breaker.record_success()
+            return result
+
+
+async def acall_with_retry(breaker, coro_factory, policy):
+    """
+    Async version of call_with_retry; coro_factory() returns the coroutine for one attempt
+    """
+    attempt = 0
+    while True:
+        attempt += 1
+        breaker.allow()
+        try:
+            result = await coro_factory()
+        except DeadlineExceededError:
+            raise
+        except Exception as e:
+            if not is_retryable(e):
+                breaker.record_success()
+                raise
+            if not is_throttled(e):
+                breaker.record_failure()
+            delay = _next_delay(breaker, policy, attempt, e)
+            if delay is None:
+                raise
+            await asyncio.sleep(delay)
+        else:
+            breaker.record_success()
+            return result
@@ -0,0 +1,245 @@
+import asyncio
+import contextvars
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from tracing import span
+
+
+class Resolver:
+    """
+    A backend that turns a Spotify track URL into a direct download URL
+
+    Implementations override resolve (for the CLI / threads) and aresolve (for
+    the bot's event loop). Both return the download URL, or None if the backend
+    doesn't have the track; exceptions count as failures too.
+    """
+
+    name = "resolver"
+
+    def resolve(self, track_url):
+        raise NotImplementedError
+
+    async def aresolve(self, track_url):
+        raise NotImplementedError
+
+
+class _BackendStats:
+    def __init__(self, alpha):
+        self.alpha = alpha
+        self.success_rate = 1.0  # exponentially weighted, so recent health counts most
+        self.latency = None      # exponentially weighted seconds per successful answer
+        self.latencies = deque(maxlen=200)
+        self.requests = 0
+        self.wins = 0
+
+    def record(self, ok, elapsed):
+        self.requests += 1
+        self.success_rate += self.alpha * ((1.0 if ok else 0.0) - self.success_rate)
+        if ok:
+            self.latencies.append(elapsed)
+            self.latency = elapsed if self.latency is None else self.latency + self.alpha * (elapsed - self.latency)
+
+    def percentile(self, pct):
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+class ResolverRouter:
+    """
+    Spreads download link lookups over several resolvers
+
+    The backend for each lookup is picked at random, weighted by its recent
+    success rate divided by its typical latency, so a slow or failing backend
+    gets little traffic but still enough to notice when it recovers. If the
+    chosen backend hasn't answered within its p95 latency, a hedged request
+    goes to the next best backend and whichever answers first wins. Hedges
+    never repeat a request to the same backend (a slow backend is often just
+    throttling us), so with a single backend there is no hedging. A backend
+    that fails outright is replaced by the next one straight away.
+    """
+
+    def __init__(self, resolvers, hedge=True, default_hedge_delay=2.0, min_hedge_delay=0.05, min_samples=20, alpha=0.1):
+        """
+        Args:
+            resolvers (list): The Resolver backends to route between
+            hedge (bool): Send a second request, to another backend, when the first is slower than p95
+            default_hedge_delay (float): Hedge delay (seconds) until a backend has min_samples answers
+            min_hedge_delay (float): Never hedge sooner than this
+            min_samples (int): Answers needed before a backend's p95 is trusted
+            alpha (float): Weight of the newest observation in the moving averages
+        """
+        if not resolvers:
+            raise ValueError("ResolverRouter needs at least one resolver")
+        self.resolvers = list(resolvers)
+        # A hedge needs another backend to go to
+        self.hedge = hedge and len(self.resolvers) > 1
+        self.default_hedge_delay = default_hedge_delay
+        self.min_hedge_delay = min_hedge_delay
+        self.min_samples = min_samples
+
+        self._lock = threading.Lock()
+        self._stats = {resolver.name: _BackendStats(alpha) for resolver in self.resolvers}
+        self._executor = None
+        self.hedged = 0
+
+    def _weight(self, resolver):
+        stats = self._stats[resolver.name]
+        # Unmeasured backends are treated as fast so they get tried
+        return max(stats.success_rate, 0.01) / max(stats.latency or 0.01, 0.01)
+
+    def _ranked(self):
+        with self._lock:
+            weights = [self._weight(resolver) for resolver in self.resolvers]
+            first = random.choices(self.resolvers, weights=weights)[0]
+            rest = sorted((r for r in self.resolvers if r is not first), key=self._weight, reverse=True)
+        return [first] + rest
+
+    def _hedge_delay(self, resolver):
+        with self._lock:
+            stats = self._stats[resolver.name]
+            if len(stats.latencies) < self.min_samples:
+                return self.default_hedge_delay
+            return max(self.min_hedge_delay, stats.percentile(95))
+
+    def _record(self, resolver, ok, elapsed):
+        with self._lock:
+            self._stats[resolver.name].record(ok, elapsed)
+
+    def _win(self, resolver):
+        with self._lock:
+            self._stats[resolver.name].wins += 1
+
+    def _next_resolver(self, candidates, launched):
+        # The best backend not asked yet; asking the same one twice only adds load
+        untried = [resolver for resolver in candidates if resolver not in launched]
+        return untried[0] if untried else None
+
+    def _attempt(self, resolver, track_url):
+        start = time.monotonic()
+        try:
+            with span(f"resolve {resolver.name}"):
+                url = resolver.resolve(track_url)
+        except Exception as e:
+            print(f"Resolver {resolver.name} failed: {e}")
+            url = None
+        self._record(resolver, url is not None, time.monotonic() - start)
+        return resolver, url
+
+    async def _aattempt(self, resolver, track_url):
+        start = time.monotonic()
+        try:
+            with span(f"resolve {resolver.name}"):
+                url = await resolver.aresolve(track_url)
+        except asyncio.CancelledError:
+            # A hedge that lost the race says nothing about the backend's health
+            raise
+        except Exception as e:
+            print(f"Resolver {resolver.name} failed: {e}")
+            url = None
+        self._record(resolver, url is not None, time.monotonic() - start)
+        return resolver, url
+
+    def resolve(self, track_url):
+        """
+        Gets a download URL from the best available backend
+
+        Args:
+            track_url (str): The Spotify track URL
+
+        Returns:
+            str: Download URL or None if no backend could resolve the track
+        """
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="resolver")
+            executor = self._executor
+
+        candidates = self._ranked()
+        launched = [candidates[0]]
+        # Each thread gets a copy of the caller's context so the request deadline still applies
+        pending = {executor.submit(contextvars.copy_context().run, self._attempt, candidates[0], track_url)}
+        hedged = False
+        while pending:
+            timeout = self._hedge_delay(launched[-1]) if self.hedge and not hedged else None
+            done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                resolver, url = future.result()
+                if url:
+                    self._win(resolver)
+                    return url
+
+            hedging = not done
+            resolver = self._next_resolver(candidates, launched) if hedging or not pending else None
+            if resolver is not None:
+                if hedging:
+                    hedged = True
+                    with self._lock:
+                        self.hedged += 1
+                launched.append(resolver)
+                pending.add(executor.submit(contextvars.copy_context().run, self._attempt, resolver, track_url))
+            elif hedging:
+                hedged = True
+        return None
+
+    async def aresolve(self, track_url):
+        """
+        Gets a download URL from the best available backend without blocking the event loop
+
+        Args:
+            track_url (str): The Spotify track URL
+
+        Returns:
+            str: Download URL or None if no backend could resolve the track
+        """
+        candidates = self._ranked()
+        launched = [candidates[0]]
+        pending = {asyncio.ensure_future(self._aattempt(candidates[0], track_url))}
+        hedged = False
+        try:
+            while pending:
+                timeout = self._hedge_delay(launched[-1]) if self.hedge and not hedged else None
+                done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    resolver, url = task.result()
+                    if url:
+                        self._win(resolver)
+                        return url
+
+                hedging = not done
+                resolver = self._next_resolver(candidates, launched) if hedging or not pending else None
+                if resolver is not None:
+                    if hedging:
+                        hedged = True
+                        self.hedged += 1
+                    launched.append(resolver)
+                    pending.add(asyncio.ensure_future(self._aattempt(resolver, track_url)))
+                elif hedging:
+                    hedged = True
+            return None
+        finally:
+            # Whoever lost the race is no longer needed
+            for task in pending:
+                task.cancel()
+
+    def stats(self):
+        """
+        Returns per-backend request counts, success rates and latencies, plus the hedge count
+
+        Returns:
+            dict: {"hedged": int, "backends": {name: {...}}}
+        """
+        with self._lock:
+            backends = {}
+            for name, stats in self._stats.items():
+                backends[name] = {
+                    "requests": stats.requests,
+                    "wins": stats.wins,
+                    "success_rate": round(stats.success_rate, 3),
+                    "p50": stats.percentile(50) if stats.latencies else None,
+                    "p95": stats.percentile(95) if stats.latencies else None
+                }
+            return {"hedged": self.hedged, "backends": backends}
@@ -0,0 +1,90 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+
+
+class SingleFlight:
+    """
+    Coalesces identical in-flight calls
+
+    While a call for a key is running, further calls with the same key don't
+    start their own work; they wait for the running call and get its result
+    (or its exception). Works for threads (call) and coroutines (acall).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._tasks = {}
+        self.started = 0
+        self.shared = 0
+
+    def call(self, key, fn):
+        """
+        Runs fn() unless a call for key is already running in another thread
+
+        Args:
+            key: Identifies identical calls
+            fn (callable): Does the work
+
+        Returns:
+            The result of the one fn() call made for the in-flight key
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._calls[key] = future
+                self.started += 1
+            else:
+                self.shared += 1
+
+        if not leader:
+            return future.result()
+
+        try:
+            result = fn()
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+
+    async def acall(self, key, coro_factory):
+        """
+        Awaits coro_factory() unless a coroutine for key is already running
+
+        The shared work runs in its own task, so a caller giving up (being
+        cancelled) doesn't cancel it for the others.
+
+        Args:
+            key: Identifies identical calls
+            coro_factory (callable): Returns the coroutine that does the work
+
+        Returns:
+            The result of the one coroutine run for the in-flight key
+        """
+        task = self._tasks.get(key)
+        if task is None:
+            task = asyncio.ensure_future(coro_factory())
+            self._tasks[key] = task
+            self.started += 1
+
+            def forget(finished, key=key):
+                if self._tasks.get(key) is finished:
+                    del self._tasks[key]
+            task.add_done_callback(forget)
+        else:
+            self.shared += 1
+        return await asyncio.shield(task)
+
+    def in_flight(self):
+        """
+        Returns the number of keys currently being worked on
+        """
+        with self._lock:
+            return len(self._calls) + len(self._tasks)
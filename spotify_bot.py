@@ -1,11 +1,616 @@
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
-from spotify_downloader import get_spotify_track_metadata, download_track, download_file  # Added download_file import
+from telegram.error import BadRequest, RetryAfter
+from spotify_downloader import get_spotify_track_metadata_async, get_spotify_collection_tracks_async, download_track_async, download_to_buffer_async, track_tag_async, cover_cache, http_client, extract_track_id, extract_collection, track_filename, audio_store, store_track_buffer, TransferRejectedError, CACHE_DIR, REQUEST_DEADLINE, SPOOL_THRESHOLD
+from resilience import deadline
+from tracing import current_span, span, traced
+from progress import format_eta
+from transcode import PROFILES, TranscodeError, Transcoder, variant_key
+from metrics import IN_FLIGHT, METRICS_PORT, STAGE_SECONDS, record_error, start_metrics_server, watch_cache
+from cache import TieredCache
+from job_queue import FairJobQueue, QueueFullError
+from singleflight import SingleFlight
+from broker import broker_from_url
+import asyncio
 import os
+import time
 import requests
 
-TOKEN = "bot token"
+TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN", "bot token")
 
+# Bot API server (override to test against a local fake Telegram, see fake_telegram.py)
+TELEGRAM_API_BASE_URL = os.environ.get("TELEGRAM_API_BASE_URL", "https://api.telegram.org/bot")
+# Largest file the bot can upload: 50 MB on the public Bot API, up to 2000 MB on a local Bot API server
+UPLOAD_LIMIT = int(os.environ.get("TELEGRAM_UPLOAD_LIMIT", 50 * 1024 * 1024))  # bytes
+
+# "polling" or "webhook". Webhook mode receives updates over HTTPS as soon as they happen
+# and can run behind a load balancer; polling is for local development.
+BOT_MODE = os.environ.get("BOT_MODE", "polling")
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", 8443))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")  # checked against X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")  # public base URL Telegram should post to, e.g. https://bot.example.com
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get("WEBHOOK_MAX_CONNECTIONS", 100))  # parallel deliveries Telegram may open
+
+# Album/playlist downloads: tracks processed at once, tracks per request
+COLLECTION_CONCURRENCY = int(os.environ.get("COLLECTION_CONCURRENCY", 4))
+MAX_COLLECTION_TRACKS = int(os.environ.get("MAX_COLLECTION_TRACKS", 100))
+
+# Seconds between progress edits of a status message (album progress and single-track speed/ETA);
+# Telegram throttles bots that edit the same chat much more often than once a second
+PROGRESS_EDIT_INTERVAL = float(os.environ.get("PROGRESS_EDIT_INTERVAL", 3))
+
+# Optional ffmpeg re-encoding before upload. With ffmpeg installed, tracks over UPLOAD_LIMIT are
+# re-encoded to fit instead of being refused, and TRANSCODE_PROFILE (e.g. "mp3_128") re-encodes every
+# track to shrink uploads ("" sends them as downloaded). Variants are kept in the audio store per track and profile.
+TRANSCODE_PROFILE = os.environ.get("TRANSCODE_PROFILE", "")
+if TRANSCODE_PROFILE and TRANSCODE_PROFILE not in PROFILES:
+    raise ValueError(f"Unknown TRANSCODE_PROFILE {TRANSCODE_PROFILE!r}, expected one of {', '.join(PROFILES)}")
+# Largest download accepted when it can be re-encoded to fit
+TRANSCODE_MAX_SOURCE = int(os.environ.get("TRANSCODE_MAX_SOURCE", 200 * 1024 * 1024))  # bytes
+transcoder = Transcoder(
+    concurrency=int(os.environ.get("TRANSCODE_CONCURRENCY", 0)) or None,  # 0 = one per CPU
+    timeout=float(os.environ.get("TRANSCODE_TIMEOUT", 300)),
+    spool_threshold=SPOOL_THRESHOLD
+)
+if not transcoder.available:
+    if TRANSCODE_PROFILE:
+        print("TRANSCODE_PROFILE is set but ffmpeg wasn't found; tracks are sent as downloaded")
+    transcoder = None
+
+# Every download runs through one queue: bounded workers, per-user cap, round-robin between users
+download_queue = FairJobQueue(
+    workers=int(os.environ.get("DOWNLOAD_WORKERS", 8)),
+    per_user_limit=int(os.environ.get("PER_USER_DOWNLOADS", 2)),
+    max_queued=int(os.environ.get("MAX_QUEUED_DOWNLOADS", 200))
+)
+
+# Requests for a track that's already being downloaded wait for that download
+track_flights = SingleFlight()
+
+# When set, downloads are enqueued for worker.py processes instead of running in this process
+# (e.g. sqlite:///cache/jobs.sqlite3 or redis://localhost:6379/0)
+BROKER_URL = os.environ.get("BROKER_URL")
+job_broker = broker_from_url(BROKER_URL) if BROKER_URL else None
+
+# SQLite file holding the bot's persistent caches ("" keeps them in memory only)
+BOT_CACHE_DB = os.environ.get("BOT_CACHE_DB", os.path.join(CACHE_DIR, "bot.sqlite3")) or None
+
+# Spotify track ID -> Telegram audio file_id, so popular tracks are re-sent without downloading
+file_id_cache = TieredCache(
+    "telegram_file_ids",
+    db_path=BOT_CACHE_DB,
+    ttl=None,
+    max_entries=int(os.environ.get("FILE_ID_CACHE_SIZE", 10000)),
+    max_disk_entries=int(os.environ.get("FILE_ID_CACHE_DISK_SIZE", 200000))
+)
+
+# Cover image URL -> Telegram photo file_id, so info cards re-send the photo without uploading it again
+photo_file_ids = TieredCache(
+    "telegram_photo_ids",
+    db_path=BOT_CACHE_DB,
+    ttl=None,
+    max_entries=int(os.environ.get("PHOTO_ID_CACHE_SIZE", 10000)),
+    max_disk_entries=int(os.environ.get("PHOTO_ID_CACHE_DISK_SIZE", 200000))
+)
+
+# Per-track request context carried from the info card to the download button
+track_contexts = TieredCache(
+    "track_contexts",
+    db_path=BOT_CACHE_DB,
+    ttl=float(os.environ.get("TRACK_CONTEXT_TTL", 60 * 60)),
+    max_entries=int(os.environ.get("TRACK_CONTEXT_SIZE", 10000))
+)
+
+watch_cache("telegram_file_ids", file_id_cache)
+watch_cache("telegram_photo_ids", photo_file_ids)
+watch_cache("track_contexts", track_contexts)
+IN_FLIGHT.set_function(lambda: download_queue.stats()["running"], kind="downloads_running")
+IN_FLIGHT.set_function(lambda: download_queue.stats()["queued"], kind="downloads_queued")
+IN_FLIGHT.set_function(track_flights.in_flight, kind="tracks")
+
+async def track_metadata(track_id, track_url):
+    """
+    Gets the metadata needed to send a track
+
+    It comes from the context stored when the info card was shown; only if
+    that has expired is it fetched again.
+
+    Args:
+        track_id (str): Spotify track ID
+        track_url (str): Spotify track URL
+
+    Returns:
+        dict: Track metadata, or None on failure
+    """
+    hit, context = await track_contexts.aget(track_id)
+    if hit and context:
+        return context['metadata']
+    return await get_spotify_track_metadata_async(track_url)
+
+@traced()
+async def send_cached_audio(message, track_id):
+    """
+    Re-sends a previously uploaded track by its Telegram file_id
+
+    Args:
+        message (telegram.Message): Message to reply to
+        track_id (str): Spotify track ID
+
+    Returns:
+        bool: True if the track was sent from cache
+    """
+    hit, cached = await file_id_cache.aget(track_id)
+    if not hit or not cached:
+        return False
+
+    try:
+        await message.reply_audio(
+            audio=cached['file_id'],
+            caption=f"🎵 {cached['title']} - {cached['performer']}"
+        )
+        return True
+    except BadRequest as e:
+        # Telegram no longer accepts this file_id; forget it and upload again
+        print(f"Cached file_id for {track_id} rejected: {e}")
+        await file_id_cache.adelete(track_id)
+        return False
+
+@traced()
+async def reply_cover_photo(message, cover_url, **kwargs):
+    """
+    Replies with a track's cover as a photo, uploading each cover only once
+
+    The first send uploads the cached, resized image (or lets Telegram fetch
+    the URL if there's no cover cache); later sends reuse the photo's file_id.
+
+    Args:
+        message (telegram.Message): Message to reply to
+        cover_url (str): The cover's URL
+        **kwargs: Passed on to reply_photo (caption, reply_markup, ...)
+
+    Returns:
+        telegram.Message: The sent message
+    """
+    hit, file_id = await photo_file_ids.aget(cover_url)
+    if hit and file_id:
+        try:
+            return await message.reply_photo(photo=file_id, **kwargs)
+        except BadRequest as e:
+            # Telegram no longer accepts this file_id; forget it and upload again
+            print(f"Cached photo file_id for {cover_url} rejected: {e}")
+            await photo_file_ids.adelete(cover_url)
+
+    photo = await cover_cache.aget(cover_url) if cover_cache else None
+    sent = await message.reply_photo(photo=photo or cover_url, **kwargs)
+    if sent and sent.photo:
+        # The largest size is last; Telegram serves the smaller ones from it
+        await photo_file_ids.aset(cover_url, sent.photo[-1].file_id)
+    return sent
+
+class DeliveryError(Exception):
+    """
+    Raised when a track can't be delivered; the message is shown to the user
+    """
+
+TOO_LARGE_MESSAGE = (
+    f"⚠️ The track is too large to send through Telegram (>{UPLOAD_LIMIT // (1024 * 1024)}MB).\n"
+    "Please try a different track or contact the bot owner for assistance."
+)
+
+class StatusProgress:
+    """
+    Download progress callback that shows percentage, speed and ETA in a status message
+
+    Edits go out in the background, one at a time and at most every
+    PROGRESS_EDIT_INTERVAL seconds, so the download never waits on Telegram;
+    a RetryAfter from Telegram pushes the next edit back as requested.
+    """
+
+    def __init__(self, status_message, interval=None):
+        self.status_message = status_message
+        self.interval = PROGRESS_EDIT_INTERVAL if interval is None else interval
+        self._next_edit = time.monotonic() + self.interval
+        self._task = None
+
+    def __call__(self, event):
+        now = time.monotonic()
+        if event.done or now < self._next_edit or (self._task and not self._task.done()):
+            return
+        self._next_edit = now + self.interval
+        self._task = asyncio.get_running_loop().create_task(self._edit(self.format(event)))
+
+    @staticmethod
+    def format(event):
+        downloaded = event.downloaded / 1024 / 1024
+        if event.total:
+            text = f"🔄 Downloading track... {event.percent:.0f}% ({downloaded:.1f} of {event.total / 1024 / 1024:.1f} MB)"
+        else:
+            text = f"🔄 Downloading track... {downloaded:.1f} MB"
+        if event.speed:
+            text += f"\n⚡ {event.speed / 1024 / 1024:.2f} MB/s"
+            if event.eta is not None:
+                text += f", about {format_eta(event.eta)} left"
+        return text
+
+    async def _edit(self, text):
+        try:
+            await self.status_message.edit_text(text)
+        except RetryAfter as e:
+            self._next_edit = time.monotonic() + e.retry_after
+        except BadRequest:
+            # Unchanged text or a deleted status message; the next update will do
+            pass
+        except Exception as e:
+            print(f"Error updating download progress: {e}")
+
+    async def aclose(self):
+        """
+        Stops further edits and waits for one in flight, so it can't overwrite the next status
+        """
+        self._next_edit = float("inf")
+        if self._task:
+            await asyncio.gather(self._task, return_exceptions=True)
+
+@traced()
+async def fetch_track_audio(track_id, track_url, track_data=None, status_message=None):
+    """
+    Resolves and downloads a track into a buffer
+
+    Returns:
+        tuple: (buffer, track_data, download_url) - the caller must close the buffer
+
+    Raises:
+        DeliveryError: If the track couldn't be downloaded
+    """
+    # Upstream calls share one time budget, retries included
+    with deadline(REQUEST_DEADLINE):
+        # The metadata (if not given) and the cover for the ID3 tag are fetched while the download link resolves
+        async def tagged_metadata():
+            data = track_data or await track_metadata(track_id, track_url)
+            return data, await track_tag_async(data)
+
+        tagging = asyncio.create_task(tagged_metadata())
+        try:
+            download_url = await download_track_async(track_url)
+            if not download_url:
+                raise DeliveryError("❌ Failed to get download link.")
+            track_data, tag = await tagging
+        finally:
+            tagging.cancel()
+        if not track_data:
+            raise DeliveryError("❌ Failed to get track information.")
+    
+        # Stream the file into a buffer (never written to downloads/), showing progress in the status message.
+        # Files too large to send (or to re-encode to fit), or error pages posing as audio, are dropped before the transfer.
+        # The ID3 tag (with cover art) is written into the buffer ahead of the audio.
+        progress = StatusProgress(status_message) if status_message else None
+        max_bytes = max(UPLOAD_LIMIT, TRANSCODE_MAX_SOURCE) if transcoder else UPLOAD_LIMIT
+        try:
+            audio = await download_to_buffer_async(download_url, on_progress=progress, max_bytes=max_bytes, tag=tag)
+        except TransferRejectedError as e:
+            if e.reason == "too_large":
+                raise DeliveryError(TOO_LARGE_MESSAGE)
+            raise DeliveryError("⚠️ The download source returned an invalid file. Please try again later or try a different track.")
+        finally:
+            if progress:
+                await progress.aclose()
+        if not audio:
+            # Don't provide direct download link to user
+            raise DeliveryError("⚠️ Failed to download the track. Please try again later or try a different track.")
+    
+    return audio, track_data, download_url
+
+def open_stored_track(track_id):
+    """
+    Opens the stored copy of a track to send, preferring a re-encoded variant
+
+    Returns:
+        tuple: (file, entry, profile) - profile is None for the file as downloaded - or None if nothing is stored
+    """
+    if audio_store is None:
+        return None
+    profiles = []
+    if transcoder:
+        # A "fit" variant only exists for tracks too large for any other encode to be sent
+        profiles = ["fit", TRANSCODE_PROFILE] if TRANSCODE_PROFILE else ["fit"]
+    stored = audio_store.open_first([variant_key(track_id, profile) for profile in profiles] + [track_id])
+    if stored is None:
+        return None
+    audio, entry, key = stored
+    return audio, entry, key.partition("@")[2] or None
+
+async def prepare_upload(track_id, audio, track_data, source_url, profile=None, status_message=None):
+    """
+    Re-encodes a track that's over the upload limit, or that TRANSCODE_PROFILE asks to shrink
+
+    The caller should add the result to the audio store under the track and
+    the returned profile, so it's only encoded once.
+
+    Args:
+        audio: The track's audio, as downloaded or already re-encoded
+        profile (str): Profile audio is already encoded with (None if as downloaded)
+
+    Returns:
+        tuple: (file to send, profile to store it under) - the file is audio
+            itself or the variant, the profile None if there's nothing new to store
+    """
+    if transcoder is None:
+        return audio, None
+    file_size = audio.seek(0, os.SEEK_END)
+    audio.seek(0)
+    if file_size > UPLOAD_LIMIT:
+        target = "fit"
+    elif TRANSCODE_PROFILE and profile is None:
+        target = TRANSCODE_PROFILE
+    else:
+        return audio, None
+
+    if target == "fit" and status_message:
+        await status_message.edit_text("🎛 Track is over Telegram's size limit, re-encoding it to fit...")
+    try:
+        with STAGE_SECONDS.time(stage="transcode"), span("transcode", profile=target, bytes=file_size) as transcode_span:
+            if target == "fit":
+                variant = await transcoder.fit(audio, UPLOAD_LIMIT)
+            else:
+                variant = await transcoder.transcode(audio, target)
+            variant_size = variant.seek(0, os.SEEK_END)
+            variant.seek(0)
+            transcode_span.set("output_bytes", variant_size)
+    except TranscodeError as e:
+        # Send the original if it fits; the caller refuses it otherwise
+        print(f"Could not re-encode track {track_id} ({target}): {e}")
+        record_error("transcode", e)
+        return audio, None
+
+    if variant_size >= file_size:
+        # Already at or below the profile's bitrate; the store dedupes the original under the variant's key
+        variant.close()
+        return audio, target
+    return variant, target
+
+def keep_track_copies(copies, files, source_url, track_data):
+    """
+    Adds a delivered track's buffers to the audio store, then closes files
+
+    Args:
+        copies (list): (store key, buffer) pairs to add
+        files (list): Every buffer the delivery opened
+    """
+    try:
+        for key, buffer in copies:
+            store_track_buffer(key, buffer, source_url, track_data)
+    finally:
+        for f in files:
+            f.close()
+
+@traced()
+async def deliver_track(message, track_id, track_url, track_data=None, status_message=None):
+    """
+    Resolves, downloads and sends one track as an audio reply
+
+    Args:
+        message (telegram.Message): Message to reply to
+        track_id (str): Spotify track ID
+        track_url (str): Spotify track URL
+        track_data (dict): Track metadata if already known
+        status_message (telegram.Message): Optional status message to keep updated
+
+    Raises:
+        DeliveryError: If the track couldn't be sent
+    """
+    # Tracks in the audio store are sent without any upstream call
+    stored = await asyncio.to_thread(open_stored_track, track_id)
+    # Buffers to add to the audio store; they're written after the upload so the disk write isn't part of the wait
+    copies = []
+    if stored and (track_data or stored[1]['metadata']):
+        audio, entry, profile = stored
+        track_data = track_data or entry['metadata']
+        source_url = entry['source_url']
+    else:
+        if stored:
+            stored[0].close()
+        audio, track_data, source_url = await fetch_track_audio(track_id, track_url, track_data, status_message)
+        profile = None
+        copies.append((track_id, audio))
+    filename = track_filename(track_data)
+    
+    try:
+        upload, target = await prepare_upload(track_id, audio, track_data, source_url, profile, status_message)
+    except BaseException:
+        audio.close()
+        raise
+    if target:
+        copies.append((variant_key(track_id, target), upload))
+    
+    try:
+        await send_track_audio(message, track_id, upload, track_data, filename, status_message)
+    finally:
+        # The buffers (and any spooled temp files) are dropped once stored
+        await asyncio.to_thread(keep_track_copies, copies, [audio, upload], source_url, track_data)
+
+async def send_track_audio(message, track_id, audio, track_data, filename, status_message=None):
+    """
+    Uploads a track as an audio reply and remembers its file_id
+
+    Raises:
+        DeliveryError: If the track couldn't be sent
+    """
+    # Stored files may predate a lower limit, and re-encoding may have failed or been unavailable
+    file_size = audio.seek(0, os.SEEK_END)
+    audio.seek(0)
+    if file_size > UPLOAD_LIMIT:
+        record_error("upload", "too_large")
+        raise DeliveryError(TOO_LARGE_MESSAGE)
+    
+    # Send the audio file, with a thumbnail small enough for Telegram to accept
+    if status_message:
+        await status_message.edit_text("✅ Track downloaded! Sending file...")
+    thumbnail = await cover_cache.aget(track_data.get('cover_url'), "thumb") if cover_cache else None
+    
+    try:
+        with STAGE_SECONDS.time(stage="upload"), span("reply_audio", bytes=file_size):
+            sent = await message.reply_audio(
+                audio=audio,
+                filename=f"{filename}.mp3",
+                title=track_data['name'],
+                performer=track_data['artist'],
+                caption=f"🎵 {track_data['name']} - {track_data['artist']}",
+                thumbnail=thumbnail
+            )
+    except Exception as e:
+        print(f"Error sending audio: {e}")
+        record_error("upload", e)
+        # Don't provide direct download link to user
+        raise DeliveryError(
+            "⚠️ The track is too large to send directly through Telegram.\n"
+            "Please try a different track or contact the bot owner for assistance."
+        )
+    
+    if sent and sent.audio:
+        await file_id_cache.aset(track_id, {
+            'file_id': sent.audio.file_id,
+            'title': track_data['name'],
+            'performer': track_data['artist']
+        })
+
+@traced()
+async def queue_download(message, user_id, track_id, track_url, track_data=None, status_message=None):
+    """
+    Delivers a track through the download queue, once per track at a time
+
+    If the same track is already being downloaded for someone else, this waits
+    for that download instead of queueing another one, then re-sends the
+    uploaded copy by its file_id. That also keeps concurrent requests from
+    writing the same file.
+
+    Raises:
+        QueueFullError: If the download queue is full
+        DeliveryError: If the track couldn't be sent
+    """
+    leader = False
+    
+    async def download():
+        nonlocal leader
+        leader = True
+        
+        async def run():
+            if position and status_message:
+                await status_message.edit_text("🔄 Downloading track... Please wait, this may take a moment.")
+            await deliver_track(message, track_id, track_url, track_data=track_data, status_message=status_message)
+        
+        # All downloads go through the shared queue so bursts can't open unlimited transfers
+        job, position = download_queue.submit(user_id, run)
+        if position and status_message:
+            await status_message.edit_text(f"⏳ You're in the queue (position {position}). Your download will start soon.")
+        await job
+    
+    await track_flights.acall(track_id, download)
+    
+    # Someone else's request did the upload; send their copy
+    if not leader and not await send_cached_audio(message, track_id):
+        raise DeliveryError("⚠️ Failed to download the track. Please try again later or try a different track.")
+
+@traced()
+async def enqueue_download(message, user_id, track_id, track_url, track_data=None, status_message=None):
+    """
+    Hands a track to the worker processes through the job broker
+
+    The job carries everything a worker needs to reply on its own: the chat,
+    the message to reply to, the status message to update and any metadata
+    already known.
+    """
+    if track_data is None:
+        hit, context = await track_contexts.aget(track_id)
+        track_data = context['metadata'] if hit and context else None
+    
+    # The worker continues this update's trace
+    trace = current_span()
+    await asyncio.to_thread(job_broker.enqueue, {
+        'trace_id': trace.trace_id,
+        'parent_span_id': trace.span_id,
+        'chat_id': message.chat_id,
+        'message_id': message.message_id,
+        'status_message_id': status_message.message_id if status_message else None,
+        'user_id': user_id,
+        'track_id': track_id,
+        'track_url': track_url,
+        'track_data': track_data
+    })
+
+@traced()
+async def process_spotify_collection(update, collection_url):
+    """
+    Sends every track of an album or playlist, several at a time
+
+    Tracks go through a bounded worker pool (metadata, link resolution and
+    download run concurrently across tracks) and are sent as soon as each one
+    is ready, while a single status message shows overall progress.
+    """
+    kind, _ = extract_collection(collection_url)
+    status_message = await update.message.reply_text(f"🔄 Fetching {kind} tracks...")
+    
+    with deadline(REQUEST_DEADLINE):
+        tracks = await get_spotify_collection_tracks_async(collection_url)
+    if not tracks:
+        await status_message.edit_text(f"❌ Failed to get {kind} information.")
+        return
+    
+    tracks = tracks[:MAX_COLLECTION_TRACKS]
+    user_id = update.effective_user.id
+    total = len(tracks)
+    workers = asyncio.Semaphore(COLLECTION_CONCURRENCY)
+    
+    async def process_track(entry):
+        track_url = entry['url'].split("?")[0]
+        track_id = extract_track_id(track_url)
+        async with workers:
+            if await send_cached_audio(update.message, track_id):
+                return True
+            track_data = entry if 'name' in entry and 'artist' in entry else await get_spotify_track_metadata_async(track_url)
+            try:
+                await queue_download(update.message, user_id, track_id, track_url, track_data=track_data)
+                return True
+            except Exception as e:
+                print(f"Error sending {track_url} from {kind}: {e}")
+                return False
+    
+    if job_broker:
+        for entry in tracks:
+            track_url = entry['url'].split("?")[0]
+            track_data = entry if 'name' in entry and 'artist' in entry else None
+            await enqueue_download(update.message, user_id, extract_track_id(track_url), track_url, track_data=track_data)
+        await status_message.edit_text(f"⏳ {total} tracks from this {kind} are queued. They'll arrive as each one finishes.")
+        return
+    
+    sent, failed = 0, 0
+    last_edit = 0
+    for finished in asyncio.as_completed([process_track(entry) for entry in tracks]):
+        if await finished:
+            sent += 1
+        else:
+            failed += 1
+        
+        # Telegram rate-limits message edits, so update progress every few seconds at most
+        done = sent + failed
+        if done == total or time.monotonic() - last_edit < PROGRESS_EDIT_INTERVAL:
+            continue
+        last_edit = time.monotonic()
+        progress = f"⬇️ Downloading {kind}: {done}/{total} done"
+        if failed:
+            progress += f" ({failed} failed)"
+        try:
+            await status_message.edit_text(progress)
+        except BadRequest:
+            pass  # "message is not modified"
+    
+    summary = f"✅ Finished {kind}: {sent}/{total} tracks sent."
+    if failed:
+        summary += f"\n⚠️ {failed} tracks could not be downloaded."
+    await status_message.edit_text(summary)
+
+@traced()
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     keyboard = [
         [InlineKeyboardButton("🔍 How to Use", callback_data='help')],
@@ -26,6 +631,7 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode='MarkdownV2'
     )
 
+@traced()
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE, is_callback=False):
     keyboard = [
         [InlineKeyboardButton("🎵 Download Track", callback_data='download_info')],
@@ -37,7 +643,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE, is_ca
         "📖 *How to use the bot:*\n\n"
         "1️⃣ Use /download command followed by Spotify track URL\n"
         "   Example: `/download https://open\\.spotify\\.com/track/\\.\\.\\.`\n\n"
-        "2️⃣ Or simply send the Spotify track URL\n\n"
+        "2️⃣ Or simply send the Spotify track, album or playlist URL\n\n"
         "🎁 *I'll provide you with:*\n"
         "• 🎵 Track Information\n"
         "• 💿 Album Details\n"
@@ -57,6 +663,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE, is_ca
             parse_mode='MarkdownV2'
         )
 
+@traced()
 async def download_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args:
         keyboard = [
@@ -75,7 +682,12 @@ async def download_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     track_url = context.args[0]
     await process_spotify_url(update, track_url)
 
+@traced()
 async def process_spotify_url(update, track_url):
+    if extract_collection(track_url):
+        await process_spotify_collection(update, track_url)
+        return
+    
     if "open.spotify.com/track/" not in track_url:
         await update.message.reply_text("❌ Please provide a valid Spotify track URL.")
         return
@@ -83,11 +695,15 @@ async def process_spotify_url(update, track_url):
     status_message = await update.message.reply_text("🔄 Processing your request...")
     
     # Extract track ID from URL to use in callback data
-    track_id = track_url.split("/track/")[1].split("?")[0]
+    track_id = extract_track_id(track_url)
     
-    track_data = get_spotify_track_metadata(track_url)
+    with deadline(REQUEST_DEADLINE):
+        track_data = await get_spotify_track_metadata_async(track_url)
     
     if track_data:
+        # Remember the metadata so the download step doesn't fetch it again
+        await track_contexts.aset(track_id, {'track_url': track_url, 'metadata': track_data})
+        
         # Create inline keyboard for download with shortened callback data
         keyboard = [
             [InlineKeyboardButton("⬇️ Download Track", callback_data=f'get_link_{track_id}')],
@@ -105,8 +721,9 @@ async def process_spotify_url(update, track_url):
         )
         
         await status_message.delete()
-        await update.message.reply_photo(
-            photo=track_data['cover_url'],
+        await reply_cover_photo(
+            update.message,
+            track_data['cover_url'],
             caption=info_text,
             reply_markup=reply_markup,
             parse_mode='MarkdownV2'
@@ -114,6 +731,7 @@ async def process_spotify_url(update, track_url):
     else:
         await status_message.edit_text("❌ Failed to get track information.")
 
+@traced()
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -158,70 +776,36 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Reconstruct full URL
         track_url = f"https://open.spotify.com/track/{track_id}"
         
+        # Popular tracks were already uploaded once; reuse Telegram's copy
+        if await send_cached_audio(query.message, track_id):
+            return
+        
         status_message = await query.message.reply_text("🔄 Downloading track... Please wait, this may take a moment.")
         
+        # Split deployment: hand the job to a worker process, which replies to the chat itself
+        if job_broker:
+            await enqueue_download(query.message, update.effective_user.id, track_id, track_url, status_message=status_message)
+            await status_message.edit_text("⏳ Your download is queued and will start shortly.")
+            return
+        
         try:
-            # Get the download URL
-            download_url = download_track(track_url)
-            
-            if download_url:
-                # Get track metadata for filename
-                track_data = get_spotify_track_metadata(track_url)
-                if not track_data:
-                    await status_message.edit_text("❌ Failed to get track information.")
-                    return
-                
-                # Create a clean filename
-                filename = f"{track_data['name']} - {track_data['artist']}"
-                # Remove characters that are invalid in filenames
-                filename = "".join(c for c in filename if c not in r'<>:"/\|?*')
-                
-                # Download the file
-                filepath = download_file(download_url, filename)
-                
-                if filepath:
-                    # Check file size before sending (Telegram limit is 50MB)
-                    file_size = os.path.getsize(filepath)
-                    if file_size > 50 * 1024 * 1024:  # 50MB in bytes
-                        await status_message.edit_text(
-                            "⚠️ The track is too large to send through Telegram (>50MB).\n"
-                            "Please try a different track or contact the bot owner for assistance."
-                        )
-                        return
-                    
-                    # Send the audio file
-                    await status_message.edit_text("✅ Track downloaded! Sending file...")
-                    
-                    try:
-                        with open(filepath, 'rb') as audio:
-                            await query.message.reply_audio(
-                                audio=audio,
-                                title=track_data['name'],
-                                performer=track_data['artist'],
-                                caption=f"🎵 {track_data['name']} - {track_data['artist']}",
-                                thumbnail=track_data['cover_url'] if 'cover_url' in track_data else None
-                            )
-                        await status_message.delete()
-                    except Exception as e:
-                        print(f"Error sending audio: {e}")
-                        # Don't provide direct download link to user
-                        await status_message.edit_text(
-                            "⚠️ The track is too large to send directly through Telegram.\n"
-                            "Please try a different track or contact the bot owner for assistance."
-                        )
-                else:
-                    # Don't provide direct download link to user
-                    await status_message.edit_text(
-                        "⚠️ Failed to download the track. Please try again later or try a different track."
-                    )
-            else:
-                await status_message.edit_text("❌ Failed to get download link.")
+            await queue_download(query.message, update.effective_user.id, track_id, track_url, status_message=status_message)
+            await status_message.delete()
+        except QueueFullError:
+            await status_message.edit_text(
+                "🚦 The bot is very busy right now and the download queue is full.\n"
+                "Please try again in a minute."
+            )
+        except DeliveryError as e:
+            await status_message.edit_text(str(e))
         except Exception as e:
             print(f"Error in download process: {e}")
+            record_error("bot", e)
             await status_message.edit_text("❌ An error occurred during download.")
 
+@traced()
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if "open.spotify.com/track/" in update.message.text:
+    if "open.spotify.com/track/" in update.message.text or extract_collection(update.message.text):
         await process_spotify_url(update, update.message.text)
     else:
         keyboard = [
@@ -236,6 +820,27 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             parse_mode='MarkdownV2'
         )
 
+@traced()
+async def queue_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if job_broker:
+        stats = await asyncio.to_thread(job_broker.stats)
+        await update.message.reply_text(
+            "📊 Download queue\n\n"
+            f"Waiting: {stats['ready']}\n"
+            f"Being downloaded: {stats['reserved']}\n"
+            f"Given up: {stats['dead']}"
+        )
+        return
+    
+    stats = download_queue.stats()
+    await update.message.reply_text(
+        "📊 Download queue\n\n"
+        f"Waiting: {stats['queued']} ({stats['waiting_users']} users)\n"
+        f"Running: {stats['running']}/{download_queue.workers}\n"
+        f"Wait time: p50 {stats['wait_p50']:.1f}s, p95 {stats['wait_p95']:.1f}s, max {stats['wait_max']:.1f}s\n"
+        f"Completed: {stats['completed']}, failed: {stats['failed']}, turned away: {stats['rejected']}"
+    )
+
 async def error(update: Update, context: ContextTypes.DEFAULT_TYPE):
     print(f'Update {update} caused error {context.error}')
     
@@ -251,14 +856,33 @@ async def error(update: Update, context: ContextTypes.DEFAULT_TYPE):
             parse_mode='MarkdownV2'
         )
 
+async def shutdown(app: Application):
+    await download_queue.stop()
+    await http_client.aclose()
+    http_client.close()
+
 def main():
+    if BOT_MODE == "webhook" and not WEBHOOK_URL:
+        # Without it the webhook would be registered at the listen address, which Telegram can't reach
+        raise SystemExit("Error: BOT_MODE=webhook needs WEBHOOK_URL, the public base URL Telegram should post updates to")
     print("Starting bot...")
-    app = Application.builder().token(TOKEN).build()
+    if METRICS_PORT:
+        start_metrics_server()
+    # Handle updates concurrently so one slow download doesn't hold up other chats
+    app = (
+        Application.builder()
+        .token(TOKEN)
+        .base_url(TELEGRAM_API_BASE_URL)
+        .concurrent_updates(True)
+        .post_shutdown(shutdown)
+        .build()
+    )
 
     # Commands
     app.add_handler(CommandHandler('start', start_command))
     app.add_handler(CommandHandler('help', help_command))
     app.add_handler(CommandHandler('download', download_command))
+    app.add_handler(CommandHandler('queue', queue_command))
     
     # Callback queries
     app.add_handler(CallbackQueryHandler(button_callback))
@@ -269,8 +893,22 @@ def main():
     # Error handler
     app.add_error_handler(error)
     
-    print("Bot is running...")
-    app.run_polling(poll_interval=1)
+    if BOT_MODE == "webhook":
+        if not WEBHOOK_SECRET:
+            print("Warning: WEBHOOK_SECRET is not set, anyone who finds the webhook URL can send updates")
+        print(f"Bot is running (webhook on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH})...")
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}"
+        )
+    else:
+        print("Bot is running...")
+        # Long polling returns as soon as an update arrives, so don't sleep between polls
+        app.run_polling(poll_interval=0, timeout=30)
 
 if __name__ == '__main__':
     main()
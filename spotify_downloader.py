@@ -1,13 +1,235 @@
-import requests
+import httpx
+import argparse
+import asyncio
 import json
 import os
-import zstandard as zstd
-import brotli
+import re
+import sqlite3
+import sys
+import tempfile
+import threading
 import time  # Add this for timing operations
+import contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from http_pool import PooledClient
+from cache import TieredCache
+from audio_store import AudioStore
+from audio_format import is_document_type, looks_like_document
+from covers import PIL_AVAILABLE, CoverCache
+from tagging import build_tag, seal_tag
+from singleflight import SingleFlight
+from resolvers import Resolver, ResolverRouter
+from rate_limit import RateLimiter
+from metrics import IN_FLIGHT, METRICS_PORT, STAGE_SECONDS, record_error, record_transfer, start_metrics_server, watch_audio_store, watch_cache
+from decoding import ACCEPT_ENCODING, aread_json, read_json
+from tracing import span, traced
+from progress import Progress, print_progress_bar, print_progress_line
+from resilience import (
+    CircuitBreaker, DeadlineExceededError, RetryPolicy, acall_with_retry, budget_timeout, call_with_retry, deadline,
+    raise_for_retryable_status, remaining_budget
+)
 
-# Set global timeout for all requests
-REQUEST_TIMEOUT = 15  # seconds
+# Timeouts for every request: connecting fails fast, reading waits for slow servers
+CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", 5))  # seconds
+READ_TIMEOUT = float(os.environ.get("HTTP_READ_TIMEOUT", 15))  # seconds
+REQUEST_TIMEOUT = httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT)
 
+# Total time budget for one user request (metadata, link and download), retries included
+REQUEST_DEADLINE = float(os.environ.get("REQUEST_DEADLINE", 120))  # seconds
+
+# Retries for network errors, timeouts, 5xx and 429, with jittered exponential backoff
+retry_policy = RetryPolicy(
+    attempts=int(os.environ.get("HTTP_RETRY_ATTEMPTS", 3)),
+    base_delay=float(os.environ.get("HTTP_RETRY_BASE_DELAY", 0.5)),
+    max_delay=float(os.environ.get("HTTP_RETRY_MAX_DELAY", 8))
+)
+
+# One circuit breaker per upstream endpoint, so a dead file host doesn't block metadata lookups
+breakers = {
+    name: CircuitBreaker(
+        name,
+        failure_threshold=int(os.environ.get("CIRCUIT_FAILURE_THRESHOLD", 5)),
+        reset_timeout=float(os.environ.get("CIRCUIT_RESET_TIMEOUT", 30))
+    )
+    for name in ("get-metadata", "download-track", "files")
+}
+
+# Paces spotydown API calls per host, learning the sustainable rate from 429s and Retry-After;
+# set RATE_LIMIT_DB to share the budget between processes (e.g. bot workers)
+rate_limiter = RateLimiter(
+    rate=float(os.environ.get("RATE_LIMIT_RPS", 5)),
+    burst=int(os.environ.get("RATE_LIMIT_BURST", 10)),
+    min_rate=float(os.environ.get("RATE_LIMIT_MIN_RPS", 0.5)),
+    max_rate=float(os.environ.get("RATE_LIMIT_MAX_RPS", 20)),
+    db_path=os.environ.get("RATE_LIMIT_DB") or None
+)
+
+# Downloads streamed to Telegram stay in memory up to this size, then spill to a temp file
+SPOOL_THRESHOLD = int(os.environ.get("SPOOL_THRESHOLD", 20 * 1024 * 1024))  # bytes
+
+# Base URL of the spotydown API (override to point at a local stub server)
+SPOTYDOWN_BASE_URL = os.environ.get("SPOTYDOWN_BASE_URL", "https://spotydown.com")
+
+# One keep-alive connection pool shared by every spotydown and file host request
+http_client = PooledClient(
+    max_connections_per_host=int(os.environ.get("HTTP_MAX_CONNECTIONS_PER_HOST", 10)),
+    keepalive_expiry=float(os.environ.get("HTTP_KEEPALIVE_EXPIRY", 30)),
+    timeout=REQUEST_TIMEOUT
+)
+
+# Track metadata cache: in-memory LRU backed by SQLite so it survives restarts
+CACHE_DIR = os.environ.get("CACHE_DIR", "cache")
+metadata_cache = TieredCache(
+    "metadata",
+    db_path=os.environ.get("METADATA_CACHE_DB", os.path.join(CACHE_DIR, "metadata.sqlite3")) or None,
+    ttl=float(os.environ.get("METADATA_CACHE_TTL", 24 * 60 * 60)),
+    negative_ttl=float(os.environ.get("METADATA_NEGATIVE_TTL", 5 * 60)),
+    max_entries=int(os.environ.get("METADATA_CACHE_SIZE", 10000))
+)
+
+# Downloaded audio, kept by track ID and content hash within a disk budget and shared by
+# the CLI, the bot and its workers ("" = don't keep audio)
+AUDIO_STORE_DIR = os.environ.get("AUDIO_STORE_DIR", os.path.join(CACHE_DIR, "audio"))
+audio_store = AudioStore(
+    AUDIO_STORE_DIR,
+    max_bytes=int(os.environ.get("AUDIO_STORE_MAX_BYTES", 5 * 1024 * 1024 * 1024)) or None,
+    policy=os.environ.get("AUDIO_STORE_POLICY", "lru")
+) if AUDIO_STORE_DIR else None
+
+# Downloads get ID3 tags (title, artist, album and cover art) written in front of the audio
+TAG_DOWNLOADS = os.environ.get("TAG_DOWNLOADS", "1") != "0"
+
+# Cover art for tags, info cards and audio thumbnails, fetched once per URL and resized
+# ("" = don't embed covers; the bot then links the original images)
+COVER_CACHE_DIR = os.environ.get("COVER_CACHE_DIR", os.path.join(CACHE_DIR, "covers"))
+cover_cache = CoverCache(
+    COVER_CACHE_DIR,
+    http_client,
+    size=int(os.environ.get("COVER_SIZE", 600)),  # pixels
+    thumbnail_size=int(os.environ.get("COVER_THUMBNAIL_SIZE", 320))  # Telegram's limit for audio thumbnails
+) if COVER_CACHE_DIR else None
+if cover_cache and not PIL_AVAILABLE:
+    print("Pillow isn't installed; covers are used at their original size, and audio thumbnails are only sent for covers already within Telegram's limits")
+
+TRACK_ID_PATTERN = re.compile(r"(?:open\.spotify\.com/(?:intl-[\w-]+/)?track/|spotify:track:)([A-Za-z0-9]+)")
+
+def extract_track_id(track_url):
+    """
+    Extracts the normalized Spotify track ID from a track URL or URI
+
+    Args:
+        track_url (str): A Spotify track URL (open.spotify.com/track/...) or spotify:track: URI
+
+    Returns:
+        str: The track ID or None if the URL isn't a track link
+    """
+    match = TRACK_ID_PATTERN.search(track_url or "")
+    return match.group(1) if match else None
+
+COLLECTION_PATTERN = re.compile(r"(?:open\.spotify\.com/(?:intl-[\w-]+/)?|spotify:)(album|playlist)[/:]([A-Za-z0-9]+)")
+
+def extract_collection(collection_url):
+    """
+    Recognises Spotify album and playlist links
+
+    Args:
+        collection_url (str): A Spotify album/playlist URL or URI
+
+    Returns:
+        tuple: (kind, collection_id) where kind is "album" or "playlist", or None
+    """
+    match = COLLECTION_PATTERN.search(collection_url or "")
+    return (match.group(1), match.group(2)) if match else None
+
+# Fields a single-track lookup returns; the info card and save_track_info rely on all of them
+TRACK_METADATA_FIELDS = ("name", "artist", "album_name", "album_artist", "cover_url", "url")
+
+def _collection_tracks(data):
+    """
+    Pulls the track list out of a get-metadata response for an album or playlist
+    """
+    if not data or "apiResponse" not in data or not data["apiResponse"].get("data"):
+        return None
+    return [track for track in data["apiResponse"]["data"] if extract_track_id(track.get("url"))]
+
+def _complete_tracks(tracks):
+    """
+    Returns (track_id, metadata) for the collection entries that are as complete
+    as a single-track lookup, so they can be cached under the per-track key;
+    partial entries are left for the per-track lookup to fetch
+    """
+    return [
+        (extract_track_id(track["url"]), track)
+        for track in tracks
+        if all(track.get(field) for field in TRACK_METADATA_FIELDS)
+    ]
+
+def _cache_metadata(track_id, track_data):
+    if track_id:
+        metadata_cache.set(track_id, track_data)
+
+async def _acache_metadata(track_id, track_data):
+    if track_id:
+        await metadata_cache.aset(track_id, track_data)
+
+# Identical in-flight requests (same track or same output file) share one upstream call
+inflight = SingleFlight()
+
+watch_cache("metadata", metadata_cache)
+if audio_store is not None:
+    watch_audio_store(audio_store)
+IN_FLIGHT.set_function(inflight.in_flight, kind="upstream_calls")
+IN_FLIGHT.set_function(lambda: http_client.stats()["active"], kind="http_connections")
+
+def _spotydown_headers():
+    """
+    Builds the request headers expected by the spotydown.com API
+    """
+    return {
+        "Accept": "*/*",
+        "Accept-Encoding": ACCEPT_ENCODING,
+        "Accept-Language": "en-US,en;q=0.9",
+        "Content-Type": "application/json",
+        "Origin": SPOTYDOWN_BASE_URL,
+        "Referer": f"{SPOTYDOWN_BASE_URL}/",
+        "User-Agent": "Mozilla/5.0 (Linux; Android 13; Pixel 7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/136.0.0.0 Mobile Safari/537.36 Edg/136.0.0.0"
+    }
+
+def _post_json(endpoint, payload, check_status=False):
+    """
+    POSTs a JSON payload to the spotydown API and decodes the JSON answer
+
+    The raw body is decompressed and parsed in one pass by decoding.py, so
+    every encoding advertised in Accept-Encoding is handled the same way.
+    Calls are paced by the per-host rate limiter, go through the endpoint's
+    circuit breaker and are retried on network errors, 5xx and 429.
+
+    Args:
+        endpoint (str): The API endpoint, e.g. "get-metadata"
+        payload (dict): The request body
+        check_status (bool): Raise httpx.HTTPStatusError for 4xx responses too
+
+    Returns:
+        dict: Parsed JSON or None if the body can't be decoded
+    """
+    request_url = f"{SPOTYDOWN_BASE_URL}/api/{endpoint}"
+
+    def attempt():
+        with span(f"POST /api/{endpoint}") as request_span:
+            with span("rate_limit_wait"):
+                if not rate_limiter.acquire(request_url, max_wait=remaining_budget()):
+                    raise DeadlineExceededError("rate limit wait exceeds the request deadline")
+            with http_client.stream("POST", request_url, headers=_spotydown_headers(), json=payload, timeout=budget_timeout(REQUEST_TIMEOUT)) as response:
+                request_span.set("status_code", response.status_code)
+                rate_limiter.record(request_url, response)
+                raise_for_retryable_status(response)
+                if check_status:
+                    response.raise_for_status()
+                return read_json(response)
+    return call_with_retry(breakers[endpoint], attempt, retry_policy)
+
+@traced()
 def get_spotify_track_metadata(track_url):
     """
     Fetches metadata for a Spotify track using the spotydown.com API
@@ -19,18 +241,13 @@ def get_spotify_track_metadata(track_url):
         dict: Track metadata or None if request fails
     """
     start_time = time.time()  # Track start time
-    request_url = "https://spotydown.com/api/get-metadata"
 
-    headers = {
-        "Host": "spotydown.com",
-        "Accept": "*/*",
-        "Accept-Encoding": "gzip, deflate",
-        "Accept-Language": "en-US,en;q=0.9",
-        "Content-Type": "application/json",
-        "Origin": "https://spotydown.com",
-        "Referer": "https://spotydown.com/",
-        "User-Agent": "Mozilla/5.0 (Linux; Android 13; Pixel 7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/136.0.0.0 Mobile Safari/537.36 Edg/136.0.0.0"
-    }
+    track_id = extract_track_id(track_url)
+    if track_id:
+        hit, cached = metadata_cache.get(track_id)
+        if hit:
+            print(f"Metadata served from cache")
+            return cached
 
     # Clean the URL by removing any query parameters
     if "?" in track_url:
@@ -40,53 +257,63 @@ def get_spotify_track_metadata(track_url):
     
     try:
         print(f"Fetching track metadata...")
-        response = requests.post(
-            request_url, 
-            headers=headers, 
-            json=request_payload,
-            timeout=REQUEST_TIMEOUT  # Add timeout
-        )
-        
-        # Try multiple approaches to decode the response
-        data = None
-        
-        # First try: Let requests handle it automatically
-        try:
-            data = response.json()
-        except json.JSONDecodeError:
-            # Second try: If content-encoding is brotli, try manual decompression
-            if 'content-encoding' in response.headers and 'br' in response.headers['content-encoding'].lower():
-                try:
-                    decompressed_data = brotli.decompress(response.content)
-                    data = json.loads(decompressed_data)
-                except Exception:
-                    # Third try: Try to use requests built-in content decoding
-                    try:
-                        data = json.loads(response.text)
-                    except json.JSONDecodeError:
-                        # Fourth try: Try a different approach with raw content
-                        try:
-                            raw_text = response.content.decode('utf-8', errors='ignore')
-                            data = json.loads(raw_text)
-                        except Exception:
-                            return None
-        
+        with STAGE_SECONDS.time(stage="metadata"):
+            data = _post_json("get-metadata", request_payload)
         if data is None:
             return None
             
         if "apiResponse" in data and "data" in data["apiResponse"] and len(data["apiResponse"]["data"]) > 0:
             elapsed_time = time.time() - start_time
             print(f"Metadata fetched in {elapsed_time:.2f} seconds")
+            _cache_metadata(track_id, data["apiResponse"]["data"][0])
             return data["apiResponse"]["data"][0]
         else:
             print(f"Error: Unexpected response format")
+            record_error("metadata", "unexpected_response")
+            _cache_metadata(track_id, None)
             return None
             
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         print(f"Error making request: {e}")
+        record_error("metadata", e)
         return None
     except Exception as e:
         print(f"Unexpected error: {str(e)}")
+        record_error("metadata", e)
+        return None
+
+@traced()
+def get_spotify_collection_tracks(collection_url):
+    """
+    Expands a Spotify album or playlist URL into its tracks
+
+    Args:
+        collection_url (str): The Spotify album or playlist URL
+
+    Returns:
+        list: Track metadata dicts (each with a track "url") or None if request fails
+    """
+    start_time = time.time()
+
+    # Clean the URL by removing any query parameters
+    collection_url = collection_url.split("?")[0]
+
+    try:
+        print(f"Fetching album/playlist tracks...")
+        tracks = _collection_tracks(_post_json("get-metadata", {"url": collection_url}))
+        if not tracks:
+            print(f"Error: Unexpected response format")
+            return None
+        # Complete entries save a per-track lookup later
+        for track_id, track in _complete_tracks(tracks):
+            _cache_metadata(track_id, track)
+
+        elapsed_time = time.time() - start_time
+        print(f"{len(tracks)} tracks fetched in {elapsed_time:.2f} seconds")
+        return tracks
+    except Exception as e:
+        print(f"Error fetching album/playlist: {str(e)}")
+        record_error("collection", e)
         return None
 
 def save_track_info(track_data, output_dir="downloads"):
@@ -117,9 +344,68 @@ def save_track_info(track_data, output_dir="downloads"):
     print(f"Track information saved to {filepath}")
     return filepath
 
+def track_tag(track_data):
+    """
+    Builds the ID3 tag for a track, fetching its cover art if needed
+
+    Returns:
+        bytes: The tag, or None if tagging is off
+    """
+    if not TAG_DOWNLOADS or not track_data:
+        return None
+    cover = cover_cache.get(track_data.get('cover_url')) if cover_cache else None
+    return build_tag(track_data, cover)
+
+async def track_tag_async(track_data):
+    """
+    Async version of track_tag
+    """
+    if not TAG_DOWNLOADS or not track_data:
+        return None
+    cover = await cover_cache.aget(track_data.get('cover_url')) if cover_cache else None
+    return build_tag(track_data, cover)
+
+def _seal_part(part_path, tag):
+    # The audio was written after room reserved for the tag; put the tag in that room
+    with open(part_path, 'r+b') as f:
+        f.write(tag)
+        seal_tag(f, tag)
+
+def _file_url(data):
+    if data is None:
+        return None
+    if "file_url" in data:
+        return data["file_url"]
+    print("Error: No download URL in response")
+    return None
+
+class SpotydownResolver(Resolver):
+    """
+    Gets download links from the spotydown.com download-track API
+    """
+
+    name = "spotydown"
+
+    def resolve(self, track_url):
+        return _file_url(_post_json("download-track", {"url": track_url}, check_status=True))
+
+    async def aresolve(self, track_url):
+        return _file_url(await _post_json_async("download-track", {"url": track_url}, check_status=True))
+
+# Download link backends by name; RESOLVERS lists the ones to route between
+RESOLVER_BACKENDS = {
+    "spotydown": SpotydownResolver
+}
+resolver_router = ResolverRouter(
+    [RESOLVER_BACKENDS[name.strip()]() for name in os.environ.get("RESOLVERS", "spotydown").split(",")],
+    hedge=os.environ.get("HEDGE_REQUESTS", "1") != "0",  # only with more than one backend
+    default_hedge_delay=float(os.environ.get("HEDGE_DEFAULT_DELAY", 2))
+)
+
+@traced()
 def download_track(track_url):
     """
-    Downloads the track using spotydown.com API
+    Gets the download URL for a track from the resolver backends
     
     Args:
         track_url (str): The Spotify track URL
@@ -128,181 +414,1027 @@ def download_track(track_url):
         str: Download URL or None if request fails
     """
     start_time = time.time()  # Track start time
-    request_url = "https://spotydown.com/api/download-track"
-
-    headers = {
-        "Host": "spotydown.com",
-        "Accept": "*/*",
-        "Accept-Encoding": "gzip, deflate",
-        "Accept-Language": "en-US,en;q=0.9",
-        "Content-Type": "application/json",
-        "Origin": "https://spotydown.com",
-        "Referer": "https://spotydown.com/",
-        "User-Agent": "Mozilla/5.0 (Linux; Android 13; Pixel 7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/136.0.0.0 Mobile Safari/537.36 Edg/136.0.0.0"
-    }
-
-    request_payload = {"url": track_url}
     
     try:
         print("Getting download link...")
-        response = requests.post(
-            request_url, 
-            headers=headers, 
-            json=request_payload,
-            timeout=REQUEST_TIMEOUT  # Add timeout
-        )
-        response.raise_for_status()
-        
-        # Try multiple approaches to decode the response
-        data = None
-        
-        # First try: Let requests handle it automatically
-        try:
-            data = response.json()
-        except json.JSONDecodeError:
-            # Second try: If content-encoding is brotli, try manual decompression
-            if 'content-encoding' in response.headers and 'br' in response.headers['content-encoding'].lower():
-                try:
-                    decompressed_data = brotli.decompress(response.content)
-                    data = json.loads(decompressed_data)
-                except Exception:
-                    # Third try: Try to use requests built-in content decoding
-                    try:
-                        data = json.loads(response.text)
-                    except json.JSONDecodeError:
-                        # Fourth try: Try a different approach with raw content
-                        try:
-                            raw_text = response.content.decode('utf-8', errors='ignore')
-                            data = json.loads(raw_text)
-                        except Exception:
-                            return None
-        
-        if data is None:
+        with STAGE_SECONDS.time(stage="link"):
+            download_url = resolver_router.resolve(track_url)
+        if download_url is None:
+            record_error("link", "no_result")
             return None
         
-        if "file_url" in data:
-            elapsed_time = time.time() - start_time
-            print(f"Download link obtained in {elapsed_time:.2f} seconds")
-            return data["file_url"]
-        else:
-            print("Error: No download URL in response")
-            return None
+        elapsed_time = time.time() - start_time
+        print(f"Download link obtained in {elapsed_time:.2f} seconds")
+        return download_url
             
     except Exception as e:
         print(f"Error getting download link: {str(e)}")
+        record_error("link", e)
         return None
 
-# Add this at the top of the file if not already present
-import time
+# Parallel ranged downloads: number of connections per file and smallest segment worth splitting
+DOWNLOAD_CONNECTIONS = int(os.environ.get("DOWNLOAD_CONNECTIONS", 4))
+MIN_SEGMENT_SIZE = 1024 * 1024  # bytes
+CHUNK_SIZE = 1024 * 1024  # 1MB chunks for faster download
+# Resume state is saved after this many new bytes, and whenever a segment completes
+RESUME_CHECKPOINT_BYTES = int(os.environ.get("RESUME_CHECKPOINT_BYTES", 4 * 1024 * 1024))
+
+class RangeNotSupportedError(Exception):
+    """
+    Raised when the server answers a Range request with the whole file
+    """
+
+class TransferRejectedError(Exception):
+    """
+    Raised instead of finishing a download that can't be used: too large to
+    deliver ("too_large") or not audio at all ("not_audio")
+    """
+
+    def __init__(self, reason, message):
+        super().__init__(message)
+        self.reason = reason
+
+def check_transfer(headers, max_bytes=None):
+    """
+    Decides from HEAD (or GET) headers whether a download is worth starting
+
+    Args:
+        headers (httpx.Headers): The response headers
+        max_bytes (int): Largest file the caller can use, or None for no limit
+
+    Raises:
+        TransferRejectedError: If the file is too large or isn't audio
+    """
+    file_size = int(headers.get('content-length') or 0)
+    if max_bytes and file_size > max_bytes:
+        raise TransferRejectedError("too_large", f"file is {file_size/1024/1024:.1f} MB, the limit is {max_bytes/1024/1024:.0f} MB")
+    content_type = headers.get('content-type', '')
+    if is_document_type(content_type):
+        raise TransferRejectedError("not_audio", f"server sent {content_type} instead of audio")
+
+def check_first_bytes(chunk):
+    """
+    Rejects a body that starts like an HTML error page or JSON answer
+
+    Raises:
+        TransferRejectedError: If the body isn't audio
+    """
+    if looks_like_document(chunk[:64]):
+        raise TransferRejectedError("not_audio", "server sent a web page instead of audio")
+
+class _RangedDownload:
+    """
+    Segment bookkeeping for one ranged download into a preallocated .part file
+
+    Progress is checkpointed to a side-car .part.json every few megabytes and
+    at the end of each segment, so a failed download resumes from the bytes
+    already on disk instead of restarting. Only bytes flushed to the .part file
+    are recorded, so the state never claims more than the file holds.
+    The body is written after `offset` bytes kept free for an ID3 tag.
+    """
+
+    def __init__(self, part_path, file_size, validator, connections, offset=0):
+        self.part_path = part_path
+        self.state_path = part_path + ".json"
+        self.file_size = file_size
+        self.validator = validator
+        self.offset = offset
+        self.downloaded_size = 0
+        self._unsaved = 0
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self.segments = self._load() or self._plan(connections)
+        self.downloaded_size = sum(segment["done"] for segment in self.segments)
+
+    def _load(self):
+        if not (os.path.exists(self.part_path) and os.path.exists(self.state_path)):
+            return None
+        try:
+            with open(self.state_path, encoding="utf-8") as f:
+                state = json.load(f)
+            # Only resume if it's the same file and the preallocated .part is intact
+            if (state["size"] != self.file_size or state["validator"] != self.validator
+                    or state.get("offset", 0) != self.offset
+                    or os.path.getsize(self.part_path) != self.offset + self.file_size):
+                return None
+            done = sum(segment["done"] for segment in state["segments"])
+            print(f"Resuming partial download ({done/1024/1024:.2f} of {self.file_size/1024/1024:.2f} MB already on disk)")
+            return state["segments"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _plan(self, connections):
+        with open(self.part_path, 'wb') as f:
+            f.truncate(self.offset + self.file_size)  # Preallocate so segments can be written in place
+
+        count = max(1, min(connections, self.file_size // MIN_SEGMENT_SIZE))
+        segment_size = -(-self.file_size // count)  # ceiling division
+        segments = []
+        for start in range(0, self.file_size, segment_size):
+            end = min(start + segment_size, self.file_size) - 1
+            segments.append({"start": start, "end": end, "done": 0})
+        self._save(segments)
+        return segments
+
+    def _save(self, segments):
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"size": self.file_size, "validator": self.validator, "offset": self.offset, "segments": segments}, f)
+        os.replace(tmp_path, self.state_path)
+
+    def pending(self):
+        """
+        Returns the segments that still have bytes to fetch
+        """
+        return [s for s in self.segments if s["start"] + s["done"] <= s["end"]]
+
+    def range_header(self, segment):
+        return {"Range": f"bytes={segment['start'] + segment['done']}-{segment['end']}"}
 
-# Set global timeout for all requests if not already defined
-REQUEST_TIMEOUT = 30  # seconds
+    def remaining(self, segment):
+        return segment["end"] - (segment["start"] + segment["done"]) + 1
 
-def download_file(url, filename, output_dir="downloads"):
+    def record(self, segment, length):
+        """
+        Marks length more bytes of a segment as written and flushed to the .part file
+
+        Returns:
+            bool: True if it's time to checkpoint
+        """
+        with self._lock:
+            segment["done"] += length
+            self.downloaded_size += length
+            self._unsaved += length
+            return self._unsaved >= RESUME_CHECKPOINT_BYTES or segment["start"] + segment["done"] > segment["end"]
+
+    def checkpoint(self):
+        """
+        Saves the segment state for a later resume (file I/O, keep it off the event loop)
+        """
+        with self._lock:
+            self._unsaved = 0
+            segments = [dict(segment) for segment in self.segments]
+        with self._save_lock:
+            self._save(segments)
+
+    def finish(self):
+        if os.path.exists(self.state_path):
+            os.remove(self.state_path)
+
+def _accepts_ranges(head_response):
+    return head_response.headers.get('accept-ranges', '').lower() == 'bytes'
+
+def _resume_validator(head_response):
+    # ETag/Last-Modified tell us whether a .part file on disk belongs to the same upstream file
+    return head_response.headers.get('etag') or head_response.headers.get('last-modified') or ""
+
+def _discard_partial(part_path):
+    for path in (part_path, part_path + ".json"):
+        if os.path.exists(path):
+            os.remove(path)
+
+def _files_call(fn):
+    # File host requests share one circuit breaker and retry policy
+    return call_with_retry(breakers["files"], fn, retry_policy)
+
+async def _afiles_call(coro_factory):
+    return await acall_with_retry(breakers["files"], coro_factory, retry_policy)
+
+def _head(url):
+    with STAGE_SECONDS.time(stage="head"), span("HEAD") as head_span:
+        response = http_client.head(url, timeout=budget_timeout(REQUEST_TIMEOUT))
+        head_span.set("status_code", response.status_code)
+    raise_for_retryable_status(response)
+    return response
+
+async def _ahead(url):
+    with STAGE_SECONDS.time(stage="head"), span("HEAD") as head_span:
+        response = await http_client.ahead(url, timeout=budget_timeout(REQUEST_TIMEOUT))
+        head_span.set("status_code", response.status_code)
+    raise_for_retryable_status(response)
+    return response
+
+@traced("GET segment")
+def _fetch_segment(url, download, segment, progress):
+    # A retried segment picks up where the failed attempt stopped
+    with http_client.stream("GET", url, headers=download.range_header(segment), timeout=budget_timeout(REQUEST_TIMEOUT)) as response:
+        raise_for_retryable_status(response)
+        if response.status_code != 206:
+            raise RangeNotSupportedError(f"expected 206 Partial Content, got {response.status_code}")
+        with open(download.part_path, 'r+b') as f:
+            f.seek(download.offset + segment["start"] + segment["done"])
+            try:
+                for chunk in response.iter_bytes(chunk_size=CHUNK_SIZE):
+                    chunk = chunk[:download.remaining(segment)]
+                    if chunk:
+                        f.write(chunk)
+                        f.flush()
+                        if download.record(segment, len(chunk)):
+                            download.checkpoint()
+                        progress.advance(len(chunk))
+            finally:
+                # Keep what this attempt got, for the retry or a later resume
+                download.checkpoint()
+
+def _download_ranged(url, part_path, file_size, head_response, connections, progress, offset=0):
+    download = _RangedDownload(part_path, file_size, _resume_validator(head_response), connections, offset)
+    progress.start(file_size, initial=download.downloaded_size)
+    pending = download.pending()
+    print(f"Downloading in {len(pending)} parallel range requests...")
+    with ThreadPoolExecutor(max_workers=max(1, len(pending))) as executor:
+        # Each thread gets a copy of the caller's context so the request deadline still applies
+        futures = [
+            executor.submit(contextvars.copy_context().run, _files_call, lambda segment=segment: _fetch_segment(url, download, segment, progress))
+            for segment in pending
+        ]
+        for future in futures:
+            future.result()
+    download.finish()
+
+@traced("GET stream")
+def _download_stream(url, part_path, file_size, progress, offset=0):
+    _discard_partial(part_path)
+    # A retry starts the body over
+    progress.start(file_size)
+    with http_client.stream("GET", url, timeout=budget_timeout(REQUEST_TIMEOUT)) as response:
+        response.raise_for_status()
+        with open(part_path, 'wb') as f:
+            f.seek(offset)
+            for chunk in response.iter_bytes(chunk_size=CHUNK_SIZE):
+                if chunk:
+                    if f.tell() == offset:
+                        check_first_bytes(chunk)
+                    f.write(chunk)
+                    progress.advance(len(chunk))
+
+@traced()
+def download_file(url, filename, output_dir="downloads", connections=None, on_progress=None, tag=None):
     """
     Downloads a file from the given URL
     
+    Uses parallel HTTP Range requests when the server advertises Accept-Ranges,
+    resuming a previous partial download if one is found, and falls back to a
+    single stream otherwise. Concurrent calls writing the same output file share
+    one download.
+    
     Args:
         url (str): The download URL
         filename (str): The filename to save as
         output_dir (str): Directory to save the file
+        connections (int): Parallel connections to use (defaults to DOWNLOAD_CONNECTIONS)
+        on_progress (callable): Called with throttled progress.ProgressEvents
+        tag (bytes): ID3 tag to put in front of the audio (see track_tag)
+    """
+    filepath = os.path.abspath(os.path.join(output_dir, f"{filename}.mp3"))
+    return inflight.call(("file", filepath), lambda: _download_file(url, filename, output_dir, connections, on_progress, tag))
+
+def _download_file(url, filename, output_dir, connections, on_progress, tag):
+    """
+    Does the actual download for download_file
     """
     start_time = time.time()  # Track start time
+    if connections is None:
+        connections = DOWNLOAD_CONNECTIONS
     
     if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+        os.makedirs(output_dir, exist_ok=True)
         
     filepath = os.path.join(output_dir, f"{filename}.mp3")
+    part_path = filepath + ".part"
     
     try:
         print(f"Downloading track to {filepath}...")
         
-        # Use a session for better performance
-        session = requests.Session()
-        
         # First make a HEAD request to get file size
-        head_response = session.head(url, timeout=REQUEST_TIMEOUT)
+        head_response = _files_call(lambda: _head(url))
+        check_transfer(head_response.headers)
         file_size = int(head_response.headers.get('content-length', 0))
         print(f"Expected file size: {file_size/1024/1024:.2f} MB")
         
         # Download with progress tracking
-        response = session.get(url, stream=True, timeout=REQUEST_TIMEOUT)
-        response.raise_for_status()
-        
-        downloaded_size = 0
-        chunk_size = 1024 * 1024  # 1MB chunks for faster download
-        
-        with open(filepath, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=chunk_size):
-                if chunk:
-                    f.write(chunk)
-                    downloaded_size += len(chunk)
-                    percent = (downloaded_size / file_size) * 100 if file_size > 0 else 0
-                    print(f"Downloaded: {downloaded_size/1024/1024:.2f} MB ({percent:.1f}%)", end='\r')
+        progress = Progress(on_progress)
+        transfer_start = time.time()
+        tag = tag or b""
+        if connections > 1 and file_size > 0 and _accepts_ranges(head_response):
+            try:
+                _download_ranged(url, part_path, file_size, head_response, connections, progress, len(tag))
+            except RangeNotSupportedError as e:
+                print(f"Range requests not honoured ({e}), falling back to a single stream")
+                _files_call(lambda: _download_stream(url, part_path, file_size, progress, len(tag)))
+        else:
+            _files_call(lambda: _download_stream(url, part_path, file_size, progress, len(tag)))
+        if tag:
+            _seal_part(part_path, tag)
+        os.replace(part_path, filepath)
+        progress.finish()
         
         # Verify file size
         actual_size = os.path.getsize(filepath)
+        STAGE_SECONDS.observe(time.time() - transfer_start, stage="transfer")
+        record_transfer(actual_size, time.time() - transfer_start)
         if file_size > 0 and actual_size < file_size * 0.95:  # Allow 5% difference
-            print(f"\nWarning: Downloaded file ({actual_size/1024/1024:.2f} MB) is smaller than expected ({file_size/1024/1024:.2f} MB)")
+            print(f"Warning: Downloaded file ({actual_size/1024/1024:.2f} MB) is smaller than expected ({file_size/1024/1024:.2f} MB)")
         
         elapsed_time = time.time() - start_time
-        print(f"\nDownload completed in {elapsed_time:.2f} seconds: {filepath}")
+        print(f"Download completed in {elapsed_time:.2f} seconds: {filepath}")
         return filepath
+    except TransferRejectedError as e:
+        print(f"Download abandoned: {e}")
+        record_error("transfer", e.reason)
+        _discard_partial(part_path)
+        return None
     except Exception as e:
         print(f"Error downloading file: {str(e)}")
+        record_error("transfer", e)
         return None
 
-def download_track_direct(track_url, output_dir="downloads"):
+def track_filename(track_data):
+    """
+    Returns the "Name - Artist" filename for a track, without invalid characters
+    """
+    filename = f"{track_data['name']} - {track_data['artist']}"
+    return "".join(c for c in filename if c not in r'<>:"/\|?*')
+
+@traced()
+def download_track_direct(track_url, output_dir="downloads", on_progress=None):
     """
     One-step function to download a track directly
     
     Args:
         track_url (str): The Spotify track URL
         output_dir (str): Directory to save the file
+        on_progress (callable): Called with throttled progress.ProgressEvents
         
     Returns:
         str: Path to downloaded file or None if failed
     """
     print(f"Processing Spotify track: {track_url}")
-    
+    with deadline(REQUEST_DEADLINE):
+        return _download_track_direct(track_url, output_dir, on_progress)
+
+def export_stored_track(track_id, output_dir):
+    """
+    Copies a track from the audio store into output_dir, without any upstream call
+
+    Args:
+        track_id (str): Spotify track ID
+        output_dir (str): Directory to place the "Name - Artist.mp3" file in
+
+    Returns:
+        str: Path of the file, or None if the track isn't stored
+    """
+    return _export_stored_track(track_id, output_dir)[0]
+
+def _export_stored_track(track_id, output_dir):
+    # export_stored_track that also tells whether it copied anything: (path, False) if the file was already there
+    if audio_store is None or not track_id:
+        return None, False
+    entry = audio_store.lookup(track_id)
+    if entry is None or not entry["metadata"]:
+        return None, False
+    filepath = os.path.join(output_dir, f"{track_filename(entry['metadata'])}.mp3")
+    if os.path.exists(filepath):
+        return filepath, False
+    return audio_store.export(entry, filepath), True
+
+def store_downloaded_track(track_id, filepath, download_url, track_data):
+    """
+    Adds a downloaded file to the audio store (a failure only costs the cache entry)
+    """
+    if audio_store is None or not track_id:
+        return
+    try:
+        audio_store.add_file(track_id, filepath, source_url=download_url, metadata=track_data)
+    except (OSError, sqlite3.Error) as e:
+        print(f"Could not add {filepath} to the audio store: {e}")
+
+def store_track_buffer(track_id, buffer, download_url, track_data):
+    """
+    Adds a downloaded buffer to the audio store and rewinds it for sending
+    """
+    if audio_store is None or not track_id:
+        return
+    try:
+        buffer.seek(0)
+        audio_store.add(track_id, buffer, source_url=download_url, metadata=track_data)
+    except (OSError, sqlite3.Error) as e:
+        print(f"Could not add track {track_id} to the audio store: {e}")
+    finally:
+        buffer.seek(0)
+
+def _download_track_direct(track_url, output_dir, on_progress):
+    track_id = extract_track_id(track_url)
+    filepath = export_stored_track(track_id, output_dir)
+    if filepath:
+        print(f"Served from the audio store: {filepath}")
+        return filepath
+
     # Get track metadata
     track_data = get_spotify_track_metadata(track_url)
     if not track_data:
         print("Failed to get track metadata")
         return None
     
-    # Get download URL
-    download_url = download_track(track_url)
+    # Get download URL, fetching the cover for the ID3 tag meanwhile
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        tagging = executor.submit(contextvars.copy_context().run, track_tag, track_data)
+        download_url = download_track(track_url)
+        tag = tagging.result()
     if not download_url:
         print("Failed to get download URL")
         return None
     
-    # Create a clean filename
-    filename = f"{track_data['name']} - {track_data['artist']}"
-    # Remove characters that are invalid in filenames
-    filename = "".join(c for c in filename if c not in r'<>:"/\|?*')
-    
     # Download the file
-    return download_file(download_url, filename, output_dir)
+    filepath = download_file(download_url, track_filename(track_data), output_dir, on_progress=on_progress, tag=tag)
+    if filepath:
+        store_downloaded_track(track_id, filepath, download_url, track_data)
+    return filepath
+
+# Async versions of the API calls for use inside an event loop (e.g. the Telegram bot).
+# They return exactly the same values as their synchronous counterparts.
+
+async def _post_json_async(endpoint, payload, check_status=False):
+    """
+    Async version of _post_json
+    """
+    request_url = f"{SPOTYDOWN_BASE_URL}/api/{endpoint}"
+
+    async def attempt():
+        with span(f"POST /api/{endpoint}") as request_span:
+            with span("rate_limit_wait"):
+                if not await rate_limiter.aacquire(request_url, max_wait=remaining_budget()):
+                    raise DeadlineExceededError("rate limit wait exceeds the request deadline")
+            async with http_client.astream("POST", request_url, headers=_spotydown_headers(), json=payload, timeout=budget_timeout(REQUEST_TIMEOUT)) as response:
+                request_span.set("status_code", response.status_code)
+                await rate_limiter.arecord(request_url, response)
+                raise_for_retryable_status(response)
+                if check_status:
+                    response.raise_for_status()
+                return await aread_json(response)
+    return await acall_with_retry(breakers[endpoint], attempt, retry_policy)
+
+@traced()
+async def get_spotify_track_metadata_async(track_url):
+    """
+    Fetches metadata for a Spotify track without blocking the event loop
+
+    Concurrent lookups of the same track share one API request.
+
+    Args:
+        track_url (str): The Spotify track URL
+
+    Returns:
+        dict: Track metadata or None if request fails
+    """
+    track_id = extract_track_id(track_url)
+    if not track_id:
+        return await _get_spotify_track_metadata_async(track_url)
+    return await inflight.acall(("metadata", track_id), lambda: _get_spotify_track_metadata_async(track_url))
+
+async def _get_spotify_track_metadata_async(track_url):
+    """
+    Does the actual lookup for get_spotify_track_metadata_async
+    """
+    start_time = time.time()
+
+    track_id = extract_track_id(track_url)
+    if track_id:
+        hit, cached = await metadata_cache.aget(track_id)
+        if hit:
+            print(f"Metadata served from cache")
+            return cached
+
+    # Clean the URL by removing any query parameters
+    if "?" in track_url:
+        track_url = track_url.split("?")[0]
+
+    try:
+        print(f"Fetching track metadata...")
+        with STAGE_SECONDS.time(stage="metadata"):
+            data = await _post_json_async("get-metadata", {"url": track_url})
+        if data is None:
+            return None
+
+        if "apiResponse" in data and "data" in data["apiResponse"] and len(data["apiResponse"]["data"]) > 0:
+            elapsed_time = time.time() - start_time
+            print(f"Metadata fetched in {elapsed_time:.2f} seconds")
+            await _acache_metadata(track_id, data["apiResponse"]["data"][0])
+            return data["apiResponse"]["data"][0]
+        else:
+            print(f"Error: Unexpected response format")
+            record_error("metadata", "unexpected_response")
+            await _acache_metadata(track_id, None)
+            return None
+
+    except httpx.HTTPError as e:
+        print(f"Error making request: {e}")
+        record_error("metadata", e)
+        return None
+    except Exception as e:
+        print(f"Unexpected error: {str(e)}")
+        record_error("metadata", e)
+        return None
+
+@traced()
+async def get_spotify_collection_tracks_async(collection_url):
+    """
+    Expands a Spotify album or playlist URL into its tracks without blocking the event loop
+
+    Args:
+        collection_url (str): The Spotify album or playlist URL
+
+    Returns:
+        list: Track metadata dicts (each with a track "url") or None if request fails
+    """
+    start_time = time.time()
+
+    # Clean the URL by removing any query parameters
+    collection_url = collection_url.split("?")[0]
+
+    try:
+        print(f"Fetching album/playlist tracks...")
+        tracks = _collection_tracks(await _post_json_async("get-metadata", {"url": collection_url}))
+        if not tracks:
+            print(f"Error: Unexpected response format")
+            return None
+        # Complete entries save a per-track lookup later
+        for track_id, track in _complete_tracks(tracks):
+            await _acache_metadata(track_id, track)
+
+        elapsed_time = time.time() - start_time
+        print(f"{len(tracks)} tracks fetched in {elapsed_time:.2f} seconds")
+        return tracks
+    except Exception as e:
+        print(f"Error fetching album/playlist: {str(e)}")
+        record_error("collection", e)
+        return None
+
+@traced()
+async def download_track_async(track_url):
+    """
+    Gets the download URL for a track without blocking the event loop
+
+    Concurrent requests for the same track share one API request.
+
+    Args:
+        track_url (str): The Spotify track URL
+
+    Returns:
+        str: Download URL or None if request fails
+    """
+    track_id = extract_track_id(track_url)
+    if not track_id:
+        return await _download_track_async(track_url)
+    return await inflight.acall(("link", track_id), lambda: _download_track_async(track_url))
+
+async def _download_track_async(track_url):
+    """
+    Does the actual request for download_track_async
+    """
+    start_time = time.time()
+
+    try:
+        print("Getting download link...")
+        with STAGE_SECONDS.time(stage="link"):
+            download_url = await resolver_router.aresolve(track_url)
+        if download_url is None:
+            record_error("link", "no_result")
+            return None
+
+        elapsed_time = time.time() - start_time
+        print(f"Download link obtained in {elapsed_time:.2f} seconds")
+        return download_url
+
+    except Exception as e:
+        print(f"Error getting download link: {str(e)}")
+        record_error("link", e)
+        return None
+
+def _write_flushed(f, data):
+    f.write(data)
+    f.flush()
+
+@traced("GET segment")
+async def _fetch_segment_async(url, download, segment, progress):
+    async with http_client.astream("GET", url, headers=download.range_header(segment), timeout=budget_timeout(REQUEST_TIMEOUT)) as response:
+        raise_for_retryable_status(response)
+        if response.status_code != 206:
+            raise RangeNotSupportedError(f"expected 206 Partial Content, got {response.status_code}")
+        with open(download.part_path, 'r+b') as f:
+            f.seek(download.offset + segment["start"] + segment["done"])
+            try:
+                async for chunk in response.aiter_bytes(chunk_size=CHUNK_SIZE):
+                    chunk = chunk[:download.remaining(segment)]
+                    if chunk:
+                        # Disk writes go to a thread so a slow disk can't stall other chats;
+                        # the chunk is flushed before it's recorded as on disk
+                        await asyncio.to_thread(_write_flushed, f, chunk)
+                        if download.record(segment, len(chunk)):
+                            await asyncio.to_thread(download.checkpoint)
+                        progress.advance(len(chunk))
+            finally:
+                # Keep what this attempt got, for the retry or a later resume
+                await asyncio.to_thread(download.checkpoint)
+
+async def _download_ranged_async(url, part_path, file_size, head_response, connections, progress, offset=0):
+    download = await asyncio.to_thread(_RangedDownload, part_path, file_size, _resume_validator(head_response), connections, offset)
+    progress.start(file_size, initial=download.downloaded_size)
+    pending = download.pending()
+    print(f"Downloading in {len(pending)} parallel range requests...")
+    await asyncio.gather(*[
+        _afiles_call(lambda segment=segment: _fetch_segment_async(url, download, segment, progress))
+        for segment in pending
+    ])
+    download.finish()
+
+@traced("GET stream")
+async def _download_stream_async(url, part_path, progress, offset=0):
+    _discard_partial(part_path)
+    async with http_client.astream("GET", url, timeout=budget_timeout(REQUEST_TIMEOUT)) as response:
+        response.raise_for_status()
+        # A retry starts the body over
+        progress.start(int(response.headers.get('content-length', 0)))
+        with open(part_path, 'wb') as f:
+            f.seek(offset)
+            async for chunk in response.aiter_bytes(chunk_size=CHUNK_SIZE):
+                if chunk:
+                    if f.tell() == offset:
+                        check_first_bytes(chunk)
+                    # Disk writes go to a thread so a slow disk can't stall other chats
+                    await asyncio.to_thread(f.write, chunk)
+                    progress.advance(len(chunk))
+
+@traced()
+async def download_file_async(url, filename, output_dir="downloads", connections=None, on_progress=None, tag=None):
+    """
+    Downloads a file from the given URL without blocking the event loop
+
+    Uses parallel ranged requests with resume, like download_file. Concurrent
+    calls writing the same output file share one download.
+
+    Args:
+        url (str): The download URL
+        filename (str): The filename to save as
+        output_dir (str): Directory to save the file
+        connections (int): Parallel connections to use (defaults to DOWNLOAD_CONNECTIONS)
+        on_progress (callable): Called with throttled progress.ProgressEvents
+        tag (bytes): ID3 tag to put in front of the audio (see track_tag_async)
+
+    Returns:
+        str: Path to downloaded file or None if failed
+    """
+    filepath = os.path.abspath(os.path.join(output_dir, f"{filename}.mp3"))
+    return await inflight.acall(("file", filepath), lambda: _download_file_async(url, filename, output_dir, connections, on_progress, tag))
+
+async def _download_file_async(url, filename, output_dir, connections, on_progress, tag):
+    """
+    Does the actual download for download_file_async
+    """
+    start_time = time.time()
+    if connections is None:
+        connections = DOWNLOAD_CONNECTIONS
+
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir, exist_ok=True)
+
+    filepath = os.path.join(output_dir, f"{filename}.mp3")
+    part_path = filepath + ".part"
+
+    try:
+        print(f"Downloading track to {filepath}...")
+
+        # First make a HEAD request to get file size
+        head_response = await _afiles_call(lambda: _ahead(url))
+        check_transfer(head_response.headers)
+        file_size = int(head_response.headers.get('content-length', 0))
+        print(f"Expected file size: {file_size/1024/1024:.2f} MB")
+
+        progress = Progress(on_progress)
+        transfer_start = time.time()
+        tag = tag or b""
+        if connections > 1 and file_size > 0 and _accepts_ranges(head_response):
+            try:
+                await _download_ranged_async(url, part_path, file_size, head_response, connections, progress, len(tag))
+            except RangeNotSupportedError as e:
+                print(f"Range requests not honoured ({e}), falling back to a single stream")
+                await _afiles_call(lambda: _download_stream_async(url, part_path, progress, len(tag)))
+        else:
+            await _afiles_call(lambda: _download_stream_async(url, part_path, progress, len(tag)))
+        if tag:
+            await asyncio.to_thread(_seal_part, part_path, tag)
+        os.replace(part_path, filepath)
+        progress.finish()
+
+        # Verify file size
+        actual_size = os.path.getsize(filepath)
+        STAGE_SECONDS.observe(time.time() - transfer_start, stage="transfer")
+        record_transfer(actual_size, time.time() - transfer_start)
+        if file_size > 0 and actual_size < file_size * 0.95:  # Allow 5% difference
+            print(f"Warning: Downloaded file ({actual_size/1024/1024:.2f} MB) is smaller than expected ({file_size/1024/1024:.2f} MB)")
+
+        elapsed_time = time.time() - start_time
+        print(f"Download completed in {elapsed_time:.2f} seconds: {filepath}")
+        return filepath
+    except TransferRejectedError as e:
+        print(f"Download abandoned: {e}")
+        record_error("transfer", e.reason)
+        _discard_partial(part_path)
+        return None
+    except Exception as e:
+        print(f"Error downloading file: {str(e)}")
+        record_error("transfer", e)
+        return None
+
+@traced()
+async def download_to_buffer_async(url, spool_threshold=None, on_progress=None, max_bytes=None, tag=None):
+    """
+    Downloads a file into a buffer instead of the downloads directory
+
+    The body is held in memory up to spool_threshold bytes and spooled to an
+    anonymous temp file beyond that, which disappears as soon as the buffer
+    is closed. Nothing is left behind on disk.
+
+    Before the body is read, the response headers and first bytes are checked:
+    a file larger than max_bytes or a web page instead of audio is abandoned
+    at once, rather than after the whole transfer.
+
+    Args:
+        url (str): The download URL
+        spool_threshold (int): Bytes kept in memory before spilling to disk
+        on_progress (callable): Called with throttled progress.ProgressEvents
+        max_bytes (int): Largest file the caller can use, or None for no limit
+        tag (bytes): ID3 tag written to the buffer ahead of the audio (see track_tag_async)
+
+    Returns:
+        tempfile.SpooledTemporaryFile: Buffer positioned at the start, or None if failed.
+            The caller must close it.
+
+    Raises:
+        TransferRejectedError: If the file is too large or isn't audio
+    """
+    start_time = time.time()
+    if spool_threshold is None:
+        spool_threshold = SPOOL_THRESHOLD
+
+    buffer = tempfile.SpooledTemporaryFile(max_size=spool_threshold)
+    progress = Progress(on_progress)
+    tag = tag or b""
+    try:
+        print("Streaming track into memory...")
+        chunk_size = 1024 * 1024  # 1MB chunks for faster download
+
+        async def attempt():
+            # A retry starts the body over
+            buffer.seek(0)
+            buffer.truncate()
+            buffer.write(tag)
+            with span("GET stream"):
+                async with http_client.astream("GET", url, timeout=budget_timeout(REQUEST_TIMEOUT)) as response:
+                    response.raise_for_status()
+                    check_transfer(response.headers, max_bytes)
+                    content_length = int(response.headers.get('content-length', 0))
+                    progress.start(content_length)
+                    async for chunk in response.aiter_bytes(chunk_size=chunk_size):
+                        if chunk:
+                            if buffer.tell() == len(tag):
+                                check_first_bytes(chunk)
+                            buffer.write(chunk)
+                            # Without a Content-Length the limit is enforced as the body arrives (the tag isn't counted)
+                            if max_bytes and buffer.tell() - len(tag) > max_bytes:
+                                raise TransferRejectedError("too_large", f"file is over the {max_bytes/1024/1024:.0f} MB limit")
+                            progress.advance(len(chunk))
+                    return content_length
+
+        file_size = await _afiles_call(attempt)
+        progress.finish()
+
+        downloaded_size = buffer.tell() - len(tag)
+        if tag:
+            seal_tag(buffer, tag)
+        if file_size > 0 and downloaded_size < file_size * 0.95:  # Allow 5% difference
+            print(f"Warning: Downloaded data ({downloaded_size/1024/1024:.2f} MB) is smaller than expected ({file_size/1024/1024:.2f} MB)")
+
+        buffer.seek(0)
+        elapsed_time = time.time() - start_time
+        STAGE_SECONDS.observe(elapsed_time, stage="transfer")
+        record_transfer(downloaded_size, elapsed_time)
+        print(f"Download completed in {elapsed_time:.2f} seconds ({downloaded_size/1024/1024:.2f} MB)")
+        return buffer
+    except TransferRejectedError as e:
+        buffer.close()
+        print(f"Download abandoned: {e}")
+        record_error("transfer", e.reason)
+        raise
+    except Exception as e:
+        buffer.close()
+        print(f"Error downloading file: {str(e)}")
+        record_error("transfer", e)
+        return None
+
+async def _batch_track(track_url, output_dir, track_data=None, on_progress=None):
+    """
+    Downloads one track for download_batch
+
+    Args:
+        on_progress (callable): Called with the file name and each ProgressEvent of its download
+
+    Returns:
+        dict: The track's manifest entry
+    """
+    track_id = extract_track_id(track_url)
+    entry = {"url": track_url, "track_id": track_id}
+    with deadline(REQUEST_DEADLINE), span("batch_track", url=track_url):
+        # Tracks already in the audio store need no upstream call at all
+        filepath, exported = await asyncio.to_thread(_export_stored_track, track_id, output_dir)
+        if filepath:
+            entry.update(status="cached" if exported else "skipped", path=filepath, bytes=os.path.getsize(filepath))
+            return entry
+
+        if track_data is None:
+            track_data = await get_spotify_track_metadata_async(track_url)
+        if not track_data:
+            entry.update(status="failed", error="metadata lookup failed")
+            return entry
+
+        filename = track_filename(track_data)
+        filepath = os.path.join(output_dir, f"{filename}.mp3")
+        entry.update(name=track_data['name'], artist=track_data['artist'], path=filepath)
+        if os.path.exists(filepath):
+            entry.update(status="skipped", bytes=os.path.getsize(filepath))
+            return entry
+
+        # The cover for the ID3 tag is fetched while the download link resolves
+        tagging = asyncio.create_task(track_tag_async(track_data))
+        try:
+            download_url = await download_track_async(track_url)
+            if not download_url:
+                entry.update(status="failed", error="no download link")
+                return entry
+            tag = await tagging
+        finally:
+            tagging.cancel()
+        file_progress = None
+        if on_progress is not None:
+            file_progress = lambda event: on_progress(filename, event)
+        if not await download_file_async(download_url, filename, output_dir, on_progress=file_progress, tag=tag):
+            entry.update(status="failed", error="download failed")
+            return entry
+        await asyncio.to_thread(store_downloaded_track, track_id, filepath, download_url, track_data)
+        entry.update(status="downloaded", bytes=os.path.getsize(filepath))
+        return entry
+
+async def download_batch(urls, output_dir="downloads", concurrency=4, manifest_path=None, on_progress=None):
+    """
+    Downloads many tracks concurrently, skipping those already in output_dir
+
+    Album and playlist URLs are expanded into their tracks and repeated tracks
+    are downloaded once. Tracks in the audio store are copied from there. Every result is printed with the running totals as it
+    completes and appended to the manifest as one JSON line, so an interrupted
+    backfill still leaves a record of what was done; a rerun adds to the same manifest.
+
+    Args:
+        urls (list): Spotify track, album or playlist URLs
+        output_dir (str): Directory to save the files
+        concurrency (int): Tracks downloaded at the same time
+        manifest_path (str): JSON-lines results file (defaults to output_dir/manifest.jsonl)
+        on_progress (callable): Called with a file name and a ProgressEvent as each file downloads
+
+    Returns:
+        list: One manifest entry per track, each with a "status" of
+            "downloaded", "cached" (from the audio store), "skipped" or "failed"
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    if manifest_path is None:
+        manifest_path = os.path.join(output_dir, "manifest.jsonl")
+
+    results = []
+    jobs = deque()
+    seen = set()
+
+    def add(track_url, track_data=None):
+        key = extract_track_id(track_url) or track_url
+        if key not in seen:
+            seen.add(key)
+            jobs.append((track_url, track_data))
+
+    for url in urls:
+        if extract_collection(url):
+            tracks = await get_spotify_collection_tracks_async(url)
+            if tracks is None:
+                results.append({"url": url, "status": "failed", "error": "album/playlist lookup failed"})
+            for track in tracks or ():
+                add(track["url"], track)
+        else:
+            add(url)
+
+    total = len(jobs) + len(results)
+    counts = {"downloaded": 0, "cached": 0, "skipped": 0, "failed": len(results)}
+    downloaded_bytes = 0
+    start_time = time.time()
+
+    with open(manifest_path, "a", encoding="utf-8") as manifest:
+        def finish(entry):
+            nonlocal downloaded_bytes
+            results.append(entry)
+            counts[entry["status"]] += 1
+            if entry["status"] == "downloaded":
+                downloaded_bytes += entry["bytes"]
+            manifest.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            manifest.flush()
+
+            label = entry.get("path") or entry["url"]
+            detail = entry.get("error") or f"{entry.get('bytes', 0)/1024/1024:.2f} MB"
+            rate = downloaded_bytes / 1024 / 1024 / max(time.time() - start_time, 0.001)
+            print(
+                f"[{len(results)}/{total}] {entry['status']}: {label} ({detail}) | "
+                f"{counts['downloaded']} downloaded, {counts['cached']} cached, {counts['skipped']} skipped, "
+                f"{counts['failed']} failed, {rate:.2f} MB/s"
+            )
+
+        for entry in list(results):
+            manifest.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+        async def worker():
+            while jobs:
+                track_url, track_data = jobs.popleft()
+                track_start = time.time()
+                try:
+                    entry = await _batch_track(track_url, output_dir, track_data, on_progress)
+                except Exception as e:
+                    entry = {"url": track_url, "track_id": extract_track_id(track_url), "status": "failed", "error": str(e) or type(e).__name__}
+                entry["seconds"] = round(time.time() - track_start, 2)
+                finish(entry)
+
+        await asyncio.gather(*[worker() for _ in range(max(1, min(concurrency, len(jobs))))])
+
+    elapsed_time = time.time() - start_time
+    print(
+        f"Batch finished in {elapsed_time:.2f} seconds: {counts['downloaded']} downloaded, {counts['cached']} cached, "
+        f"{counts['skipped']} skipped, {counts['failed']} failed ({downloaded_bytes/1024/1024:.2f} MB). "
+        f"Manifest: {manifest_path}"
+    )
+    return results
+
+def read_urls(urls, input_path=None):
+    """
+    Collects URLs from the command line and an input file ("-" = stdin)
+
+    Blank lines and lines starting with # are ignored.
+    """
+    lines = list(urls)
+    if input_path == "-":
+        lines.extend(sys.stdin)
+    elif input_path:
+        with open(input_path, encoding="utf-8") as f:
+            lines.extend(f)
+    return [line.strip() for line in lines if line.strip() and not line.strip().startswith("#")]
+
+async def _run_batch(urls, output_dir, concurrency, manifest_path):
+    try:
+        return await download_batch(urls, output_dir, concurrency, manifest_path, on_progress=print_progress_line)
+    finally:
+        await http_client.aclose()
 
 def main():
+    parser = argparse.ArgumentParser(
+        description="Download Spotify tracks, albums and playlists. "
+                    "Without URLs or --input, asks for one track URL (or reads URLs from piped stdin)."
+    )
+    parser.add_argument("urls", nargs="*", help="Spotify track, album or playlist URLs")
+    parser.add_argument("-i", "--input", help="file with one URL per line ('-' = stdin)")
+    parser.add_argument("-o", "--output-dir", default="downloads", help="directory to save tracks (default: downloads)")
+    parser.add_argument("-c", "--concurrency", type=int, default=int(os.environ.get("BATCH_CONCURRENCY", 4)), help="tracks downloaded at the same time (default: 4)")
+    parser.add_argument("--manifest", help="JSON-lines results file (default: <output-dir>/manifest.jsonl)")
+    args = parser.parse_args()
+
+    if METRICS_PORT:
+        start_metrics_server()
+
+    input_path = args.input
+    if not args.urls and input_path is None and not sys.stdin.isatty():
+        input_path = "-"
+
+    if args.urls or input_path:
+        urls = read_urls(args.urls, input_path)
+        if not urls:
+            parser.error("no URLs given")
+        results = asyncio.run(_run_batch(urls, args.output_dir, args.concurrency, args.manifest))
+        # Non-zero exit so scripts notice a partial backfill
+        sys.exit(1 if any(entry["status"] == "failed" for entry in results) else 0)
+    
     print("Spotify Track Information and Download Link")
     print("------------------------------------------")
     
     track_url = input("Enter Spotify track URL: ")
     
     # Use the direct download function for faster processing
-    filepath = download_track_direct(track_url)
+    filepath = download_track_direct(track_url, args.output_dir, on_progress=print_progress_bar)
     
     if filepath:
         print(f"Track successfully downloaded to: {filepath}")
     else:
         print("Failed to download track.")
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
-
-
-
-
-
@@ -0,0 +1,108 @@
+import os
+import struct
+
+# Picture type 3 is "Cover (front)" in the ID3v2 APIC frame
+FRONT_COVER = 3
+
+
+def _syncsafe(value):
+    # ID3v2 header sizes use 7 bits per byte so they can't contain a false MPEG sync
+    return bytes(((value >> shift) & 0x7F) for shift in (21, 14, 7, 0))
+
+
+def _frame(frame_id, data):
+    # ID3v2.3 frames: 4-byte ID, plain 32-bit size, two flag bytes
+    return frame_id.encode("ascii") + struct.pack(">I", len(data)) + b"\x00\x00" + data
+
+
+def _text_frame(frame_id, text):
+    try:
+        return _frame(frame_id, b"\x00" + text.encode("latin-1"))
+    except UnicodeEncodeError:
+        # UTF-16 with a BOM is the only Unicode encoding ID3v2.3 has
+        return _frame(frame_id, b"\x01" + text.encode("utf-16"))
+
+
+def image_mime(data):
+    """
+    Tells a JPEG or PNG from anything else by its first bytes
+
+    Returns:
+        str: "image/jpeg" or "image/png", or None (e.g. for an error page served as the image)
+    """
+    if data.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    return None
+
+
+def build_tag(track_data, cover=None):
+    """
+    Builds an ID3v2.3 tag with a track's title, artist, album and cover
+
+    Args:
+        track_data (dict): Track metadata (name, artist, album_name, album_artist, url)
+        cover (bytes): JPEG or PNG cover art to embed (anything else is left out), or None
+
+    Returns:
+        bytes: The tag, ready to go in front of the MP3 data
+    """
+    frames = []
+    for frame_id, key in (("TIT2", "name"), ("TPE1", "artist"), ("TALB", "album_name"), ("TPE2", "album_artist")):
+        if track_data.get(key):
+            frames.append(_text_frame(frame_id, str(track_data[key])))
+    if track_data.get("url"):
+        # Official audio source webpage
+        frames.append(_frame("WOAS", str(track_data["url"]).encode("latin-1", "ignore")))
+    mime = image_mime(cover) if cover else None
+    if mime:
+        frames.append(_frame("APIC", b"\x00" + mime.encode("ascii") + b"\x00" + bytes([FRONT_COVER]) + b"\x00" + cover))
+    body = b"".join(frames)
+    return b"ID3\x03\x00\x00" + _syncsafe(len(body)) + body
+
+
+def tag_size(header):
+    """
+    Size of the ID3v2 tag at the start of a file, header and footer included
+
+    Args:
+        header (bytes): The file's first 10 bytes
+
+    Returns:
+        int: Bytes the tag occupies, 0 if the file doesn't start with one
+    """
+    if len(header) < 10 or not header.startswith(b"ID3") or header[3] == 0xFF or header[4] == 0xFF:
+        return 0
+    if any(b & 0x80 for b in header[6:10]):
+        return 0
+    size = (header[6] << 21) | (header[7] << 14) | (header[8] << 7) | header[9]
+    # ID3v2.4 tags may end with a 10-byte footer
+    return 10 + size + (10 if header[5] & 0x10 else 0)
+
+
+def pad_tag(tag, size):
+    """
+    Grows a tag built by build_tag to exactly size bytes with zero padding
+    """
+    return tag[:6] + _syncsafe(size - 10) + tag[10:] + b"\x00" * (size - len(tag))
+
+
+def seal_tag(f, tag):
+    """
+    Finishes a file whose audio was written right after tag
+
+    If the downloaded audio brought its own ID3v2 tag, ours is padded to
+    cover it, so players see one tag and the audio itself never moves.
+
+    Args:
+        f: File object open for reading and writing, holding tag + audio
+        tag (bytes): The tag at the start of the file
+    """
+    end = f.seek(0, os.SEEK_END)
+    f.seek(len(tag))
+    existing = tag_size(f.read(10))
+    # A corrupt header can claim any size; only absorb a tag that fits inside the file
+    if existing and len(tag) + existing <= end:
+        f.seek(0)
+        f.write(pad_tag(tag, len(tag) + existing))
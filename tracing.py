@@ -0,0 +1,371 @@
+"""
+Lightweight request tracing.
+
+Every incoming update starts a trace; the handlers and downloader calls it
+goes through record nested spans, which follow the work into coroutines,
+tasks and worker threads through contextvars. Finished spans are written by a
+background thread to a JSON-lines file (TRACE_FILE) and/or posted to an
+OTLP/HTTP collector (OTEL_EXPORTER_OTLP_ENDPOINT).
+
+Usage:
+    python tracing.py slowest               # slowest traces of the last hour
+    python tracing.py slowest --since 600 --limit 3
+    python tracing.py show <trace_id>
+"""
+import argparse
+import asyncio
+import atexit
+import contextlib
+import contextvars
+import functools
+import json
+import os
+import queue
+import threading
+import time
+import uuid
+
+import httpx
+
+# JSON-lines file spans are appended to ("" = don't write spans to disk)
+TRACE_FILE = os.environ.get("TRACE_FILE", os.path.join(os.environ.get("CACHE_DIR", "cache"), "traces.jsonl"))
+TRACE_FILE_MAX_BYTES = int(os.environ.get("TRACE_FILE_MAX_BYTES", 50 * 1024 * 1024))
+
+# OTLP/HTTP collector, e.g. http://localhost:4318 (spans are posted to /v1/traces)
+OTLP_ENDPOINT = os.environ.get("OTEL_EXPORTER_OTLP_ENDPOINT", "")
+SERVICE_NAME = os.environ.get("OTEL_SERVICE_NAME", "spotify-bot")
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    """
+    One timed stage of a trace
+    """
+
+    def __init__(self, name, trace_id, parent_id, attributes):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.start = time.time()
+        self.duration = None
+        self.error = None
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": self.start,
+            "duration": self.duration,
+            "error": self.error,
+            "attributes": self.attributes
+        }
+
+
+@contextlib.contextmanager
+def span(name, trace_id=None, parent_id=None, **attributes):
+    """
+    Records the block as a span of the current trace, or starts a new trace
+
+    Args:
+        name (str): What the block does
+        trace_id (str): Continue this trace (e.g. one started in another process)
+        parent_id (str): Parent span in that trace
+        **attributes: Extra details to record (user_id, status_code, ...)
+
+    Yields:
+        Span: The span, for adding attributes
+    """
+    parent = _current_span.get()
+    if trace_id is None:
+        if parent is not None:
+            trace_id, parent_id = parent.trace_id, parent.span_id
+        else:
+            trace_id = uuid.uuid4().hex
+
+    current = Span(name, trace_id, parent_id, attributes)
+    token = _current_span.set(current)
+    started = time.perf_counter()
+    try:
+        yield current
+    except BaseException as e:
+        current.error = f"{type(e).__name__}: {e}" if str(e) else type(e).__name__
+        raise
+    finally:
+        current.duration = time.perf_counter() - started
+        _current_span.reset(token)
+        _exporter.export(current)
+
+
+def current_span():
+    """
+    Returns the innermost active span, or None outside any trace
+    """
+    return _current_span.get()
+
+
+def current_trace_id():
+    """
+    Returns the active trace ID, or None outside any trace
+    """
+    active = _current_span.get()
+    return active.trace_id if active else None
+
+
+def _update_attributes(args):
+    # Handlers get a telegram Update first; record which update and user the trace is for
+    update = args[0] if args else None
+    if not hasattr(update, "update_id"):
+        return {}
+    attributes = {"update_id": update.update_id}
+    user = getattr(update, "effective_user", None)
+    if user is not None:
+        attributes["user_id"] = user.id
+    return attributes
+
+
+def traced(name=None):
+    """
+    Decorator recording every call of a function (sync or async) as a span
+
+    Args:
+        name (str): Span name (defaults to the function's name)
+    """
+    def decorate(fn):
+        span_name = name or fn.__name__
+
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with span(span_name, **_update_attributes(args)):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(span_name, **_update_attributes(args)):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_payload(spans):
+    # OTLP/HTTP JSON encoding: trace IDs are 32 hex chars, span IDs 16, times in nanoseconds
+    otlp_spans = []
+    for finished in spans:
+        start_ns = int(finished.start * 1e9)
+        otlp_span = {
+            "traceId": finished.trace_id,
+            "spanId": finished.span_id,
+            "name": finished.name,
+            "kind": 1,
+            "startTimeUnixNano": str(start_ns),
+            "endTimeUnixNano": str(start_ns + int(finished.duration * 1e9)),
+            "attributes": [{"key": key, "value": _otlp_value(value)} for key, value in finished.attributes.items()],
+            "status": {"code": 2, "message": finished.error} if finished.error else {"code": 1}
+        }
+        if finished.parent_id:
+            otlp_span["parentSpanId"] = finished.parent_id
+        otlp_spans.append(otlp_span)
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": SERVICE_NAME}}]},
+            "scopeSpans": [{"scope": {"name": "spotify_bot.tracing"}, "spans": otlp_spans}]
+        }]
+    }
+
+
+class _Exporter:
+    """
+    Hands finished spans to a background thread that writes them in batches,
+    so recording a span never waits on disk or network
+    """
+
+    def __init__(self, trace_file, otlp_endpoint, batch_size=256, flush_interval=1.0):
+        self.trace_file = trace_file
+        self.otlp_url = otlp_endpoint.rstrip("/") + "/v1/traces" if otlp_endpoint else None
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=10000)
+        self._thread = None
+        self._lock = threading.Lock()
+        self.dropped = 0
+
+    @property
+    def enabled(self):
+        return bool(self.trace_file or self.otlp_url)
+
+    def export(self, finished):
+        if not self.enabled:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="trace-exporter", daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+        try:
+            self._queue.put_nowait(finished)
+        except queue.Full:
+            # Tracing must never slow the bot down; drop spans instead
+            self.dropped += 1
+
+    def _drain(self, block):
+        batch = []
+        try:
+            batch.append(self._queue.get(timeout=self.flush_interval) if block else self._queue.get_nowait())
+            while len(batch) < self.batch_size:
+                batch.append(self._queue.get_nowait())
+        except queue.Empty:
+            pass
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._drain(block=True)
+            if batch:
+                self._write(batch)
+
+    def flush(self):
+        """
+        Writes out whatever is still queued (called at exit)
+        """
+        while True:
+            batch = self._drain(block=False)
+            if not batch:
+                return
+            self._write(batch)
+
+    def _write(self, batch):
+        if self.trace_file:
+            try:
+                self._rotate()
+                lines = "".join(json.dumps(finished.to_dict(), default=str) + "\n" for finished in batch)
+                # One append per batch, so workers sharing the file don't interleave lines
+                with open(self.trace_file, "a", encoding="utf-8") as f:
+                    f.write(lines)
+            except OSError as e:
+                print(f"Could not write traces to {self.trace_file}: {e}")
+        if self.otlp_url:
+            try:
+                httpx.post(self.otlp_url, json=_otlp_payload(batch), timeout=5).raise_for_status()
+            except httpx.HTTPError as e:
+                print(f"Could not export traces to {self.otlp_url}: {e}")
+
+    def _rotate(self):
+        directory = os.path.dirname(self.trace_file)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        if os.path.exists(self.trace_file) and os.path.getsize(self.trace_file) > TRACE_FILE_MAX_BYTES:
+            os.replace(self.trace_file, self.trace_file + ".1")
+
+
+_exporter = _Exporter(TRACE_FILE, OTLP_ENDPOINT)
+
+
+def load_traces(paths, since=None):
+    """
+    Reads spans from JSON-lines files and groups them by trace
+
+    Args:
+        paths (list): Trace files, oldest first
+        since (float): Skip spans that started before this Unix time
+
+    Returns:
+        dict: trace_id -> list of span dicts
+    """
+    traces = {}
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if since is not None and record["start"] < since:
+                    continue
+                traces.setdefault(record["trace_id"], []).append(record)
+    return traces
+
+
+def trace_duration(spans):
+    return max(s["start"] + s["duration"] for s in spans) - min(s["start"] for s in spans)
+
+
+def print_trace(trace_id, spans):
+    """
+    Prints a trace as an indented tree of spans with their durations
+    """
+    start = min(s["start"] for s in spans)
+    ids = {s["span_id"] for s in spans}
+    children = {}
+    for s in sorted(spans, key=lambda s: s["start"]):
+        # Spans whose parent isn't in the file (e.g. another process) are shown as roots
+        parent = s["parent_id"] if s["parent_id"] in ids else None
+        children.setdefault(parent, []).append(s)
+
+    roots = children.get(None, [])
+    attributes = " ".join(f"{k}={v}" for root in roots for k, v in root["attributes"].items())
+    print(f"{trace_duration(spans):8.2f}s  {trace_id}  {time.strftime('%H:%M:%S', time.localtime(start))}  {attributes}")
+
+    def walk(s, depth):
+        error = f"  !! {s['error']}" if s["error"] else ""
+        offset = s["start"] - start
+        print(f"{'':10}{'  ' * depth}{s['name']}  {s['duration']:.3f}s (at +{offset:.3f}s){error}")
+        for child in children.get(s["span_id"], []):
+            walk(child, depth + 1)
+
+    for root in roots:
+        walk(root, 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect recorded traces")
+    parser.add_argument("--file", default=TRACE_FILE, help="trace file (default: $TRACE_FILE)")
+    commands = parser.add_subparsers(dest="command", required=True)
+    slowest = commands.add_parser("slowest", help="print the slowest recent traces")
+    slowest.add_argument("--since", type=float, default=3600, help="look back this many seconds (default: 1 hour)")
+    slowest.add_argument("--limit", type=int, default=5, help="number of traces to print")
+    show = commands.add_parser("show", help="print one trace")
+    show.add_argument("trace_id")
+    args = parser.parse_args()
+
+    paths = [args.file + ".1", args.file]
+    if args.command == "slowest":
+        traces = load_traces(paths, since=time.time() - args.since)
+        if not traces:
+            print(f"No traces in the last {args.since:.0f} seconds")
+            return
+        ranked = sorted(traces.items(), key=lambda item: trace_duration(item[1]), reverse=True)
+        print(f"Slowest {min(args.limit, len(ranked))} of {len(ranked)} traces in the last {args.since:.0f} seconds:\n")
+        for trace_id, spans in ranked[:args.limit]:
+            print_trace(trace_id, spans)
+            print()
+    else:
+        spans = load_traces(paths).get(args.trace_id)
+        if not spans:
+            print(f"Trace {args.trace_id} not found")
+            return
+        print_trace(args.trace_id, spans)
+
+
+if __name__ == "__main__":
+    main()
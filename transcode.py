@@ -0,0 +1,215 @@
+import asyncio
+import os
+import shutil
+import tempfile
+
+# ffmpeg/ffprobe binaries (looked up on PATH); transcoding is off when ffmpeg isn't installed
+FFMPEG_PATH = os.environ.get("FFMPEG_PATH", "ffmpeg")
+FFPROBE_PATH = os.environ.get("FFPROBE_PATH", "ffprobe")
+
+# Named encodes a track can be re-encoded to: profile -> MP3 bitrate in kbit/s
+PROFILES = {"mp3_320": 320, "mp3_192": 192, "mp3_160": 160, "mp3_128": 128, "mp3_96": 96}
+
+# Bitrates LAME encodes at, highest first; "fit" encodes pick the highest that stays under the size
+MP3_BITRATES = (320, 256, 224, 192, 160, 128, 112, 96, 80, 64, 56, 48, 40, 32)
+
+# Bitrate assumed for a file ffprobe can't measure, to estimate its duration from its size
+FALLBACK_SOURCE_BITRATE = 320  # kbit/s
+
+CHUNK_SIZE = 256 * 1024
+
+
+class TranscodeError(Exception):
+    """
+    Raised when ffmpeg fails, times out or can't make a file small enough
+    """
+
+
+class Transcoder:
+    """
+    Pool of ffmpeg processes re-encoding audio buffers to MP3
+
+    Audio is piped through ffmpeg (stdin in, stdout out) while it's read and
+    written, so neither side is ever held whole in memory; the output is
+    spooled to disk past spool_threshold. At most `concurrency` encodes run at
+    once, later ones wait for a slot, so a burst of requests can't start more
+    CPU-bound encoders than the machine has cores.
+    """
+
+    def __init__(self, ffmpeg=None, ffprobe=None, concurrency=None, timeout=300, spool_threshold=20 * 1024 * 1024):
+        """
+        Args:
+            ffmpeg (str): ffmpeg binary (defaults to FFMPEG_PATH)
+            ffprobe (str): ffprobe binary (defaults to FFPROBE_PATH)
+            concurrency (int): Encodes allowed at once (defaults to the CPU count)
+            timeout (float): Seconds one encode may take before it's killed
+            spool_threshold (int): Output size above which it's spooled to a temp file
+        """
+        self.ffmpeg = shutil.which(ffmpeg or FFMPEG_PATH)
+        self.ffprobe = shutil.which(ffprobe or FFPROBE_PATH)
+        self.concurrency = concurrency or os.cpu_count() or 2
+        self.timeout = timeout
+        self.spool_threshold = spool_threshold
+        self._slots = None
+
+    @property
+    def available(self):
+        return self.ffmpeg is not None
+
+    def _semaphore(self):
+        # Created lazily so it binds to the loop that first uses it
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.concurrency)
+        return self._slots
+
+    async def transcode(self, source, profile):
+        """
+        Re-encodes audio to a named profile
+
+        Args:
+            source: Readable binary file object holding the audio
+            profile (str): Key of PROFILES
+
+        Returns:
+            SpooledTemporaryFile: The re-encoded MP3, rewound - the caller must close it
+
+        Raises:
+            TranscodeError: If ffmpeg fails or times out
+        """
+        if profile not in PROFILES:
+            raise ValueError(f"Unknown transcode profile {profile!r}, expected one of {', '.join(PROFILES)}")
+        return await self.encode(source, PROFILES[profile])
+
+    async def fit(self, source, max_bytes, duration=None):
+        """
+        Re-encodes audio at the highest standard bitrate that keeps it under max_bytes
+
+        Args:
+            source: Readable binary file object holding the audio
+            max_bytes (int): Size the result must not exceed
+            duration (float): Track length in seconds (probed with ffprobe if not given)
+
+        Returns:
+            SpooledTemporaryFile: The re-encoded MP3, rewound - the caller must close it
+
+        Raises:
+            TranscodeError: If ffmpeg fails, or even the lowest bitrate is too large
+        """
+        if duration is None:
+            duration = await self.probe_duration(source)
+        if duration is None:
+            source_size = source.seek(0, os.SEEK_END)
+            duration = source_size * 8 / (FALLBACK_SOURCE_BITRATE * 1000)
+
+        # Leave headroom for the ID3 tag, frame padding and encoder overshoot
+        budget = max_bytes * 8 * 0.95 / max(duration, 1) / 1000
+        bitrate = next((b for b in MP3_BITRATES if b <= budget), None)
+        if bitrate is None:
+            raise TranscodeError(f"A {duration:.0f}s track can't be encoded under {max_bytes} bytes")
+
+        output = await self.encode(source, bitrate)
+        if output.seek(0, os.SEEK_END) > max_bytes:
+            output.close()
+            raise TranscodeError(f"Encoding at {bitrate} kbit/s still exceeded {max_bytes} bytes")
+        output.seek(0)
+        return output
+
+    async def probe_duration(self, source):
+        """
+        Measures a track's length with ffprobe
+
+        Returns:
+            float: Duration in seconds, or None if ffprobe is missing or can't tell
+        """
+        if not self.ffprobe:
+            return None
+        args = [self.ffprobe, "-v", "error", "-show_entries", "format=duration", "-of", "default=noprint_wrappers=1:nokey=1", "-i", "pipe:0"]
+        output = tempfile.SpooledTemporaryFile(max_size=64 * 1024)
+        try:
+            await self._pipe(args, source, output)
+            output.seek(0)
+            return float(output.read().decode().strip())
+        except (TranscodeError, ValueError):
+            return None
+        finally:
+            output.close()
+
+    async def encode(self, source, bitrate):
+        """
+        Re-encodes audio to constant-bitrate MP3, keeping its tags and cover art
+
+        Args:
+            source: Readable binary file object holding the audio
+            bitrate (int): Target bitrate in kbit/s
+
+        Returns:
+            SpooledTemporaryFile: The re-encoded MP3, rewound - the caller must close it
+
+        Raises:
+            TranscodeError: If ffmpeg fails or times out
+        """
+        if not self.ffmpeg:
+            raise TranscodeError("ffmpeg is not installed")
+        args = [
+            self.ffmpeg, "-hide_banner", "-loglevel", "error",
+            "-i", "pipe:0", "-map", "0:a:0", "-map", "0:v?", "-map_metadata", "0",
+            # Embedded cover art is an attached-picture video stream; copy it as is
+            "-codec:v", "copy", "-codec:a", "libmp3lame", "-b:a", f"{bitrate}k", "-id3v2_version", "3",
+            "-f", "mp3", "pipe:1"
+        ]
+        output = tempfile.SpooledTemporaryFile(max_size=self.spool_threshold)
+        try:
+            await self._pipe(args, source, output)
+        except BaseException:
+            output.close()
+            raise
+        output.seek(0)
+        return output
+
+    async def _pipe(self, args, source, output):
+        # Streams source through the process into output, inside one of the pool's slots
+        async with self._semaphore():
+            process = await asyncio.create_subprocess_exec(
+                *args, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+            )
+
+            async def feed():
+                try:
+                    source.seek(0)
+                    while chunk := await asyncio.to_thread(source.read, CHUNK_SIZE):
+                        process.stdin.write(chunk)
+                        await process.stdin.drain()
+                except (BrokenPipeError, ConnectionResetError):
+                    # The process stopped reading (e.g. ffprobe has what it needs); its exit status says how it went
+                    pass
+                finally:
+                    process.stdin.close()
+
+            async def collect():
+                while chunk := await process.stdout.read(CHUNK_SIZE):
+                    output.write(chunk)
+
+            try:
+                _, _, stderr = await asyncio.wait_for(
+                    asyncio.gather(feed(), collect(), process.stderr.read()), self.timeout
+                )
+                returncode = await process.wait()
+            except BaseException as e:
+                if process.returncode is None:
+                    process.kill()
+                    await process.wait()
+                if isinstance(e, asyncio.TimeoutError):
+                    raise TranscodeError(f"{os.path.basename(args[0])} timed out after {self.timeout}s")
+                raise
+            source.seek(0)
+
+        if returncode != 0:
+            message = stderr.decode(errors="replace").strip().splitlines()
+            raise TranscodeError(f"{os.path.basename(args[0])} exited with {returncode}: {message[-1] if message else 'no output'}")
+
+
+def variant_key(track_id, profile):
+    """
+    Audio store key of a track re-encoded with a profile ("fit" for size-fitted encodes)
+    """
+    return f"{track_id}@{profile}"
@@ -0,0 +1,206 @@
+"""
+Download worker for the split deployment.
+
+The bot front end (spotify_bot.py with BROKER_URL set) only accepts updates and
+enqueues download jobs. Any number of these workers, on this host or others,
+take jobs from the broker, download the track and send it to the chat.
+
+Usage:
+    BROKER_URL=sqlite:///cache/jobs.sqlite3 python worker.py --processes 4 --concurrency 8
+    BROKER_URL=redis://localhost:6379/0 python worker.py
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import signal
+
+from telegram import Bot
+
+import spotify_bot
+from broker import broker_from_url
+from metrics import METRICS_PORT, start_metrics_server
+from spotify_bot import DeliveryError, deliver_track, send_cached_audio
+from tracing import span
+
+# A job not acked or extended within this many seconds is handed to another worker
+VISIBILITY_TIMEOUT = float(os.environ.get("JOB_VISIBILITY_TIMEOUT", 120))
+POLL_INTERVAL = 0.5  # seconds between broker polls when idle
+# On SIGTERM/SIGINT, running jobs get this long to finish; unfinished ones are redelivered after their visibility timeout
+SHUTDOWN_GRACE = float(os.environ.get("WORKER_SHUTDOWN_GRACE", 30))  # seconds
+
+
+class ChatReply:
+    """
+    Stands in for the user's message so deliver_track can reply from a worker
+    """
+
+    def __init__(self, bot, chat_id, message_id):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+
+    async def reply_audio(self, **kwargs):
+        return await self.bot.send_audio(chat_id=self.chat_id, reply_to_message_id=self.message_id, **kwargs)
+
+
+class StatusMessage:
+    """
+    Stands in for the status message the front end posted for a job
+    """
+
+    def __init__(self, bot, chat_id, message_id):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+
+    async def edit_text(self, text, **kwargs):
+        return await self.bot.edit_message_text(text, chat_id=self.chat_id, message_id=self.message_id, **kwargs)
+
+    async def delete(self):
+        return await self.bot.delete_message(chat_id=self.chat_id, message_id=self.message_id)
+
+
+async def handle_job(bot, payload):
+    """
+    Delivers one queued track
+
+    DeliveryError is a final answer for the user and completes the job; any other
+    exception leaves the job unacknowledged so it's retried after the visibility timeout.
+    """
+    message = ChatReply(bot, payload['chat_id'], payload['message_id'])
+    status_message = StatusMessage(bot, payload['chat_id'], payload['status_message_id']) if payload.get('status_message_id') else None
+    track_id = payload['track_id']
+
+    if await send_cached_audio(message, track_id):
+        if status_message:
+            await status_message.delete()
+        return
+
+    try:
+        if status_message:
+            await status_message.edit_text("🔄 Downloading track... Please wait, this may take a moment.")
+        await deliver_track(message, track_id, payload['track_url'], track_data=payload.get('track_data'), status_message=status_message)
+        if status_message:
+            await status_message.delete()
+    except DeliveryError as e:
+        if status_message:
+            await status_message.edit_text(str(e))
+
+
+async def keep_reserved(broker, job_id, receipt):
+    # Extend the reservation while the job runs so long downloads aren't handed out twice
+    while True:
+        await asyncio.sleep(VISIBILITY_TIMEOUT / 3)
+        if not await asyncio.to_thread(broker.extend, job_id, receipt, VISIBILITY_TIMEOUT):
+            print(f"Lost reservation for job {job_id}")
+            return
+
+
+async def process_job(bot, broker, job, slots):
+    job_id, receipt, payload, attempts = job
+    heartbeat = asyncio.create_task(keep_reserved(broker, job_id, receipt))
+    try:
+        # Continue the trace of the update that queued the job
+        with span("job", trace_id=payload.get('trace_id'), parent_id=payload.get('parent_span_id'), job_id=job_id, attempt=attempts):
+            await handle_job(bot, payload)
+        await asyncio.to_thread(broker.ack, job_id, receipt)
+    except Exception as e:
+        print(f"Job {job_id} failed on attempt {attempts}, will be retried: {e}")
+    finally:
+        heartbeat.cancel()
+        slots.release()
+
+
+async def run_worker(broker_url, concurrency):
+    """
+    Takes jobs from the broker and runs up to concurrency of them at a time
+
+    SIGTERM or SIGINT stops taking new jobs and waits up to SHUTDOWN_GRACE
+    seconds for the running ones.
+    """
+    broker = broker_from_url(broker_url)
+    slots = asyncio.Semaphore(concurrency)
+    print(f"Worker {os.getpid()} consuming {broker_url} ({concurrency} at a time)")
+
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, stopping.set)
+        except (NotImplementedError, RuntimeError):
+            # No signal handlers here (e.g. Windows); Ctrl+C then cancels running jobs
+            pass
+
+    # The event loop only keeps weak references to tasks; hold running jobs until they finish
+    running = set()
+    async with Bot(spotify_bot.TOKEN, base_url=spotify_bot.TELEGRAM_API_BASE_URL) as bot:
+        try:
+            while not stopping.is_set():
+                await slots.acquire()
+                if stopping.is_set():
+                    slots.release()
+                    break
+                job = await asyncio.to_thread(broker.reserve, VISIBILITY_TIMEOUT)
+                if job is None:
+                    slots.release()
+                    try:
+                        await asyncio.wait_for(stopping.wait(), POLL_INTERVAL)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                task = asyncio.create_task(process_job(bot, broker, job, slots))
+                running.add(task)
+                task.add_done_callback(running.discard)
+        finally:
+            if running:
+                print(f"Worker {os.getpid()} waiting up to {SHUTDOWN_GRACE:.0f}s for {len(running)} running jobs")
+                _, pending = await asyncio.wait(set(running), timeout=SHUTDOWN_GRACE)
+                for task in pending:
+                    task.cancel()
+                await asyncio.gather(*pending, return_exceptions=True)
+
+
+def start_worker(broker_url, concurrency, index=0):
+    # Each process serves its own /metrics, on consecutive ports from METRICS_PORT
+    if METRICS_PORT:
+        start_metrics_server(METRICS_PORT + index)
+    try:
+        asyncio.run(run_worker(broker_url, concurrency))
+    except KeyboardInterrupt:
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run download workers for the bot")
+    parser.add_argument("--broker", default=os.environ.get("BROKER_URL"), help="broker URL (default: $BROKER_URL)")
+    parser.add_argument("--processes", type=int, default=1, help="worker processes to start")
+    parser.add_argument("--concurrency", type=int, default=8, help="jobs each process runs at once")
+    args = parser.parse_args()
+
+    if not args.broker:
+        parser.error("set BROKER_URL or pass --broker")
+
+    if args.processes == 1:
+        start_worker(args.broker, args.concurrency)
+        return
+
+    # Importing spotify_bot opens SQLite connections (caches, audio store, rate limits), and a
+    # connection carried across fork() can corrupt the database; spawned children open their own
+    context = multiprocessing.get_context("spawn")
+    processes = [
+        context.Process(target=start_worker, args=(args.broker, args.concurrency, index))
+        for index in range(args.processes)
+    ]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+
+
+if __name__ == "__main__":
+    main()